@@ -1,17 +1,48 @@
 from PyPrometheusQueryClient import PrometheusQueryClient
 import json 
 from pathlib import Path
+import time
+import threading
+import multiprocessing
 from datetime import datetime
+from urllib.parse import quote, unquote
+from PyPrometheusCache import RangeQueryCache
+import PyPrometheusInstrumentation as instrumentation
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 class Prometheus:
-    def __init__(self, url, metrics_config_file=None, cache_path=None, cache_ttl=3600, ssl_verify=True, starttime=None, endtime=None):
+    def __init__(self, url, metrics_config_file=None, cache_path=None, cache_ttl=3600, cache_retention=None, ssl_verify=True, starttime=None, endtime=None,
+                 compact=False, compact_float32=False, keep_raw=False, instrumentation=None, column_labels=None, max_series=None,
+                 rollup_tiers=None):
 
         self._metrics_config_file = metrics_config_file
         self._starttime = starttime
         self._endtime = endtime
 
+        # In compact mode, prometheus_data entries hold columnar sample arrays and build 'data' and 'df' on demand
+        self._compact = compact
+        self._compact_float32 = compact_float32
+        self._keep_raw = keep_raw
+        self._interner = None
+
+        # Defaults for metrics which don't set 'labels' (or 'aggregate_by') and 'max_series' in the metrics config
+        self._column_labels = column_labels
+        self._max_series = max_series
+
+        # Per-metric query step and last sample time, so that refresh_metric() can fetch only what's new
+        self._tail_state = {}
+        self._poller = None
+
+        # Per-metric column of each series' label set, so that refreshed series land in the columns they started in
+        self._series_columns = {}
+
+        # The process pool which get_metrics() decodes and parses responses on, while it runs with parse_processes
+        self._parse_pool = None
+
+        # Don't connect until we need to; the metric catalog is fetched on first use
         self.pqc = PrometheusQueryClient(url=url, cache_path=cache_path, 
-                                         cache_ttl=cache_ttl, ssl_verify=ssl_verify)
+                                         cache_ttl=cache_ttl, cache_retention=cache_retention, ssl_verify=ssl_verify, auto_get_server_metrics=False, 
+                                         instrumentation=instrumentation, rollup_tiers=rollup_tiers)
         self._load_metrics_config()
         self.prometheus_data = {} 
         #---
@@ -35,19 +66,193 @@ class Prometheus:
         
         return
 
-    def get_metrics(self, report_progress):
+    def get_metrics(self, report_progress, max_workers=1, batch=False, max_series_per_batch=1000, parse_processes=0):
+        # With parse_processes, raw response bodies are decoded and parsed into sample arrays on a pool of that
+        # many processes, and the arrays handed back through shared memory. Entries are then stored compactly 
+        # (see PyPrometheusStore.CompactMetricData), without the raw results. Queries which go through the range 
+        # cache, or need sharding, are still parsed in this process.
+        # Work out which metrics we need, up front, so a bad config fails before we start fetching
+        metrics = []
         for (metric, metadata) in self._metrics_config.items():
             if metadata['active'] == False:
                 continue
 
-            if (not metric in self.pqc.metrics):
+            if (not self.pqc.has_metric(metric)):
                 raise ValueError("Metric '{}' is unknown".format(metric))
 
-            if (report_progress):
-                print("Getting results for metric '{}'{}".format(metric, ' ' * 40), end='\r')
-                
-            _ = self.get_metric(metric, metadata)
-            
+            metrics.append( (metric, metadata) )
+
+        # Optionally combine metrics into batches, each fetched by a single query
+        if (batch):
+            batches = self._plan_batches(metrics, max_series_per_batch)
+        else:
+            batches = [ [item] for item in metrics ]
+
+        # Fetch the metrics on a pool of worker threads, collecting any per-metric errors rather than 
+        # abandoning the whole run. Progress is reported from this thread as each metric completes.
+        errors = {}
+        count = 0
+        self._parse_pool = self._start_parse_pool(parse_processes) if (parse_processes) else None
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = { executor.submit(self._get_metric_batch, items): items for items in batches }
+                for future in as_completed(futures):
+                    items = futures[future]
+                    try:
+                        _ = future.result()
+                    except Exception as e:
+                        for (metric, _) in items:
+                            errors[metric] = e
+                            self.prometheus_data.pop(metric, None)
+
+                    for (metric, _) in items:
+                        count += 1
+                        if (report_progress):
+                            print("Got results for metric '{}' ({}/{}){}".format(metric, count, len(metrics), ' ' * 40), end='\r')
+        finally:
+            if (self._parse_pool):
+                self._parse_pool.shutdown()
+                self._parse_pool = None
+
+        return errors
+
+
+    @staticmethod
+    def _start_parse_pool(processes):
+        # Forking once the fetch threads are running could copy a lock that one of them holds, so the workers 
+        # come from a fork server (or are spawned, where there isn't one), and are all started here, up front
+        method = 'forkserver' if ('forkserver' in multiprocessing.get_all_start_methods()) else 'spawn'
+        pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context(method))
+        try:
+            list(pool.map(int, range(processes)))
+        except BaseException:
+            pool.shutdown()
+            raise
+        return pool
+
+
+    def _plan_batches(self, metrics, max_series_per_batch):
+        # Count the current series of each metric with instant queries over a few combined selectors, fetched
+        # concurrently, then pack metrics, in config order, into batches which stay under the series limit
+        names = [ metric for (metric, _) in metrics ]
+        limit = self.pqc.max_metrics_per_selector
+        at = PrometheusQueryClient._datetime_to_str(self._endtime)
+        def count(chunk):
+            query = 'count by (__name__) ({})'.format(PrometheusQueryClient._name_selector(chunk))
+            return self.pqc._do_query('api/v1/query', {'query': query, 'time': at})
+
+        chunks = [ names[i:i + limit] for i in range(0, len(names), limit) ]
+        if (len(chunks) <= 1):
+            counted = [ count(chunk) for chunk in chunks ]
+        else:
+            with ThreadPoolExecutor(max_workers=self.pqc.shard_workers) as executor:
+                counted = list(executor.map(count, chunks))
+        counts = { r['metric'].get('__name__'): int(float(r['value'][1])) for vector in counted for r in vector.get('result', []) }
+
+        batches = []
+        current = []
+        current_series = 0
+        for (metric, metadata) in metrics:
+            # Metrics with their own query or step can't share a selector. Those with too many series are left 
+            # to get_metric() to reject.
+            max_series = self._max_series_for(metadata)
+            if (Prometheus._is_pushdown(metadata) or 'step' in metadata or (max_series and counts.get(metric, 0) > max_series)):
+                batches.append( [(metric, metadata)] )
+                continue
+
+            series = max(counts.get(metric, 1), 1)
+            if (current and (current_series + series > max_series_per_batch or len(current) >= self.pqc.max_metrics_per_selector)):
+                batches.append(current)
+                (current, current_series) = ([], 0)
+            current.append( (metric, metadata) )
+            current_series += series
+
+        if (current):
+            batches.append(current)
+
+        return batches
+
+
+    # Range-vector functions which may be pushed down to the server, and the aggregation operators to apply over them
+    pushdown_functions = ('rate', 'irate', 'increase', 'delta', 'idelta', 'deriv', 'changes', 'resets', 
+                          'avg_over_time', 'min_over_time', 'max_over_time', 'sum_over_time', 'count_over_time', 
+                          'last_over_time', 'stddev_over_time', 'stdvar_over_time', 'quantile_over_time')
+    pushdown_aggregations = ('sum', 'avg', 'min', 'max', 'count', 'stddev', 'stdvar', 'quantile', 'group')
+
+    @staticmethod
+    def _is_pushdown(metadata):
+        return any(key in metadata for key in ('function', 'aggregate_by'))
+
+
+    @staticmethod
+    def _build_query(metric, metadata):
+        # Rewrite a metric into PromQL from its config, so that the server does the reduction:
+        #   function:    a range-vector function, applied over 'range' (default '5m'), e.g. rate(metric[5m])
+        #   aggregate_by: labels to aggregate over, with the 'aggregation' operator (default 'sum')
+        #   quantile:    the parameter for quantile_over_time and quantile aggregations
+        query = metric
+
+        function = metadata.get('function', None)
+        if (function):
+            if (function not in Prometheus.pushdown_functions):
+                raise ValueError("Unsupported function '{}' for metric '{}'".format(function, metric))
+            query = '{}[{}]'.format(query, metadata.get('range', '5m'))
+            if (function == 'quantile_over_time'):
+                query = '{}, {}'.format(Prometheus._quantile(metric, metadata, function), query)
+            query = '{}({})'.format(function, query)
+
+        aggregate_by = Prometheus._label_list(metadata.get('aggregate_by', None))
+        if (aggregate_by is not None):
+            aggregation = metadata.get('aggregation', 'sum')
+            if (aggregation not in Prometheus.pushdown_aggregations):
+                raise ValueError("Unsupported aggregation '{}' for metric '{}'".format(aggregation, metric))
+            if (aggregation == 'quantile'):
+                query = '{}, {}'.format(Prometheus._quantile(metric, metadata, aggregation), query)
+            query = '{} by ({}) ({})'.format(aggregation, ', '.join(aggregate_by), query)
+
+        return query
+
+
+    @staticmethod
+    def _label_list(labels):
+        # A single label may be given on its own, rather than in a list
+        return [labels] if (isinstance(labels, str)) else labels
+
+
+    @staticmethod
+    def _quantile(metric, metadata, operator):
+        if ('quantile' not in metadata):
+            raise ValueError("Metric '{}' needs a 'quantile' for {}".format(metric, operator))
+        return metadata['quantile']
+
+
+    def _get_metric_batch(self, items):
+        if (len(items) == 1):
+            return [ self.get_metric(*items[0]) ]
+
+        # One selector for every metric in the batch, with the matrix split back out by __name__
+        if(not self._starttime or not self._endtime):
+            raise ValueError('Both starttime and endtime must be set')
+
+        selector = PrometheusQueryClient._name_selector([ metric for (metric, _) in items ])
+        (start, end, step) = PrometheusQueryClient._resolve_window(self._starttime, self._endtime)
+        with self.pqc._instrument('get_metric_batch', selector):
+            if (self._parses_remotely(start, end, step)):
+                return self._get_parsed(selector, [ (metric, metadata, metric) for (metric, metadata) in items ], start, end, step)
+
+            results = self.pqc.query_range(selector, start, end, step)
+
+            split = { metric: [] for (metric, _) in items }
+            for series in results['result']:
+                split.setdefault(series['metric'].get('__name__'), []).append(series)
+
+            stored = []
+            for (metric, metadata) in items:
+                metric_results = {'resultType': results['resultType'], 'result': split[metric]}
+                self._remember_window(metric, metric, metric_results, end, step)
+                stored.append( self._store_metric(metric, metadata, metric_results) )
+
+        return stored
 
     
 
@@ -74,7 +279,7 @@ class Prometheus:
             raise ValueError("Metric '{}' cannot be None")
 
         # Make sure the metrics are present in the list retrived from the server
-        if (not metric in self.pqc.metrics):
+        if (not self.pqc.has_metric(metric)):
             raise ValueError("Metric '{}' is not available on the server".format(metric))
 
         # If we're not passed the metadata, try to reocover it from our metrics config.
@@ -85,21 +290,290 @@ class Prometheus:
         # Now do the real work
         #
 
-        # Set up the stub of the result
-        self.prometheus_data[metric] = {}
-        self.prometheus_data[metric]['metadata'] = metadata
-        self.prometheus_data[metric]['title'] = metric
+        query = Prometheus._build_query(metric, metadata)
+        (start, end, step) = PrometheusQueryClient._resolve_window(starttime, endtime, metadata.get('step', None))
+        with self.pqc._instrument('get_metric', query):
+            max_series = self._max_series_for(metadata)
+            if (max_series):
+                self.pqc.check_cardinality(query, max_series, time=end, start=start, step=step)
+
+            if (self._parses_remotely(start, end, step)):
+                return self._get_parsed(query, [ (metric, metadata, query) ], start, end, step)[0]
+
+            results = self.pqc.query_range(query, start, end, step)
+            self._remember_window(metric, query, results, end, step)
+
+            return self._store_metric(metric, metadata, results)
+
+
+    def _column_labels_for(self, metadata):
+        # The labels which name a metric's columns, after __name__: as configured, else those it was aggregated by
+        return Prometheus._label_list(metadata.get('labels', metadata.get('aggregate_by', self._column_labels)))
+
+
+    def _max_series_for(self, metadata):
+        return metadata.get('max_series', self._max_series)
+
+
+    def _parses_remotely(self, start, end, step):
+        if (self._parse_pool is None or self.pqc._cache is not None):
+            return False
+        shards = self.pqc._shard_range(PrometheusQueryClient._to_timestamp(start), PrometheusQueryClient._to_timestamp(end), 
+                                       PrometheusQueryClient._step_to_seconds(step))
+        return len(shards) <= 1
+
+
+    def _get_parsed(self, query, items, start, end, step):
+        # Fetch the raw response here, and decode and parse it in the process pool. items are (metric, metadata, 
+        # query to refresh it with).
+        import numpy as np
+        from PyPrometheusStore import CompactMetricData, Interner, parse_response, from_shared, release_shared
+
+        body = self.pqc.query_range_raw(query, start, end, step)
+        dtype = np.float32 if (self._compact_float32) else np.float64
+        with instrumentation.phase('decode'):
+            parsed = self._parse_pool.submit(parse_response, body, [ (metric, self._column_labels_for(metadata)) for (metric, metadata, _) in items ], 
+                                             np.dtype(dtype).str).result()
+
+        # Take every block out of shared memory before using any, so that none is left behind if one fails
+        arrays = {}
+        try:
+            for (metric, (_, _, handle)) in parsed.items():
+                arrays[metric] = from_shared(handle)
+        finally:
+            for (metric, (_, _, handle)) in parsed.items():
+                if (metric not in arrays):
+                    release_shared(handle)
+
+        if (self._interner is None):
+            self._interner = Interner()
+
+        stored = []
+        for (metric, metadata, tail_query) in items:
+            (columns, label_sets, _) = parsed[metric]
+            (timestamps, values) = arrays[metric]
+            (deltas, counter, rate) = Prometheus._delta_options(metric, metadata)
+
+            self.prometheus_data[metric] = CompactMetricData.from_arrays(metric, metadata, columns, label_sets, timestamps, values, self._interner, 
+                                                                         deltas=deltas, counter=counter, rate=rate)
+            last = (timestamps[-1] / 1000) if (len(timestamps)) else PrometheusQueryClient._to_timestamp(end)
+            self._tail_state[metric] = {'query': tail_query, 'step': step, 'last': float(last)}
+            stored.append(self.prometheus_data[metric])
 
-        # Pull the data via the PrometheusQueryClient, depending on 
+        return stored
+
+
+    def _remember_window(self, metric, query, results, end, step):
+        # The last sample we hold, or failing that the end of the window, is where the next refresh starts from
+        last = max( (float(series['values'][-1][0]) for series in results['result'] if series['values']), 
+                    default=PrometheusQueryClient._to_timestamp(end) )
+        self._tail_state[metric] = {'query': query, 'step': step, 'last': last}
+        return
+
+
+    @staticmethod
+    def _delta_options(metric, metadata):
+        # Deltas as configured; otherwise, as PrometheusQueryClient.get_metric(), only for cumulative metrics 
+        # which haven't already been reduced on the server
         deltas = metadata.get('deltas', None)
+        counter = metadata.get('counter', False)
         if (deltas == None):
-            (data, df) = self.pqc.get_metric(metric, start=starttime, end=endtime)
-        elif (deltas == True):
-            (data, df) = self.pqc.get_with_deltas(metric, start=starttime, end=endtime)
-        else:
-            (data, df) = self.pqc.get_without_deltas(metric, start=starttime, end=endtime)
+            deltas = counter = PrometheusQueryClient._is_cumulative(metric) and not Prometheus._is_pushdown(metadata)
+        return (deltas, counter, metadata.get('rate', False))
+
+
+    def _store_metric(self, metric, metadata, results):
+        (deltas, counter, rate) = Prometheus._delta_options(metric, metadata)
 
-        self.prometheus_data[metric]['data'] = data
+        if (self._compact):
+            import numpy as np
+            from PyPrometheusStore import CompactMetricData, Interner
+
+            if (self._interner is None):
+                self._interner = Interner()
+
+            with instrumentation.phase('dataframe'):
+                self.prometheus_data[metric] = CompactMetricData(metric, metadata, results, self._interner, dtype=np.float32 if (self._compact_float32) else np.float64, 
+                                                                 deltas=deltas, counter=counter, rate=rate, keep_raw=self._keep_raw, 
+                                                                 labels=self._column_labels_for(metadata))
+            return self.prometheus_data[metric]
+
+        columns = PrometheusQueryClient._column_names([ series['metric'] for series in results['result'] ], metric, self._column_labels_for(metadata))
+        self._series_columns[metric] = { Prometheus._label_key(series['metric']): column for (series, column) in zip(results['result'], columns) }
+
+        df = PrometheusQueryClient._result_to_frame(results, name=metric, columns=columns)
+        if (deltas):
+            df = PrometheusQueryClient._compute_deltas(df, counter=counter, rate=rate)
+
+        self.prometheus_data[metric] = {}
+        self.prometheus_data[metric]['metadata'] = metadata
+        self.prometheus_data[metric]['title'] = metric
+        self.prometheus_data[metric]['data'] = results
         self.prometheus_data[metric]['df']   = df
 
-        return self.prometheus_data[metric]
\ No newline at end of file
+        return self.prometheus_data[metric]
+
+
+    def refresh_metric(self, metric, retention=None):
+        # Fetch only the samples after the last one we hold, append them to the metric's frame and, given a 
+        # retention in seconds, drop anything older than that
+        with self.pqc._instrument('refresh_metric', metric):
+            return self._refresh_metric(metric, retention)
+
+
+    def _refresh_metric(self, metric, retention):
+        import pandas as pd
+
+        state = self._tail_state.get(metric)
+        if (state is None or metric not in self.prometheus_data):
+            raise ValueError("Metric '{}' has not been fetched yet".format(metric))
+
+        item = self.prometheus_data[metric]
+        step_s = PrometheusQueryClient._step_to_seconds(state['step'])
+        (start, end) = (state['last'] + step_s, time.time())
+        if (start > end):
+            return item
+
+        results = self.pqc.query_range(state['query'], start, end, state['step'])
+        if (not any(series['values'] for series in results['result'])):
+            return item
+
+        cutoff = (end - retention) if (retention) else None
+        held = item['data']['result'] if (item['data']) else []
+        merged = RangeQueryCache.stitch([ {'start': 0, 'result': held}, {'start': 1, 'result': results['result']} ], 
+                                        cutoff if (cutoff) else float('-inf'), float('inf'))
+        self._remember_window(metric, state['query'], merged, end, state['step'])
+
+        # Compact entries are rebuilt from the merged samples
+        if (self._compact):
+            return self._store_metric(metric, item['metadata'], merged)
+
+        (deltas, counter, rate) = Prometheus._delta_options(metric, item['metadata'])
+        new_df = PrometheusQueryClient._result_to_frame(results, name=metric, columns=self._refreshed_columns(metric, item['metadata'], merged, results))
+        if (deltas):
+            # Seed the deltas of the new rows with the last row we already hold
+            seed = item['df'][[ col for col in new_df.columns if col in item['df'].columns ]].iloc[-1:]
+            new_df = PrometheusQueryClient._compute_deltas(pd.concat([seed, new_df]), counter=counter, rate=rate).iloc[1:]
+
+        df = pd.concat([item['df'], new_df])
+        if (cutoff):
+            df = df[df.index >= pd.Timestamp(cutoff, unit='s')]
+
+        self.prometheus_data[metric] = {'metadata': item['metadata'], 'title': item['title'], 'data': merged, 'df': df}
+        return self.prometheus_data[metric]
+
+
+    @staticmethod
+    def _label_key(labels):
+        return frozenset(labels.items())
+
+
+    def _refreshed_columns(self, metric, metadata, merged, results):
+        # Series we already hold keep their column. Names for new ones come from every series we now hold, since 
+        # which labels tell them apart depends on their siblings and these may not all be in the refreshed part.
+        known = self._series_columns.setdefault(metric, {})
+        names = dict(zip(( Prometheus._label_key(series['metric']) for series in merged['result'] ), 
+                         PrometheusQueryClient._column_names([ series['metric'] for series in merged['result'] ], metric, self._column_labels_for(metadata))))
+
+        for series in results['result']:
+            key = Prometheus._label_key(series['metric'])
+            if (key not in known):
+                known[key] = names[key]
+        return [ known[Prometheus._label_key(series['metric'])] for series in results['result'] ]
+
+
+    def start_polling(self, interval, metrics=None, retention=None, callback=None):
+        # Refresh the given (or all previously fetched) metrics every interval seconds on a background thread. 
+        # callback(self, errors) is called after each round.
+        if (self._poller):
+            raise RuntimeError('Already polling')
+
+        stop = threading.Event()
+        def poll():
+            while (not stop.wait(interval)):
+                errors = {}
+                for metric in (metrics if (metrics) else list(self._tail_state.keys())):
+                    try:
+                        self.refresh_metric(metric, retention=retention)
+                    except Exception as e:
+                        errors[metric] = e
+                if (callback):
+                    callback(self, errors)
+
+        thread = threading.Thread(target=poll, name='PrometheusPoller', daemon=True)
+        thread.start()
+        self._poller = (thread, stop)
+        return
+
+
+    def stop_polling(self):
+        if (self._poller):
+            (thread, stop) = self._poller
+            stop.set()
+            thread.join()
+            self._poller = None
+        return
+
+
+    # Column holding the DataFrame index in exported files
+    _index_column = '__timestamp__'
+
+    def export_data(self, path, format='arrow', metrics=None):
+        # Write each metric's frame to its own Arrow IPC (or Parquet) file, with the metric's title and
+        # metadata stored in the file's schema metadata. Requires pyarrow.
+        import pyarrow as pa
+
+        if (format not in ('arrow', 'parquet')):
+            raise ValueError("Unknown export format '{}'".format(format))
+
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        for metric in (metrics if (metrics) else self.prometheus_data.keys()):
+            item = self.prometheus_data[metric]
+            df = item['df'].rename_axis(self._index_column).reset_index()
+
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            schema_metadata = dict(table.schema.metadata or {})
+            schema_metadata[b'pyprometheus'] = json.dumps({'title': item['title'], 'metadata': item['metadata']}).encode('UTF-8')
+            table = table.replace_schema_metadata(schema_metadata)
+
+            filename = path / '{}.{}'.format(quote(metric, safe=''), format)
+            if (format == 'arrow'):
+                with pa.OSFile(str(filename), 'wb') as sink:
+                    with pa.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+            else:
+                import pyarrow.parquet as pq
+                pq.write_table(table, str(filename))
+
+        return
+
+
+    def import_data(self, path, metrics=None):
+        # Load frames written by export_data() into prometheus_data. Arrow IPC files are memory-mapped, so
+        # numeric columns are backed directly by the file rather than copied. The raw 'data' is not persisted.
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        loaded = []
+        for filename in sorted(Path(path).iterdir()):
+            if (filename.suffix not in ('.arrow', '.parquet')):
+                continue
+
+            metric = unquote(filename.stem)
+            if (metrics and metric not in metrics):
+                continue
+
+            if (filename.suffix == '.arrow'):
+                table = pa.ipc.open_file(pa.memory_map(str(filename), 'r')).read_all()
+            else:
+                table = pq.read_table(str(filename), memory_map=True)
+
+            info = json.loads(table.schema.metadata[b'pyprometheus'].decode('UTF-8'))
+            df = table.to_pandas(split_blocks=True).set_index(self._index_column).rename_axis(None)
+
+            self.prometheus_data[metric] = {'metadata': info['metadata'], 'title': info['title'], 'data': None, 'df': df}
+            loaded.append(metric)
+
+        return loaded
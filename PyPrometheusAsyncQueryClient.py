@@ -0,0 +1,144 @@
+import asyncio
+from urllib.parse import urljoin
+import httpx
+from PyPrometheusQueryClient import PrometheusQueryClient
+from PyPrometheusCache import RangeQueryCache
+from PyPrometheusCatalog import MetricCatalog
+
+
+class AsyncPrometheusQueryClient:
+    # An asyncio counterpart to PrometheusQueryClient, built on a pooled httpx.AsyncClient so that many
+    # range queries can be in flight at once from a single event loop. Parsing, sharding and DataFrame
+    # construction are shared with the synchronous client.
+    retry_status_codes   = PrometheusQueryClient.retry_status_codes
+    max_points_per_query = PrometheusQueryClient.max_points_per_query
+
+    _shard_range = PrometheusQueryClient._shard_range
+
+    def __init__(self, url, ssl_verify=True, pool_size=100, timeout=None, retries=3, backoff_factor=0.5, shard_concurrency=4):
+        self.url = url
+        self.ssl_verify = ssl_verify
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.shard_concurrency = shard_concurrency
+        self.metrics = None
+        self._catalog = None
+        self._catalog_lock = asyncio.Lock()
+
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self._client = httpx.AsyncClient(verify=ssl_verify, timeout=timeout, limits=limits,
+                                         headers={'Accept-Encoding': 'gzip, deflate'})
+
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self._client.aclose()
+        return
+
+
+    async def _get(self, url, params=None):
+        # Retry throttled and failed requests, and those which failed to connect or timed out, with exponential 
+        # backoff, honouring Retry-After where given
+        for attempt in range(self.retries + 1):
+            try:
+                resp = await self._client.get(url, params=params)
+            except httpx.TransportError:
+                if (attempt == self.retries):
+                    raise
+                resp = None
+
+            if (resp is not None and (resp.status_code not in self.retry_status_codes or attempt == self.retries)):
+                return resp
+
+            delay = self.backoff_factor * (2 ** attempt)
+            retry_after = resp.headers.get('Retry-After') if (resp is not None) else None
+            if (retry_after and retry_after.isdigit()):
+                delay = max(delay, float(retry_after))
+            await asyncio.sleep(delay)
+
+
+    async def _do_query(self, path, params):
+        resp = PrometheusQueryClient._check_status(await self._get(urljoin(self.url, path), params=params))
+        response = resp.json()
+        if response['status'] != 'success':
+            raise RuntimeError('{errorType}: {error}'.format_map(response))
+        return response['data']
+
+
+    async def _get_all_metrics(self):
+        names = await self._do_query('api/v1/label/__name__/values', None)
+        catalog = MetricCatalog(lambda: names, ttl=None)
+        catalog.refresh()
+        self._catalog = self.metrics = catalog
+        return
+
+
+    async def _ensure_metrics(self):
+        # Concurrent first calls share the one catalog fetch
+        if (self._catalog is None):
+            async with self._catalog_lock:
+                if (self._catalog is None):
+                    await self._get_all_metrics()
+        return self._catalog
+
+
+    async def get_metrics_starting_with(self, targets):
+        return (await self._ensure_metrics()).containing(targets)
+
+
+    async def query_range(self, query, start, end, step, timeout=None):
+        start = PrometheusQueryClient._datetime_to_str(start)
+        end   = PrometheusQueryClient._datetime_to_str(end)
+
+        params = {'query': query, 'start': start, 'end': end, 'step': step}
+        if (timeout):
+            params.update({'timeout': timeout})
+
+        start_ts = PrometheusQueryClient._to_timestamp(start)
+        end_ts   = PrometheusQueryClient._to_timestamp(end)
+        step_s   = PrometheusQueryClient._step_to_seconds(step)
+
+        shards = self._shard_range(start_ts, end_ts, step_s)
+        if (len(shards) <= 1):
+            return await self._do_query('api/v1/query_range', dict(params, start=start_ts, end=end_ts))
+
+        semaphore = asyncio.Semaphore(self.shard_concurrency)
+        async def fetch(shard):
+            async with semaphore:
+                return await self._do_query('api/v1/query_range', dict(params, start=shard[0], end=shard[1]))
+
+        chunks = await asyncio.gather(*(fetch(shard) for shard in shards))
+
+        segments = [ {'start': shard[0], 'result': chunk.get('result', [])} for (shard, chunk) in zip(shards, chunks) ]
+        return RangeQueryCache.stitch(segments, start_ts, end_ts)
+
+
+    async def get_general(self, query, start=None, end=None, step=None):
+        (start, end, step) = PrometheusQueryClient._resolve_window(start, end, step)
+        return await self.query_range(query, start, end, step)
+
+
+    async def get_without_deltas(self, query, start=None, end=None, step=None):
+        results = await self.get_general(query, start, end, step)
+        df = PrometheusQueryClient._result_to_frame(results)
+        return (results, df)
+
+
+    async def get_with_deltas(self, query, start=None, end=None, step=None, counter=False, rate=False):
+        (results, df) = await self.get_without_deltas(query, start, end, step)
+        df = PrometheusQueryClient._compute_deltas(df, counter=counter, rate=rate)
+        return (results, df)
+
+
+    async def get_metric(self, metric, start=None, end=None, step=None):
+        if (not metric in await self._ensure_metrics()):
+            raise ValueError("Metric '{}' is unknown".format(metric))
+
+        if (PrometheusQueryClient._is_cumulative(metric)):
+            return await self.get_with_deltas(metric, start, end, step, counter=True)
+        return await self.get_without_deltas(metric, start, end, step)
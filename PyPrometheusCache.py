@@ -0,0 +1,590 @@
+import os
+import sys
+import math
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+from pathlib import Path
+
+
+def format_value(value):
+    # Renders a sample value as the query API does (Go's FormatFloat(v, 'f', -1, 64)): the fewest digits which 
+    # read back as the same value, never in exponent form, and without a trailing '.0'. A numpy float32 gets 
+    # the fewest digits for a float32, rather than those of the float64 it widens to.
+    if (math.isnan(value)):
+        return 'NaN'
+    if (math.isinf(value)):
+        return '+Inf' if (value > 0) else '-Inf'
+    text = str(value)
+    if ('e' in text):
+        text = format(Decimal(text), 'f')
+    return text[:-2] if (text.endswith('.0')) else text
+
+
+
+class RangeQueryCache:
+    # Samples newer than this (in seconds, relative to the fetch time) may still be incomplete on the
+    # server, so they are returned to the caller but never written to the cache.
+    recent_window = 300
+
+    # Samples within ttl of when they were fetched may yet be revised (e.g. by late remote writes or rule
+    # evaluations), so they expire ttl after the fetch. Anything older is final and is kept, merged into 
+    # contiguous segments, until it falls out of the retention window (in seconds, None for no limit).
+    def __init__(self, cache_path, ttl=3600, retention=None):
+        self.cache_path = Path(cache_path)
+        self.ttl = ttl
+        self.retention = retention
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+
+    @staticmethod
+    def _series_key(metric):
+        return tuple(sorted(metric.items()))
+
+
+    @staticmethod
+    def align(start, end, step):
+        # Snap the window onto the step grid so that evaluation timestamps are shared between requests
+        start = math.ceil(start / step) * step
+        end   = math.floor(end / step) * step
+        return (start, end)
+
+
+    def _key_file(self, url, query, step):
+        key = '{}\n{}\n{}'.format(url, query, step).encode('UTF-8')
+        return self.cache_path / '{}.pkl'.format(hashlib.sha256(key).hexdigest())
+
+
+    def _key_lock(self, path):
+        with self._locks_lock:
+            return self._locks.setdefault(path, threading.Lock())
+
+
+    def _load(self, path, step):
+        if (not path.exists()):
+            return []
+
+        try:
+            with open(path, 'rb') as f:
+                segments = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return []
+
+        # Drop any recent tails which have outlived the TTL (final segments have no fetched_at), and any
+        # samples older than the retention window
+        now = time.time()
+        if (self.ttl):
+            segments = [ seg for seg in segments if seg['fetched_at'] is None or (now - seg['fetched_at']) <= self.ttl ]
+        if (self.retention):
+            cutoff = math.ceil((now - self.retention) / step) * step
+            segments = [ dict(seg, start=cutoff, result=self._trim(seg['result'], seg['end'], cutoff)) if (seg['start'] < cutoff) else seg
+                         for seg in segments if seg['end'] >= cutoff ]
+
+        return segments
+
+
+    def _consolidate(self, segments, step):
+        # Splits off the final part of each segment, and merges final segments which meet or overlap
+        final = []
+        tails = []
+        for seg in segments:
+            cutoff = None
+            if (self.ttl and seg['fetched_at'] is not None):
+                cutoff = math.floor((seg['fetched_at'] - self.ttl) / step) * step
+            if (cutoff is None or seg['end'] <= cutoff):
+                final.append(dict(seg, fetched_at=None))
+                continue
+
+            if (cutoff >= seg['start']):
+                final.append({'start': seg['start'], 'end': cutoff, 'fetched_at': None, 'result': self._trim(seg['result'], cutoff)})
+            tail_start = max(seg['start'], cutoff + step)
+            tails.append(dict(seg, start=tail_start, result=self._trim(seg['result'], seg['end'], tail_start)))
+
+        groups = []
+        for seg in sorted(final, key=lambda s: s['start']):
+            if (groups and seg['start'] <= groups[-1][-1]['end'] + step):
+                groups[-1].append(seg)
+            else:
+                groups.append([seg])
+
+        merged = []
+        for group in groups:
+            if (len(group) == 1):
+                merged.append(group[0])
+                continue
+            (start, end) = (group[0]['start'], max(seg['end'] for seg in group))
+            merged.append({'start': start, 'end': end, 'fetched_at': None, 'result': self.stitch(group, start, end)['result']})
+
+        return merged + tails
+
+
+    def _save(self, path, segments):
+        # Write to a temporary file and swap it in, so that readers never see a partial file
+        tmp = path.with_suffix('.{}.tmp'.format(threading.get_ident()))
+        with open(tmp, 'wb') as f:
+            pickle.dump(segments, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        return
+
+
+    @staticmethod
+    def missing_ranges(segments, start, end, step):
+        missing = []
+        cursor = start
+        for seg in sorted(segments, key=lambda s: s['start']):
+            if (seg['end'] < cursor):
+                continue
+            if (seg['start'] > end):
+                break
+            if (seg['start'] > cursor):
+                missing.append( (cursor, seg['start'] - step) )
+            cursor = max(cursor, seg['end'] + step)
+
+        if (cursor <= end):
+            missing.append( (cursor, end) )
+
+        return missing
+
+
+    @staticmethod
+    def _trim(result, end, start=float('-inf')):
+        trimmed = []
+        for series in result:
+            values = [ v for v in series['values'] if start <= float(v[0]) <= end ]
+            if (values):
+                trimmed.append({'metric': series['metric'], 'values': values})
+        return trimmed
+
+
+    @classmethod
+    def stitch(cls, segments, start, end):
+        merged = {}
+        metrics = {}
+        for seg in sorted(segments, key=lambda s: s['start']):
+            for series in seg['result']:
+                key = cls._series_key(series['metric'])
+                metrics.setdefault(key, series['metric'])
+                samples = merged.setdefault(key, {})
+                for v in series['values']:
+                    if (start <= float(v[0]) <= end):
+                        samples[float(v[0])] = v
+
+        result = [ {'metric': metrics[key], 'values': [ samples[ts] for ts in sorted(samples) ]}
+                   for (key, samples) in merged.items() if samples ]
+
+        return {'resultType': 'matrix', 'result': result}
+
+
+    def query_range(self, url, query, start, end, step, fetch):
+        # start and end are unix timestamps, step is in seconds. fetch(start, end) must return the 'data'
+        # member of a query_range response for the given (aligned) sub-range.
+        (start, end) = self.align(start, end, step)
+        if (start > end):
+            return {'resultType': 'matrix', 'result': []}
+
+        path = self._key_file(url, query, step)
+        with self._key_lock(path):
+            segments = self._load(path, step)
+
+            fetched = []
+            for (sub_start, sub_end) in self.missing_ranges(segments, start, end, step):
+                data = fetch(sub_start, sub_end)
+                fetched.append({'start': sub_start, 'end': sub_end, 'fetched_at': time.time(),
+                                'result': data.get('result', [])})
+
+            if (fetched):
+                # Only persist what is old enough to be considered final
+                settled = math.floor((time.time() - self.recent_window) / step) * step
+                stored = list(segments)
+                for seg in fetched:
+                    seg_end = min(seg['end'], settled)
+                    if (seg_end < seg['start']):
+                        continue
+                    stored.append({'start': seg['start'], 'end': seg_end, 'fetched_at': seg['fetched_at'],
+                                   'result': self._trim(seg['result'], seg_end)})
+                self._save(path, self._consolidate(stored, step))
+
+        return self.stitch(segments + fetched, start, end)
+
+
+    def clear(self):
+        for item in self.cache_path.glob('*.pkl'):
+            item.unlink()
+        return
+
+
+class FrameCache:
+    # In-memory LRU of derived (results, DataFrame) pairs, bounded by their approximate size in bytes. Keys
+    # are (query, start, end, step, deltas). Windows reaching into RangeQueryCache.recent_window may yet
+    # gain samples, so their entries expire after recent_ttl seconds; older windows are final.
+    def __init__(self, max_bytes, recent_ttl=15):
+        self.max_bytes = max_bytes
+        self.recent_ttl = recent_ttl
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+
+    @staticmethod
+    def _results_nbytes(results):
+        # Estimated from the first sample of each series, rather than walking every sample
+        nbytes = sys.getsizeof(results['result'])
+        for series in results['result']:
+            values = series['values']
+            nbytes += sys.getsizeof(series) + sys.getsizeof(values)
+            if (values):
+                nbytes += len(values) * (sys.getsizeof(values[0]) + sum(sys.getsizeof(v) for v in values[0]))
+        return nbytes
+
+
+    @classmethod
+    def nbytes(cls, value):
+        (results, df) = value
+        return int(df.memory_usage(index=True, deep=True).sum()) + cls._results_nbytes(results)
+
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None and entry['expires'] is not None and time.time() > entry['expires']):
+                self._remove(key)
+                entry = None
+
+            if (entry is None):
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry['value']
+
+
+    def put(self, key, value, end):
+        # end is the window's end, as a unix timestamp
+        nbytes = self.nbytes(value)
+        if (nbytes > self.max_bytes):
+            return
+
+        now = time.time()
+        expires = (now + self.recent_ttl) if (end > now - RangeQueryCache.recent_window) else None
+        with self._lock:
+            if (key in self._entries):
+                self._remove(key)
+            self._entries[key] = {'value': value, 'nbytes': nbytes, 'expires': expires}
+            self._bytes += nbytes
+
+            while (self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+        return
+
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry['nbytes']
+        return
+
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'evictions': self._evictions,
+                    'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        return
+
+
+class RollupCache:
+    # Range query results pre-aggregated into tiers of fixed resolution, so that long windows at coarse steps
+    # can be answered locally. Each tier holds, per series, the min, max, sum, count and last sample of every
+    # (t - resolution, t] bucket, along with the bucket ends it has complete data for. Tiers are (resolution,
+    # retention, max_bytes), in seconds and bytes on disk; each resolution must be a multiple of the one 
+    # before. Buckets older than a tier's retention are dropped, and the least recently used queries evicted
+    # to keep it within max_bytes.
+    #
+    # Tiers are fed from results at steps dividing their resolution, no coarser than the finest tier's, so
+    # the aggregates are over the samples at that step.
+    default_tiers = ((60, 7 * 86400, 256 << 20), (300, 35 * 86400, 256 << 20), (3600, 400 * 86400, 256 << 20))
+    aggregations = ('min', 'max', 'avg', 'last')
+
+    def __init__(self, cache_path, tiers=default_tiers):
+        self.cache_path = Path(cache_path)
+        self.tiers = sorted( (float(resolution), retention, max_bytes) for (resolution, retention, max_bytes) in tiers )
+        if (not self.tiers):
+            raise ValueError('At least one rollup tier is required')
+        for (finer, coarser) in zip(self.tiers, self.tiers[1:]):
+            if (not self._divides(finer[0], coarser[0])):
+                raise ValueError('Rollup tier resolutions must be multiples of each other')
+
+        for (resolution, _, _) in self.tiers:
+            self._tier_path(resolution).mkdir(parents=True, exist_ok=True)
+
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+
+    @staticmethod
+    def _divides(step, resolution):
+        n = resolution / step
+        return (n >= 1) and abs(n - round(n)) < 1e-9
+
+
+    def _tier_path(self, resolution):
+        return self.cache_path / 'rollup_{:g}s'.format(resolution)
+
+
+    def _key_file(self, resolution, url, query):
+        key = '{}\n{}'.format(url, query).encode('UTF-8')
+        return self._tier_path(resolution) / '{}.pkl'.format(hashlib.sha256(key).hexdigest())
+
+
+    def _key_lock(self, path):
+        with self._locks_lock:
+            return self._locks.setdefault(path, threading.Lock())
+
+
+    def _load(self, path):
+        # {'coverage': [{'start', 'end'}, ...] of complete bucket ends, 'series': {key: (metric, buckets)}}
+        empty = {'coverage': [], 'series': {}}
+        if (not path.exists()):
+            return empty
+
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return empty
+        return data
+
+
+    def _save(self, path, data, resolution, retention, max_bytes):
+        import numpy as np
+
+        if (retention):
+            cutoff = math.floor((time.time() - retention) / resolution) * resolution
+            data['coverage'] = [ {'start': max(seg['start'], cutoff + resolution), 'end': seg['end']}
+                                 for seg in data['coverage'] if seg['end'] > cutoff ]
+            for (key, (metric, buckets)) in list(data['series'].items()):
+                keep = buckets['t'] > cutoff
+                if (not np.any(keep)):
+                    del data['series'][key]
+                elif (not np.all(keep)):
+                    data['series'][key] = (metric, { name: column[keep] for (name, column) in buckets.items() })
+
+        tmp = path.with_suffix('.{}.tmp'.format(threading.get_ident()))
+        with open(tmp, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+        # Evict the least recently used queries, which may include this one if it alone is too large
+        files = []
+        for item in self._tier_path(resolution).glob('*.pkl'):
+            try:
+                stat = item.stat()
+            except OSError:
+                continue
+            files.append( (stat.st_mtime, stat.st_size, item) )
+        total = sum(size for (_, size, _) in files)
+        for (_, size, item) in sorted(files, key=lambda f: f[0]):
+            if (total <= max_bytes):
+                break
+            item.unlink(missing_ok=True)
+            total -= size
+        return
+
+
+    @staticmethod
+    def rollup(result, resolution, first, last):
+        # The (t - resolution, t] buckets of each series in a matrix result, for bucket ends first to last
+        import numpy as np
+
+        rolled = {}
+        for series in result:
+            if (not series['values']):
+                continue
+            (timestamps, values) = zip(*series['values'])
+            timestamps = np.array(timestamps, dtype=np.float64)
+            values = np.array(values, dtype=np.float64)
+
+            ends = np.ceil(timestamps / resolution) * resolution
+            keep = (ends >= first) & (ends <= last)
+            if (not np.any(keep)):
+                continue
+            (timestamps, values, ends) = (timestamps[keep], values[keep], ends[keep])
+
+            (t, starts) = np.unique(ends, return_index=True)
+            stops = np.append(starts[1:], len(ends)) - 1
+            rolled[RangeQueryCache._series_key(series['metric'])] = (series['metric'], {
+                't': t, 'min': np.minimum.reduceat(values, starts), 'max': np.maximum.reduceat(values, starts),
+                'sum': np.add.reduceat(values, starts), 'count': (stops - starts + 1).astype(np.float64),
+                'last': values[stops], 'last_ts': timestamps[stops]})
+        return rolled
+
+
+    @staticmethod
+    def _merge(data, rolled, resolution, first, last):
+        # Replace the buckets first to last with the newly rolled ones, and mark them complete
+        import numpy as np
+
+        for key in list(data['series']) + [ key for key in rolled if key not in data['series'] ]:
+            pieces = []
+            metric = None
+            if (key in data['series']):
+                (metric, buckets) = data['series'][key]
+                outside = (buckets['t'] < first) | (buckets['t'] > last)
+                pieces.append( { name: column[outside] for (name, column) in buckets.items() } )
+            if (key in rolled):
+                (metric, buckets) = rolled[key]
+                pieces.append(buckets)
+
+            merged = { name: np.concatenate([ piece[name] for piece in pieces ]) for name in pieces[0] }
+            order = np.argsort(merged['t'], kind='stable')
+            if (len(order)):
+                data['series'][key] = (metric, { name: column[order] for (name, column) in merged.items() })
+            else:
+                del data['series'][key]
+
+        coverage = []
+        for seg in sorted(data['coverage'] + [{'start': first, 'end': last}], key=lambda s: s['start']):
+            if (coverage and seg['start'] <= coverage[-1]['end'] + resolution):
+                coverage[-1]['end'] = max(coverage[-1]['end'], seg['end'])
+            else:
+                coverage.append(dict(seg))
+        data['coverage'] = coverage
+        return data
+
+
+    @staticmethod
+    def _reduce(data, step, start, end, agg):
+        # Combines the buckets of each (t - step, t] window, for t from start to end
+        import numpy as np
+
+        result = []
+        for (metric, buckets) in data['series'].values():
+            groups = np.ceil(buckets['t'] / step) * step
+            keep = (groups >= start) & (groups <= end)
+            if (not np.any(keep)):
+                continue
+            buckets = { name: column[keep] for (name, column) in buckets.items() }
+            groups = groups[keep]
+
+            (t, starts) = np.unique(groups, return_index=True)
+            stops = np.append(starts[1:], len(groups)) - 1
+            if (agg == 'min'):
+                values = np.minimum.reduceat(buckets['min'], starts)
+            elif (agg == 'max'):
+                values = np.maximum.reduceat(buckets['max'], starts)
+            elif (agg == 'avg'):
+                values = np.add.reduceat(buckets['sum'], starts) / np.add.reduceat(buckets['count'], starts)
+            else:
+                # Only where there is a sample at t itself
+                values = buckets['last'][stops]
+                present = buckets['last_ts'][stops] == t
+                (t, values) = (t[present], values[present])
+
+            if (len(t)):
+                result.append( {'metric': metric, 'values': [ [int(ts) if (ts.is_integer()) else ts, format_value(v)]
+                                                              for (ts, v) in zip(t.tolist(), values.tolist()) ]} )
+        return result
+
+
+    def ingest(self, url, query, results, start, end, step):
+        # Adds a query_range result for the window start to end (on the step grid) to the tiers it can feed.
+        # Only buckets which the window covers completely, and which are older than RangeQueryCache's 
+        # recent_window, are stored.
+        if (step > self.tiers[0][0] or abs(start / step - round(start / step)) > 1e-9):
+            return
+
+        settled = time.time() - RangeQueryCache.recent_window
+        for (resolution, retention, max_bytes) in self.tiers:
+            if (not self._divides(step, resolution)):
+                continue
+            first = math.ceil((start + resolution - step) / resolution) * resolution
+            last  = math.floor(min(end, settled) / resolution) * resolution
+            if (first > last):
+                continue
+
+            rolled = self.rollup(results.get('result', []), resolution, first, last)
+            path = self._key_file(resolution, url, query)
+            with self._key_lock(path):
+                data = self._merge(self._load(path), rolled, resolution, first, last)
+                self._save(path, data, resolution, retention, max_bytes)
+        return
+
+
+    def query(self, url, query, start, end, step, agg='last', fetch=None):
+        # The agg of each (t - step, t] window from start to end, as a matrix result, from the coarsest tier
+        # whose resolution divides step. 'last' is the value at t, as a range query at this step would return
+        # it. Returns None if no tier fits, or if the tier is missing some of the window and no fetch is given.
+        # fetch(start, end, step) is called for what is missing, at the finest tier's resolution, and must 
+        # return the 'data' member of a query_range response.
+        if (agg not in self.aggregations):
+            raise ValueError("Unknown aggregation '{}'".format(agg))
+
+        tiers = [ tier for tier in self.tiers if self._divides(tier[0], step) ]
+        if (not tiers):
+            return None
+        resolution = tiers[-1][0]
+
+        (start, end) = RangeQueryCache.align(start, end, step)
+        if (start > end):
+            return {'resultType': 'matrix', 'result': []}
+
+        path = self._key_file(resolution, url, query)
+        with self._key_lock(path):
+            data = self._load(path)
+
+        missing = RangeQueryCache.missing_ranges(data['coverage'], start - step + resolution, end, resolution)
+        with self._locks_lock:
+            if (missing):
+                self._misses += 1
+            else:
+                self._hits += 1
+
+        if (missing):
+            if (fetch is None):
+                return None
+
+            base = self.tiers[0][0]
+            for (first, last) in missing:
+                fetch_start = first - resolution + base
+                results = fetch(fetch_start, last, base)
+                self.ingest(url, query, results, fetch_start, last, base)
+                # Recent buckets aren't stored, so the fetched ones are merged in for this answer regardless
+                data = self._merge(data, self.rollup(results.get('result', []), resolution, first, last), resolution, first, last)
+
+        return {'resultType': 'matrix', 'result': self._reduce(data, step, start, end, agg)}
+
+
+    def stats(self):
+        tiers = []
+        for (resolution, retention, max_bytes) in self.tiers:
+            sizes = [ item.stat().st_size for item in self._tier_path(resolution).glob('*.pkl') ]
+            tiers.append( {'resolution': resolution, 'retention': retention, 'max_bytes': max_bytes,
+                           'queries': len(sizes), 'bytes': sum(sizes)} )
+        with self._locks_lock:
+            return {'hits': self._hits, 'misses': self._misses, 'tiers': tiers}
+
+
+    def clear(self):
+        for (resolution, _, _) in self.tiers:
+            for item in self._tier_path(resolution).glob('*.pkl'):
+                item.unlink()
+        return
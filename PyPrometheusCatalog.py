@@ -0,0 +1,115 @@
+import os
+import re
+import json
+import time
+import bisect
+import threading
+from pathlib import Path
+
+
+class MetricCatalog:
+    # The server's metric names, held as a set for exact lookups and a sorted list for prefix lookups.
+    # Names come from loader() and may be persisted to path, in which case they're reused until ttl expires.
+    # A stale catalog is refreshed the next time it is used.
+    def __init__(self, loader, path=None, ttl=3600):
+        self._loader = loader
+        self.path = Path(path) if (path) else None
+        self.ttl = ttl
+
+        self._names = None
+        self._sorted = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+
+    def _set(self, names, loaded_at):
+        self._sorted = sorted(set(names))
+        self._names = frozenset(self._sorted)
+        self._loaded_at = loaded_at
+        return
+
+
+    def _is_stale(self):
+        return (self._loaded_at is None) or (self.ttl is not None and (time.time() - self._loaded_at) > self.ttl)
+
+
+    def _load_persisted(self):
+        if (not self.path or not self.path.exists()):
+            return False
+
+        try:
+            with open(self.path, 'r') as f:
+                content = json.loads(f.read())
+        except (OSError, ValueError):
+            return False
+
+        if (self.ttl is not None and (time.time() - content['loaded_at']) > self.ttl):
+            return False
+
+        self._set(content['names'], content['loaded_at'])
+        return True
+
+
+    def _persist(self):
+        if (not self.path):
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.{}.tmp'.format(threading.get_ident()))
+        with open(tmp, 'w') as f:
+            f.write(json.dumps({'loaded_at': self._loaded_at, 'names': self._sorted}))
+        os.replace(tmp, self.path)
+        return
+
+
+    def refresh(self, force=False):
+        with self._lock:
+            if (not force and not self._is_stale()):
+                return
+            if (not force and self._names is None and self._load_persisted()):
+                return
+
+            self._set(self._loader(), time.time())
+            self._persist()
+        return
+
+
+    @property
+    def names(self):
+        if (self._is_stale()):
+            self.refresh()
+        return self._sorted
+
+
+    def __contains__(self, metric):
+        if (self._is_stale()):
+            self.refresh()
+        return metric in self._names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def prefix(self, prefix):
+        names = self.names
+        start = bisect.bisect_left(names, prefix)
+        end = start
+        while (end < len(names) and names[end].startswith(prefix)):
+            end += 1
+        return names[start:end]
+
+
+    def regex(self, pattern):
+        pattern = re.compile(pattern) if (isinstance(pattern, str)) else pattern
+        return [ name for name in self.names if pattern.fullmatch(name) ]
+
+
+    def containing(self, targets):
+        # Names containing any of the targets, in a single pass over the catalog
+        if (not targets):
+            return []
+        pattern = re.compile('|'.join(re.escape(target) for target in targets))
+        return [ name for name in self.names if pattern.search(name) ]
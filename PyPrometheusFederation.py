@@ -0,0 +1,142 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from PyPrometheusQueryClient import PrometheusQueryClient
+from PyPrometheusCache import RangeQueryCache
+
+
+class FederatedQueryClient:
+    # Fans queries out to several Prometheus servers in parallel and merges their results, labelling each
+    # series with the endpoint it came from. endpoints is a list of URLs, or a dict of name: URL. A name may
+    # map to a list of URLs, which are treated as an HA group: replicas scraping the same targets, whose
+    # series are merged (filling each other's gaps) after dropping any replica_labels.
+    #
+    # timeout, in seconds, applies to each request and bounds how long a call waits for each endpoint. It
+    # may be a dict of name: timeout. Endpoints with a timeout aren't retried, so their requests stay within
+    # it. An endpoint which fails or times out is reported in the result's 'errors', by URL, rather than 
+    # failing the call, unless every endpoint does. Other keyword arguments are passed to each endpoint's
+    # PrometheusQueryClient. max_workers bounds the calls each endpoint runs at once.
+    def __init__(self, endpoints, source_label='source', replica_labels=(), timeout=None, max_workers=None, **client_options):
+        if (isinstance(endpoints, dict)):
+            groups = { name: [urls] if (isinstance(urls, str)) else list(urls) for (name, urls) in endpoints.items() }
+        else:
+            groups = { url: [url] for url in endpoints }
+        if (not groups):
+            raise ValueError('At least one endpoint is required')
+
+        self.source_label = source_label
+        self.replica_labels = frozenset(replica_labels)
+        self.timeouts = { name: (timeout.get(name) if (isinstance(timeout, dict)) else timeout) for name in groups }
+
+        client_options.setdefault('auto_get_server_metrics', False)
+        def client(name, url):
+            options = dict(client_options)
+            if (self.timeouts[name] is not None):
+                options['retries'] = 0
+            return PrometheusQueryClient(url, timeout=self.timeouts[name], **options)
+        self.clients = { name: [ client(name, url) for url in urls ] for (name, urls) in groups.items() }
+
+        # Each endpoint has its own pool, so that calls left to finish in the background after timing out
+        # only hold up that endpoint. The pools aren't shut down between calls for the same reason.
+        self._executors = { id(client): ThreadPoolExecutor(max_workers=max_workers or 4)
+                            for clients in self.clients.values() for client in clients }
+
+
+    def _fan_out(self, func):
+        # Runs func(client) against every endpoint. Returns the results of each group, in replica order, and
+        # the errors by URL.
+        submitted = time.monotonic()
+        futures = { name: [ (client, self._executors[id(client)].submit(func, client)) for client in clients ]
+                    for (name, clients) in self.clients.items() }
+
+        results = {}
+        errors = {}
+        for (name, replicas) in futures.items():
+            timeout = self.timeouts[name]
+            for (client, future) in replicas:
+                try:
+                    remaining = None if (timeout is None) else max(timeout - (time.monotonic() - submitted), 0)
+                    result = future.result(timeout=remaining)
+                except TimeoutError:
+                    errors[client.url] = TimeoutError("No response from '{}' within {}s".format(client.url, timeout))
+                except Exception as e:
+                    errors[client.url] = e
+                else:
+                    results.setdefault(name, []).append(result)
+
+        if (not results):
+            raise RuntimeError('All endpoints failed: {}'.format('; '.join('{}: {}'.format(url, e) for (url, e) in errors.items())))
+
+        return (results, errors)
+
+
+    def _merge(self, results):
+        # One series per (source, labels), with an HA group's replicas merged sample by sample
+        merged = []
+        for (name, replicas) in results.items():
+            segments = [ {'start': -i, 'result': [ {'metric': { k: v for (k, v) in series['metric'].items() if k not in self.replica_labels },
+                                                   'values': series['values']} for series in replica['result'] ]}
+                         for (i, replica) in enumerate(replicas) ]
+            if (len(segments) > 1):
+                # Later segments win where replicas share a timestamp, so the first replica is ordered last
+                result = RangeQueryCache.stitch(segments, float('-inf'), float('inf'))['result']
+            else:
+                result = segments[0]['result']
+
+            for series in result:
+                merged.append( {'metric': dict(series['metric'], **{self.source_label: name}), 'values': series['values']} )
+
+        return merged
+
+
+    def query_range(self, query, start, end, step, timeout=None):
+        (results, errors) = self._fan_out(lambda client: client.query_range(query, start, end, step, timeout=timeout))
+        return {'resultType': 'matrix', 'result': self._merge(results), 'errors': errors}
+
+
+    def has_metric(self, metric):
+        # Known to any endpoint we can reach. Raises, as the queries do, if we can't reach any.
+        (results, _) = self._fan_out(lambda client: client.has_metric(metric))
+        return any(any(replicas) for replicas in results.values())
+
+
+    def get_general(self, query, start=None, end=None, step=None):
+        (start, end, step) = PrometheusQueryClient._resolve_window(start, end, step)
+        return self.query_range(query, start, end, step)
+
+
+    def get_without_deltas(self, query, start=None, end=None, step=None):
+        # Columns are named '__name__ - source, instance'
+        results = self.get_general(query, start, end, step)
+        df = PrometheusQueryClient._result_to_frame(results, labels=[self.source_label, 'instance'])
+        return (results, df)
+
+
+    def get_with_deltas(self, query, start=None, end=None, step=None, counter=False, rate=False):
+        (results, df) = self.get_without_deltas(query, start, end, step)
+        df = PrometheusQueryClient._compute_deltas(df, counter=counter, rate=rate)
+        return (results, df)
+
+
+    def get_metric(self, metric, start=None, end=None, step=None):
+        if (not self.has_metric(metric)):
+            raise ValueError("Metric '{}' is unknown".format(metric))
+
+        if (PrometheusQueryClient._is_cumulative(metric)):
+            return self.get_with_deltas(metric, start, end, step, counter=True)
+        return self.get_without_deltas(metric, start, end, step)
+
+
+    def close(self):
+        for clients in self.clients.values():
+            for client in clients:
+                client.close()
+        for executor in self._executors.values():
+            executor.shutdown(wait=False)
+        return
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,282 @@
+import time
+import heapq
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+# The call being recorded on each thread, if any. Module level so that the static helpers (frame building,
+# delta computation) and the HTTP connection classes can add to it without being handed it.
+_active = threading.local()
+
+
+class CallRecord:
+    # Timings for one top-level call. Phases are:
+    #   connect    DNS lookup, TCP connect and TLS handshake of new connections
+    #   server     from sending a request to receiving the response headers, less any connect time
+    #   transfer   reading the response body
+    #   decode     JSON decoding
+    #   dataframe  building DataFrames (or compact arrays) from the decoded series
+    #   deltas     delta and rate computation
+    # Sharded queries run their requests concurrently, so phase totals can exceed the call's duration.
+    def __init__(self, name, query=None):
+        self.name = name
+        self.query = query
+        self.started = time.time()
+        self.duration = None
+        self.error = None
+        self.phases = {}
+        self.requests = 0
+        self.bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._lock = threading.Lock()
+
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        return
+
+
+    def add_request(self, nbytes):
+        with self._lock:
+            self.requests += 1
+            self.bytes += nbytes
+        return
+
+
+    def add_cache(self, hit):
+        with self._lock:
+            if (hit):
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+        return
+
+
+    def to_dict(self):
+        return {'name': self.name, 'query': self.query, 'started': self.started, 'duration': self.duration,
+                'error': self.error, 'phases': dict(self.phases), 'requests': self.requests, 'bytes': self.bytes,
+                'cache_hits': self.cache_hits, 'cache_misses': self.cache_misses}
+
+
+class Instrumentation:
+    # Collects a CallRecord for each top-level client call. The last max_records are kept for summary(),
+    # while the totals exported by to_prometheus() cover every call. Each listener is called with the
+    # CallRecord as its call completes, e.g. to log slow queries.
+    metric_prefix = 'pyprometheus_client'
+
+    def __init__(self, max_records=1000, listeners=None):
+        self.records = deque(maxlen=max_records)
+        self.listeners = list(listeners or [])
+
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._errors = 0
+        self._phases = {}
+        self._requests = 0
+        self._bytes = 0
+        self._cache = {'hit': 0, 'miss': 0}
+
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+        return
+
+
+    @contextmanager
+    def call(self, name, query=None):
+        # Calls made from within another call (e.g. get_metric() -> query_range()) add to the outer record
+        outer = current()
+        if (outer is not None):
+            yield outer
+            return
+
+        record = CallRecord(name, query)
+        _active.record = record
+        t0 = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record.error = '{}: {}'.format(type(e).__name__, e)
+            raise
+        finally:
+            record.duration = time.perf_counter() - t0
+            _active.record = None
+            self._finish(record)
+
+
+    def _finish(self, record):
+        with self._lock:
+            self.records.append(record)
+            (count, total) = self._calls.get(record.name, (0, 0.0))
+            self._calls[record.name] = (count + 1, total + record.duration)
+            self._errors += 1 if (record.error) else 0
+            for (phase, seconds) in record.phases.items():
+                (count, total) = self._phases.get(phase, (0, 0.0))
+                self._phases[phase] = (count + 1, total + seconds)
+            self._requests += record.requests
+            self._bytes += record.bytes
+            self._cache['hit'] += record.cache_hits
+            self._cache['miss'] += record.cache_misses
+
+        for listener in self.listeners:
+            listener(record)
+        return
+
+
+    def summary(self, slowest=10):
+        # Aggregates over the retained records, with the slowest of them in full
+        with self._lock:
+            records = list(self.records)
+
+        phases = {}
+        for record in records:
+            for (phase, seconds) in record.phases.items():
+                stats = phases.setdefault(phase, {'count': 0, 'total': 0.0, 'max': 0.0})
+                stats['count'] += 1
+                stats['total'] += seconds
+                stats['max'] = max(stats['max'], seconds)
+        for stats in phases.values():
+            stats['mean'] = stats['total'] / stats['count']
+
+        durations = [ record.duration for record in records ]
+        return {'calls': len(records),
+                'errors': sum(1 for record in records if record.error),
+                'duration': {'total': sum(durations), 'mean': (sum(durations) / len(durations)) if (durations) else 0.0,
+                             'max': max(durations, default=0.0)},
+                'phases': phases,
+                'requests': sum(record.requests for record in records),
+                'bytes': sum(record.bytes for record in records),
+                'cache': {'hits': sum(record.cache_hits for record in records), 'misses': sum(record.cache_misses for record in records)},
+                'slowest': [ record.to_dict() for record in heapq.nlargest(slowest, records, key=lambda record: record.duration) ]}
+
+
+    def to_prometheus(self):
+        # The client's own metrics, in the Prometheus text exposition format (e.g. for the node_exporter
+        # textfile collector, or to serve from an application's /metrics endpoint)
+        prefix = self.metric_prefix
+        with self._lock:
+            calls = sorted(self._calls.items())
+            phases = sorted(self._phases.items())
+            lines = [ '# HELP {}_call_duration_seconds Duration of client calls.'.format(prefix),
+                      '# TYPE {}_call_duration_seconds summary'.format(prefix) ]
+            for (name, (count, total)) in calls:
+                lines.append('{}_call_duration_seconds_sum{{call="{}"}} {!r}'.format(prefix, name, total))
+                lines.append('{}_call_duration_seconds_count{{call="{}"}} {}'.format(prefix, name, count))
+
+            lines += [ '# HELP {}_phase_duration_seconds Time spent in each phase of client calls.'.format(prefix),
+                       '# TYPE {}_phase_duration_seconds summary'.format(prefix) ]
+            for (phase, (count, total)) in phases:
+                lines.append('{}_phase_duration_seconds_sum{{phase="{}"}} {!r}'.format(prefix, phase, total))
+                lines.append('{}_phase_duration_seconds_count{{phase="{}"}} {}'.format(prefix, phase, count))
+
+            lines += [ '# HELP {}_call_errors_total Client calls which raised.'.format(prefix),
+                       '# TYPE {}_call_errors_total counter'.format(prefix),
+                       '{}_call_errors_total {}'.format(prefix, self._errors),
+                       '# HELP {}_requests_total HTTP requests made to the server.'.format(prefix),
+                       '# TYPE {}_requests_total counter'.format(prefix),
+                       '{}_requests_total {}'.format(prefix, self._requests),
+                       '# HELP {}_response_bytes_total Response bytes received from the server.'.format(prefix),
+                       '# TYPE {}_response_bytes_total counter'.format(prefix),
+                       '{}_response_bytes_total {}'.format(prefix, self._bytes),
+                       '# HELP {}_cache_lookups_total Range cache lookups, by whether they were answered without the server.'.format(prefix),
+                       '# TYPE {}_cache_lookups_total counter'.format(prefix),
+                       '{}_cache_lookups_total{{result="hit"}} {}'.format(prefix, self._cache['hit']),
+                       '{}_cache_lookups_total{{result="miss"}} {}'.format(prefix, self._cache['miss']) ]
+        return '\n'.join(lines) + '\n'
+
+
+
+def current():
+    return getattr(_active, 'record', None)
+
+
+@contextmanager
+def activate(record):
+    # Makes record the current one on this thread, e.g. on the worker threads of a sharded query
+    previous = current()
+    _active.record = record
+    try:
+        yield record
+    finally:
+        _active.record = previous
+
+
+@contextmanager
+def phase(name):
+    record = current()
+    if (record is None):
+        yield
+        return
+
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.add(name, time.perf_counter() - t0)
+
+
+def record_cache(hit):
+    record = current()
+    if (record is not None):
+        record.add_cache(hit)
+    return
+
+
+def timed_request(send, stream=False):
+    # Runs send(), a requests GET or POST, splitting its time into connect, server and transfer. requests'
+    # resp.elapsed runs until the headers are parsed, and the body is read after that unless streaming.
+    record = current()
+    if (record is None):
+        return send()
+
+    _active.connect = 0.0
+    t0 = time.perf_counter()
+    resp = send()
+    total = time.perf_counter() - t0
+
+    connect = _active.connect
+    waited = resp.elapsed.total_seconds()
+    if (connect):
+        record.add('connect', connect)
+    record.add('server', max(waited - connect, 0.0))
+    if (not stream):
+        record.add('transfer', max(total - waited, 0.0))
+
+    # Bytes as received, i.e. before any decompression
+    nbytes = 0
+    if (not stream):
+        nbytes = getattr(resp.raw, 'tell', lambda: 0)() or len(resp.content)
+    record.add_request(nbytes)
+    return resp
+
+
+_pool_classes = None
+
+def timed_pool_classes():
+    # urllib3 connection pools whose connections report their connect time to timed_request()
+    global _pool_classes
+    if (_pool_classes is None):
+        from urllib3.connection import HTTPConnection, HTTPSConnection
+        from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+        def timed_connect(connection_cls):
+            class TimedConnection(connection_cls):
+                def connect(self):
+                    t0 = time.perf_counter()
+                    try:
+                        return super().connect()
+                    finally:
+                        _active.connect = getattr(_active, 'connect', 0.0) + time.perf_counter() - t0
+            return TimedConnection
+
+        class TimedHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = timed_connect(HTTPConnection)
+
+        class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = timed_connect(HTTPSConnection)
+
+        _pool_classes = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+    return _pool_classes
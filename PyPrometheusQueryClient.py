@@ -1,67 +1,226 @@
-from unittest import result
-import requests
+import re
+import threading
+import contextlib
 from urllib.parse import urljoin
-from datetime import datetime, timedelta
-import pandas as pd
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor, Future
+from datetime import datetime, timedelta, timezone
 import json
+import codecs
+import hashlib
 #import statsmodels.api as sm
 #import statsmodels.formula.api as smf
-from PyBlakemere.PyMemoize.MemoizationDecorator import memoize
-from PyBlakemere.PyMemoize.CacheBackendDisk import DiskCacheBackend
 from pathlib import Path
+from PyPrometheusCache import RangeQueryCache, FrameCache, RollupCache
+from PyPrometheusCatalog import MetricCatalog
+import PyPrometheusInstrumentation as instrumentation
 
 
 
 class PrometheusQueryClient:
-    def __init__(self, url, cache_path=None, cache_encrypt_at_rest=False, cache_ttl=3600, ssl_verify=True, auto_get_server_metrics=True):
+    # Responses which are worth retrying, with backoff, rather than failing the query outright
+    retry_status_codes = (429, 500, 502, 503, 504)
+
+    # Prometheus refuses range queries which would return more than 11,000 points per series
+    max_points_per_query = 11000
+
+    # Upper bound on the number of metric names combined into one selector (see _name_selector()), to keep the 
+    # query URL reasonable
+    max_metrics_per_selector = 50
+
+    def __init__(self, url, cache_path=None, cache_encrypt_at_rest=False, cache_ttl=3600, cache_retention=None, ssl_verify=True, auto_get_server_metrics=True,
+                 pool_size=10, timeout=None, retries=3, backoff_factor=0.5, shard_workers=4, catalog_ttl=3600, instrumentation=None,
+                 frame_cache_bytes=0, column_labels=None, max_series=None, rollup_tiers=None):
         self.url = url
         self.ssl_verify = ssl_verify
-        self.metrics = None
-
-        # Dynamically generate the _do_query_cache function, with or without caching. 
-        if(cache_path and False):
-            @memoize(DiskCacheBackend(cache_path, encrypt_at_rest=cache_encrypt_at_rest), maxttl=cache_ttl, is_class_method=True)
-            def query_function(self, path, params):
-                return self.__do_query_direct(self, path, params)
-        else:
-            def query_function(self, path, params):
-                return self.__do_query_direct(self, path, params)
-        setattr(self, '__query_function', query_function)
+        self.timeout = timeout
+        self.shard_workers = shard_workers
+
+        # Given a PyPrometheusInstrumentation.Instrumentation, each call records a breakdown of where its time went
+        self.instrumentation = instrumentation
+
+        # Defaults for the get_* methods: the labels which name frame columns (after __name__), and the most
+        # series a query may return, checked with a count() query before the range is fetched
+        self.column_labels = column_labels
+        self.max_series = max_series
+
+        # All requests go through one pooled session, so connections (and their TLS handshakes) are reused.
+        # It is built on first use, which also defers importing requests.
+        self._session = None
+        self._session_options = (pool_size, retries, backoff_factor)
+        self._retry_count = 0
+        self._stats_lock = threading.Lock()
+
+        # Identical range queries already in flight, which later callers wait on rather than repeat
+        self._inflight = {}
+        self._coalesced_count = 0
+
+        # Range query results are cached on disk, keyed on (query, step), so that overlapping windows only
+        # fetch the sub-ranges we don't already hold.
+        self._cache = None
+        if (cache_path):
+            if (cache_encrypt_at_rest):
+                raise ValueError('Encryption at rest is not supported by the range query cache')
+            self._cache = RangeQueryCache(cache_path, ttl=cache_ttl, retention=cache_retention)
+
+        # Rollup tiers, kept beside the range cache, answer coarse-step queries over long windows locally. Each
+        # tier is (resolution, retention seconds, max bytes), e.g. RollupCache.default_tiers.
+        self._rollups = None
+        if (rollup_tiers):
+            if (not cache_path):
+                raise ValueError('Rollup tiers require a cache_path')
+            tiers = [ (PrometheusQueryClient._step_to_seconds(str(resolution)), retention, max_bytes)
+                      for (resolution, retention, max_bytes) in rollup_tiers ]
+            self._rollups = RollupCache(Path(cache_path) / 'rollups', tiers=tiers)
+
+        # Frames built by get_with_deltas() and get_without_deltas() are also held in memory, up to 
+        # frame_cache_bytes, so that repeats of a query and window don't rebuild them
+        self._frame_cache = FrameCache(frame_cache_bytes) if (frame_cache_bytes) else None
+
+        # The metric name catalog is persisted alongside the cache, if there is one, so that a fresh client 
+        # doesn't need to download it again until it expires. Without auto_get_server_metrics, it is loaded 
+        # on first use.
+        catalog_path = None
+        if (cache_path):
+            catalog_path = Path(cache_path) / 'metric_catalog_{}.json'.format(hashlib.sha256(url.encode('UTF-8')).hexdigest()[:16])
+        self._catalog = MetricCatalog(self._fetch_metric_names, path=catalog_path, ttl=catalog_ttl)
+        self.metrics = self._catalog
 
         if(auto_get_server_metrics):
             self._get_all_metrics()
 
 
+    def _build_session(self, pool_size, retries, backoff_factor):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=self.retry_status_codes,
+                      allowed_methods=frozenset(['GET', 'POST']), respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        if (self.instrumentation):
+            adapter.poolmanager.pool_classes_by_scheme = instrumentation.timed_pool_classes()
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        session.verify = self.ssl_verify
+        return session
+
+
+    def _get_session(self):
+        if (self._session is None):
+            with self._stats_lock:
+                if (self._session is None):
+                    self._session = self._build_session(*self._session_options)
+        return self._session
+
+
+    def _get(self, url, params=None, stream=False):
+        session = self._get_session()
+        resp = instrumentation.timed_request(lambda: session.get(url, params=params, timeout=self.timeout, stream=stream), stream=stream)
+
+        history = getattr(getattr(resp.raw, 'retries', None), 'history', None)
+        if (history):
+            with self._stats_lock:
+                self._retry_count += len(history)
+
+        return resp
+
+
+    def _post(self, url, data, headers=None, stream=False):
+        # Only remote read is POSTed, which is as safe to retry as a GET
+        session = self._get_session()
+        resp = instrumentation.timed_request(lambda: session.post(url, data=data, headers=headers, timeout=self.timeout, stream=stream), stream=stream)
+
+        history = getattr(getattr(resp.raw, 'retries', None), 'history', None)
+        if (history):
+            with self._stats_lock:
+                self._retry_count += len(history)
+
+        return resp
+
+
+    def connection_stats(self):
+        # Aggregate over the session's connection pools. Every request which didn't need a new connection
+        # was served over a kept-alive one.
+        stats = {'requests': 0, 'new_connections': 0, 'reused_connections': 0, 'retries': self._retry_count,
+                 'coalesced': self._coalesced_count}
+        adapters = self._session.adapters.values() if (self._session) else []
+        for adapter in { id(a): a for a in adapters }.values():
+            pools = adapter.poolmanager.pools
+            for pool in [ pools[key] for key in pools.keys() ]:
+                stats['requests']        += pool.num_requests
+                stats['new_connections'] += pool.num_connections
+        stats['reused_connections'] = max(stats['requests'] - stats['new_connections'], 0)
+        return stats
+
+
+    def close(self):
+        if (self._session):
+            self._session.close()
+            self._session = None
+        return
+
+
+    def _instrument(self, name, query=None):
+        # Records a call, and everything it does, if we're instrumented
+        if (self.instrumentation is None):
+            return contextlib.nullcontext()
+        return self.instrumentation.call(name, query)
+
+
+    @staticmethod
+    def _check_status(resp):
+        # Prometheus reports its errors as JSON, which the callers pass on, but a failing proxy or load balancer 
+        # in front of it, e.g. still answering 503 once the retries have run out, doesn't
+        if (resp.status_code >= 400 and 'json' not in resp.headers.get('Content-Type', '')):
+            raise RuntimeError('HTTP {}: {}'.format(resp.status_code, resp.text.strip()[:200]))
+        return resp
+
+
     def __do_query_direct(self, path, params):
-        resp = requests.get(urljoin(self.url, path), params=params, verify=self.ssl_verify)
-        response = resp.json()
+        resp = PrometheusQueryClient._check_status(self._get(urljoin(self.url, path), params=params))
+        with instrumentation.phase('decode'):
+            response = resp.json()
         if response['status'] != 'success':
             raise RuntimeError('{errorType}: {error}'.format_map(response))
         return response['data']
 
     def _do_query(self, path, params):
-        results = self.__query_function(path, params)
+        results = self.__do_query_direct(path, params)
         return results 
 
-    def _get_all_metrics(self):
-        resp = requests.get(self.url + '/api/v1/label/__name__/values', verify=self.ssl_verify)
-        content = json.loads(resp.content.decode('UTF-8'))
+    def _fetch_metric_names(self):
+        resp = PrometheusQueryClient._check_status(self._get(self.url + '/api/v1/label/__name__/values'))
+        with instrumentation.phase('decode'):
+            content = json.loads(resp.content.decode('UTF-8'))
         
         if content['status'] != 'success':
-            raise RuntimeError('{errorType}: {error}'.format(resp.status_code))
-        
-        self.metrics = [ item for item in content.get('data', {}) ]
+            raise RuntimeError('{errorType}: {error}'.format_map(content))
         
+        return content.get('data', [])
+
+
+    def _get_all_metrics(self, force=False):
+        # Loads the catalog from disk if a fresh copy was persisted, otherwise from the server
+        self._catalog.refresh(force=force)
         return
 
 
+    def has_metric(self, metric):
+        # Checks the catalog, fetching it first if it hasn't been loaded yet
+        return metric in self._catalog
+
+
     def get_metrics_starting_with(self, targets):
-        results = []
-        for item in self.metrics:
-            if any(target in item for target in targets):
-                results.append(item)
-        return results
+        return self._catalog.containing(targets)
+
+
+    @staticmethod
+    def _name_selector(metrics):
+        # A selector for every series of any of the metrics
+        return '{{__name__=~"{}"}}'.format('|'.join(metrics))
 
 
     @staticmethod
@@ -69,6 +228,34 @@ class PrometheusQueryClient:
         return t.strftime('%Y-%m-%dT%H:%M:%SZ') if (isinstance(t, datetime)) else t
 
 
+    @staticmethod
+    def _to_timestamp(t):
+        # Accepts datetimes, '%Y-%m-%dT%H:%M:%SZ' strings (as sent to the server, i.e. UTC) and unix timestamps
+        t = PrometheusQueryClient._datetime_to_str(t)
+        try:
+            return float(t)
+        except ValueError:
+            pass
+        dt = datetime.fromisoformat(t.replace('Z', '+00:00'))
+        if (dt.tzinfo is None):
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp()
+
+
+    @staticmethod
+    def _step_to_seconds(step):
+        try:
+            return float(step)
+        except ValueError:
+            pass
+
+        units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800, 'y': 31536000}
+        parts = re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h|d|w|y)', step)
+        if (not parts or ''.join(n + u for (n, u) in parts) != step):
+            raise ValueError("Invalid step '{}'".format(step))
+        return sum(float(n) * units[u] for (n, u) in parts)
+
+
     def query_range(self, query, start, end, step, timeout=None):
         # Make sure our start and end times are as strings rather than 
         start = PrometheusQueryClient._datetime_to_str(start)
@@ -79,81 +266,569 @@ class PrometheusQueryClient:
         if (timeout and not params.get('timeout', False)): # FIXME: This test doesn't work. Always does the update
            params.update({'timeout': timeout})
 
-        # Run the query. 
-        # TODO: Externalize the api string
-        results = self._do_query('api/v1/query_range', params)
+        start_ts = PrometheusQueryClient._to_timestamp(start)
+        end_ts   = PrometheusQueryClient._to_timestamp(end)
+        step_s   = PrometheusQueryClient._step_to_seconds(step)
+
+        # Run the query, via the rollup tiers and range cache if we have them. The range cache aligns the window
+        # to the step grid, as the tiers need.
+        def run():
+            aligned = bool(self._cache) or abs(start_ts / step_s - round(start_ts / step_s)) < 1e-9
+            if (self._rollups and aligned):
+                results = self._rollups.query(self.url, query, start_ts, end_ts, step_s)
+                if (results is not None):
+                    instrumentation.record_cache(hit=True)
+                    return results
+
+            if (self._cache):
+                fetched = []
+                def fetch(sub_start, sub_end):
+                    fetched.append( (sub_start, sub_end) )
+                    return self._query_range_sharded(params, sub_start, sub_end, step_s)
+
+                results = self._cache.query_range(self.url, query, start_ts, end_ts, step_s, fetch)
+                instrumentation.record_cache(hit=not fetched)
+            else:
+                fetched = [ (start_ts, end_ts) ]
+                results = self._query_range_sharded(params, start_ts, end_ts, step_s)
+
+            if (self._rollups and aligned and fetched):
+                self._rollups.ingest(self.url, query, results, *RangeQueryCache.align(start_ts, end_ts, step_s), step_s)
+            return results
+
+        with self._instrument('query_range', query):
+            results = self._single_flight( (query, start_ts, end_ts, step_s, timeout), run )
         
         return results
 
 
-    def get_general(self, query, start=None, end=None, step=None):
+    def _single_flight(self, key, run):
+        # The first caller for a key runs it; callers arriving while it is in flight wait for, and share, its 
+        # result (or exception). The result is shared as-is, so callers must not modify it.
+        with self._stats_lock:
+            future = self._inflight.get(key)
+            leader = (future is None)
+            if (leader):
+                future = self._inflight[key] = Future()
+            else:
+                self._coalesced_count += 1
+
+        if (not leader):
+            return future.result()
+
+        try:
+            results = run()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(results)
+        finally:
+            with self._stats_lock:
+                del self._inflight[key]
+
+        return results
+
+
+    def query(self, query, time=None, timeout=None):
+        # An instant query: the value of each series at time (by default, now), i.e. its latest sample within
+        # the server's lookback window
+        params = {'query': query}
+        if (time is not None):
+            params.update({'time': PrometheusQueryClient._datetime_to_str(time)})
+        if (timeout):
+            params.update({'timeout': timeout})
+
+        with self._instrument('query', query):
+            return self._do_query('api/v1/query', params)
+
+
+    def count_series(self, query, time=None, start=None, step=None):
+        # The number of series the query returns at time (by default, now) or, given a start, at any point from
+        # start to time, which counts those which came and went during the window (e.g. restarted pods) too. 
+        # Series selectors are counted through the series API, other expressions by a subquery over the window
+        # at step (by default, a minute).
+        if (start is None):
+            results = self.query('count({})'.format(query), time)
+            return sum(int(float(r['value'][1])) for r in results.get('result', []))
+
+        end = PrometheusQueryClient._to_timestamp(time) if (time is not None) else datetime.now(timezone.utc).timestamp()
+        start = PrometheusQueryClient._to_timestamp(start)
+        if (PrometheusQueryClient._is_selector(query)):
+            return len(self._do_query('api/v1/series', {'match[]': query, 'start': start, 'end': end}))
+
+        subquery = 'count(last_over_time(({})[{}ms:{}ms]))'.format(query, int(round((end - start) * 1000)), 
+                                                                     int(round(PrometheusQueryClient._step_to_seconds(step or '1m') * 1000)))
+        results = self.query(subquery, end)
+        return sum(int(float(r['value'][1])) for r in results.get('result', []))
+
+
+    @staticmethod
+    def _is_selector(query):
+        # A plain series selector, e.g. metric, metric{job="node"} or {__name__=~"a|b"}, rather than an expression
+        return re.fullmatch(r'\s*([a-zA-Z_:][a-zA-Z0-9_:]*\s*)?(\{[^{}]*\})?\s*', query) is not None and query.strip() != ''
+
+
+    def check_cardinality(self, query, max_series, time=None, start=None, step=None):
+        # Raises, before anything is fetched, if the query would return more than max_series series, at time
+        # or, given a start, over the window up to it (see count_series())
+        count = self.count_series(query, time, start, step)
+        if (count > max_series):
+            raise ValueError("Query '{}' matches {} series, over the limit of {}".format(query, count, max_series))
+        return count
+
+
+    def snapshot(self, metrics, time=None):
+        # The latest value of every series of each of the metrics, from instant queries over a few combined
+        # selectors, fetched concurrently. Returns the merged vector and a frame of (timestamp, value) rows 
+        # indexed by '__name__ - instance'.
+        metrics = list(metrics)
+        chunks = [ metrics[i:i + self.max_metrics_per_selector] for i in range(0, len(metrics), self.max_metrics_per_selector) ]
+        selectors = [ PrometheusQueryClient._name_selector(chunk) for chunk in chunks ]
+
+        with self._instrument('snapshot', ', '.join(metrics)):
+            record = instrumentation.current()
+            def fetch(selector):
+                with instrumentation.activate(record):
+                    return self.query(selector, time)
+
+            if (len(selectors) <= 1):
+                vectors = [ fetch(selector) for selector in selectors ]
+            else:
+                with ThreadPoolExecutor(max_workers=self.shard_workers) as executor:
+                    vectors = list(executor.map(fetch, selectors))
+
+            results = {'resultType': 'vector', 'result': [ r for vector in vectors for r in vector.get('result', []) ]}
+            df = PrometheusQueryClient._vector_to_frame(results)
+
+        return (results, df)
+
+
+    def _shard_range(self, start, end, step):
+        # Split [start, end] into chunks that each stay within the per-series point limit, keeping every
+        # chunk on the same step grid as the full window.
+        span = (self.max_points_per_query - 1) * step
+        shards = []
+        while (start <= end):
+            shards.append( (start, min(start + span, end)) )
+            start = start + span + step
+        return shards
+
+
+    def _query_range_sharded(self, params, start, end, step):
+        # TODO: Externalize the api string
+        shards = self._shard_range(start, end, step)
+        if (len(shards) <= 1):
+            return self._do_query('api/v1/query_range', dict(params, start=start, end=end))
+
+        record = instrumentation.current()
+        def fetch(shard):
+            with instrumentation.activate(record):
+                return self._do_query('api/v1/query_range', dict(params, start=shard[0], end=shard[1]))
+
+        with ThreadPoolExecutor(max_workers=self.shard_workers) as executor:
+            chunks = list(executor.map(fetch, shards))
+
+        segments = [ {'start': shard[0], 'result': chunk.get('result', [])} for (shard, chunk) in zip(shards, chunks) ]
+        return RangeQueryCache.stitch(segments, start, end)
+
+
+    # Matches the opening of the 'result' array in a query response, but not the 'resultType' member
+    _result_array_re = re.compile(r'"result"\s*:\s*\[')
+
+    @staticmethod
+    def _iter_result_stream(chunks):
+        # Incrementally decode the members of the 'result' array from an iterable of byte chunks, yielding 
+        # each series once it is complete. Only the series being decoded is held in memory.
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder('UTF-8')()
+        chunks = iter(chunks)
+        buf = ''
+        eof = False
+
+        def read():
+            nonlocal buf, eof
+            chunk = next(chunks, None)
+            if (chunk is None):
+                buf += utf8.decode(b'', final=True)
+                eof = True
+            else:
+                buf += utf8.decode(chunk)
+
+        # Find the start of the result array. Anything without one (i.e. an error) is decoded whole.
+        while (True):
+            match = PrometheusQueryClient._result_array_re.search(buf)
+            if (match):
+                buf = buf[match.end():]
+                break
+            if (eof):
+                response = json.loads(buf)
+                if response['status'] != 'success':
+                    raise RuntimeError('{errorType}: {error}'.format_map(response))
+                return
+            read()
+
+        # Decode one series at a time. When a series is incomplete, read until the buffer has doubled 
+        # before retrying, so that large series aren't re-parsed once per chunk.
+        wanted = 0
+        while (True):
+            buf = buf.lstrip(' \t\r\n,')
+            if (buf.startswith(']')):
+                return
+            if (buf and (len(buf) >= wanted or eof)):
+                try:
+                    (series, end) = decoder.raw_decode(buf)
+                except json.JSONDecodeError:
+                    wanted = 2 * len(buf)
+                else:
+                    buf = buf[end:]
+                    wanted = 0
+                    yield series
+                    continue
+            if (eof):
+                raise RuntimeError('Truncated query response')
+            read()
+
+
+    def query_range_stream(self, query, start, end, step, timeout=None, chunk_size=1 << 16):
+        # As query_range(), but yields the result series one at a time as they are decoded from the response, 
+        # rather than holding the whole response in memory. Bypasses the range cache and sharding.
+        params = {'query': query, 'start': PrometheusQueryClient._datetime_to_str(start), 
+                  'end': PrometheusQueryClient._datetime_to_str(end), 'step': step}
+        if (timeout):
+            params.update({'timeout': timeout})
+
+        resp = self._get(urljoin(self.url, 'api/v1/query_range'), params=params, stream=True)
+        try:
+            PrometheusQueryClient._check_status(resp)
+            yield from PrometheusQueryClient._iter_result_stream(resp.iter_content(chunk_size=chunk_size))
+        finally:
+            resp.close()
+
+
+    def query_range_raw(self, query, start, end, step, timeout=None):
+        # As query_range(), but returns the undecoded response body, e.g. to be decoded in another process. 
+        # Bypasses the range cache and sharding.
+        params = {'query': query, 'start': PrometheusQueryClient._datetime_to_str(start), 
+                  'end': PrometheusQueryClient._datetime_to_str(end), 'step': step}
+        if (timeout):
+            params.update({'timeout': timeout})
+
+        return PrometheusQueryClient._check_status(self._get(urljoin(self.url, 'api/v1/query_range'), params=params)).content
+
+
+    def _remote_read_request(self, selector, start, end, response_types, stream):
+        import PyPrometheusRemoteRead as remote_read
+
+        matchers = remote_read.parse_selector(selector)
+        body = remote_read.encode_read_request(matchers, int(PrometheusQueryClient._to_timestamp(start) * 1000),
+                                               int(PrometheusQueryClient._to_timestamp(end) * 1000), response_types)
+        resp = self._post(urljoin(self.url, 'api/v1/read'), remote_read.snappy_compress(body),
+                          headers=remote_read.REQUEST_HEADERS, stream=stream)
+        if (resp.status_code != 200):
+            # Remote read errors are plain text
+            message = resp.text.strip()
+            resp.close()
+            raise RuntimeError('{}: {}'.format(resp.status_code, message))
+        return resp
+
+
+    def remote_read(self, selector, start, end):
+        # Every raw sample of the series matching selector (a plain series selector, not an expression) between
+        # start and end, through the remote read API: snappy-compressed protobuf rather than JSON, and without
+        # the points-per-series limit, so there is no step and no sharding. Returns a list of {'metric': labels,
+        # 'timestamps': int64 ms array, 'values': float64 array}. Bypasses the range cache.
+        import PyPrometheusRemoteRead as remote_read
+
+        with self._instrument('remote_read', selector):
+            resp = self._remote_read_request(selector, start, end, [remote_read.SAMPLES], stream=False)
+            with instrumentation.phase('decode'):
+                return remote_read.decode_read_response(remote_read.snappy_decompress(resp.content))
+
+
+    def remote_read_stream(self, selector, start, end, chunk_size=1 << 16):
+        # As remote_read(), but yields each series as it is received. Servers which support it (Prometheus
+        # 2.13+) stream XOR-encoded chunks, so that neither end holds the whole response; others answer as
+        # for remote_read().
+        import PyPrometheusRemoteRead as remote_read
+
+        resp = self._remote_read_request(selector, start, end, [remote_read.STREAMED_XOR_CHUNKS, remote_read.SAMPLES], stream=True)
+        try:
+            if (resp.headers.get('Content-Type', '').startswith('application/x-streamed-protobuf')):
+                yield from remote_read.iter_chunked_read_response(resp.iter_content(chunk_size=chunk_size))
+            else:
+                yield from remote_read.decode_read_response(remote_read.snappy_decompress(resp.content))
+        finally:
+            resp.close()
 
+
+    @staticmethod
+    def _arrays_to_frame(series, name=None, labels=None):
+        # remote_read() series as one frame, on the union of their timestamps
+        import numpy as np
+        import pandas as pd
+
+        with instrumentation.phase('dataframe'):
+            columns = PrometheusQueryClient._column_names([ s['metric'] for s in series ], name, labels)
+            timestamps = np.unique(np.concatenate([ s['timestamps'] for s in series ])) if (series) else np.empty(0, dtype=np.int64)
+
+            values = np.full((len(timestamps), len(series)), np.nan)
+            for (i, s) in enumerate(series):
+                values[np.searchsorted(timestamps, s['timestamps']), i] = s['values']
+
+            index = pd.to_datetime(timestamps.astype(np.int64) * 1000000)
+            return pd.DataFrame(values, index=index, columns=columns)
+
+
+    def get_raw(self, selector, start, end, labels=None):
+        # The raw samples of selector, as remote_read() and a frame of them with columns as get_without_deltas()
+        with self._instrument('get_raw', selector):
+            series = self.remote_read(selector, start, end)
+            return (series, PrometheusQueryClient._arrays_to_frame(series, labels=labels))
+
+
+    @staticmethod
+    def _resolve_window(start=None, end=None, step=None):
+        # Default to the last hour, at a step giving ~500 points
         enddt = datetime.now()
         startdt = enddt - timedelta(hours = 1)
 
         if (not start):
             start = startdt.strftime('%Y-%m-%dT%H:%M:%SZ')
         else:
+            start = PrometheusQueryClient._datetime_to_str(start)
             startdt = datetime.strptime(start, '%Y-%m-%dT%H:%M:%SZ')
 
         if(not end):
             end = enddt.strftime('%Y-%m-%dT%H:%M:%SZ')
         else:
+            end = PrometheusQueryClient._datetime_to_str(end)
             enddt = datetime.strptime(end, '%Y-%m-%dT%H:%M:%SZ')
 
         if (not step):
              step = '{}s'.format( round((enddt.timestamp() - startdt.timestamp()) / 500) )
 
-        # Correct step size that is so small it will cause an error
-        if ( ((enddt.timestamp() - startdt.timestamp()) / 500) > 11000):
-            step = '{}s'.format( np.floor((enddt.timestamp() - startdt.timestamp()) / 11000) )
-            print('Warning: step size too small. Setting to {}s'.format(step))
+        # Windows which exceed the server's points-per-series limit at this step are sharded by query_range(),
+        # so there is no need to coarsen the step here.
+
+        return (start, end, step)
+
+
+    def get_general(self, query, start=None, end=None, step=None):
 
+        (start, end, step) = PrometheusQueryClient._resolve_window(start, end, step)
 
         results = self.query_range(query, start, end, step)
         
         return results
 
 
-    def get_without_deltas(self, query, start=None, end=None, step=None):
-        results = self.get_general(query, start, end, step)
+    @staticmethod
+    def _series_to_pandas(values):
+        # Convert a series' [[ts, "value"], ...] pairs in bulk. NumPy parses the value strings (including
+        # "NaN", "+Inf" and "-Inf") in C, and the timestamps are converted as one float64 column.
+        import numpy as np
+        import pandas as pd
+
+        if (not values):
+            return pd.Series([], index=pd.DatetimeIndex([], dtype='datetime64[ns]'), dtype=np.float64)
+
+        (timestamps, samples) = zip(*values)
+        index = pd.to_datetime(np.array(timestamps, dtype=np.float64), unit='s')
+        return pd.Series(np.array(samples, dtype=np.float64), index=index)
+
+
+    @staticmethod
+    def _column_name(metric, name=None, labels=None):
+        # '__name__ - instance' by default. Series which have lost their __name__ (e.g. to rate() or an aggregation)
+        # fall back to the given name, and aggregated series are keyed on the labels they were aggregated by.
+        labels = labels if (labels) else ['instance']
+        return '{} - {}'.format(metric.get('__name__', name), ', '.join(metric.get(label, '') for label in labels))
+
+
+    @staticmethod
+    def _column_names(metrics, name=None, labels=None):
+        # As _column_name(), for a whole result. Series which the labels don't tell apart would otherwise share
+        # a column, so their names are extended with the other labels whose values differ between them.
+        names = [ PrometheusQueryClient._column_name(metric, name, labels) for metric in metrics ]
+
+        groups = {}
+        for (i, column) in enumerate(names):
+            groups.setdefault(column, []).append(i)
+
+        for (column, members) in groups.items():
+            if (len(members) < 2):
+                continue
+            keys = sorted(set().union(*( metrics[i].keys() for i in members )) - set(labels or ['instance']) - {'__name__'})
+            differing = [ key for key in keys if len({ metrics[i].get(key) for i in members }) > 1 ]
+            if (not differing):
+                continue
+            for i in members:
+                names[i] = '{}, {}'.format(column, ', '.join('{}={}'.format(key, metrics[i].get(key, '')) for key in differing))
+
+        return names
+
+
+    @staticmethod
+    def _result_to_frame(results, name=None, labels=None, columns=None):
+        # columns, if given, names the series in place of _column_names()
+        import pandas as pd
+
+        with instrumentation.phase('dataframe'):
+            if (columns is None):
+                columns = PrometheusQueryClient._column_names([ r['metric'] for r in results['result'] ], name, labels)
+            data = { column: PrometheusQueryClient._series_to_pandas(r['values']) 
+                     for (column, r) in zip(columns, results['result']) }
+
+            return pd.DataFrame(data)
+
+
+    def _cached_frame(self, key, build):
+        # The cached frame is shared between callers, so each gets its own shallow copy to modify (with pandas' 
+        # copy-on-write, in-place edits don't reach the cached frame either). The results are shared as-is.
+        if (self._frame_cache is None):
+            return build()
+
+        cached = self._frame_cache.get(key)
+        if (cached is None):
+            cached = build()
+            self._frame_cache.put(key, cached, PrometheusQueryClient._to_timestamp(key[2]))
+
+        (results, df) = cached
+        return (results, df.copy(deep=False))
+
+
+    def frame_cache_stats(self):
+        if (self._frame_cache is None):
+            return None
+        return self._frame_cache.stats()
+
+
+    @staticmethod
+    def _vector_to_frame(results, name=None, labels=None):
+        # One row per series of an instant vector, named as the columns of _result_to_frame()
+        import numpy as np
+        import pandas as pd
+
+        with instrumentation.phase('dataframe'):
+            result = results['result']
+            index = PrometheusQueryClient._column_names([ r['metric'] for r in result ], name, labels)
+            timestamps = pd.to_datetime(np.array([ r['value'][0] for r in result ], dtype=np.float64), unit='s')
+            values = np.array([ r['value'][1] for r in result ], dtype=np.float64)
+
+            return pd.DataFrame({'timestamp': timestamps, 'value': values}, index=pd.Index(index, dtype=object))
+
+
+    def get_without_deltas(self, query, start=None, end=None, step=None, labels=None, max_series=None):
+        (start, end, step) = PrometheusQueryClient._resolve_window(start, end, step)
+        labels = labels or self.column_labels
+        max_series = max_series or self.max_series
+
+        def build():
+            if (max_series):
+                self.check_cardinality(query, max_series, time=end, start=start, step=step)
+
+            results = self.get_general(query, start, end, step)
         
-        data = { '{} - {}'.format(r['metric']['__name__'], r['metric']['instance']): 
-                pd.Series((np.float64(v[1]) for v in r['values']), index=(pd.Timestamp(v[0], unit='s') for v in r['values']))
-                for r in results['result']}
+            df = PrometheusQueryClient._result_to_frame(results, labels=labels)
+
+            return (results, df)
+
+        with self._instrument('get_without_deltas', query):
+            return self._cached_frame( (query, start, end, step, None, tuple(labels or ())), build )
+
+
+    def get_rollup(self, query, start=None, end=None, step=None, agg='avg', labels=None):
+        # The min, max, avg or last of the query over each step, from the rollup tiers. What the tier lacks is
+        # fetched at the finest tier's resolution and rolled up, so repeated reports over long windows only 
+        # fetch what is new. The step must be a multiple of a tier's resolution.
+        if (self._rollups is None):
+            raise ValueError('No rollup tiers are configured')
+        (start, end, step) = PrometheusQueryClient._resolve_window(start, end, step)
+        labels = labels or self.column_labels
+
+        fetched = []
+        def fetch(sub_start, sub_end, sub_step):
+            fetched.append( (sub_start, sub_end) )
+            params = {'query': query, 'step': '{:g}s'.format(sub_step)}
+            return self._query_range_sharded(params, sub_start, sub_end, sub_step)
 
-        df = pd.DataFrame(data)
+        with self._instrument('get_rollup', query):
+            results = self._rollups.query(self.url, query, PrometheusQueryClient._to_timestamp(start), PrometheusQueryClient._to_timestamp(end),
+                                          PrometheusQueryClient._step_to_seconds(step), agg=agg, fetch=fetch)
+            if (results is None):
+                raise ValueError("No rollup tier divides the step '{}'".format(step))
+            instrumentation.record_cache(hit=not fetched)
 
-        return (results, df)                   
+            df = PrometheusQueryClient._result_to_frame(results, labels=labels)
+            return (results, df)
 
 
-    def get_with_deltas(self, query, start=None, end=None, step=None):
+    def rollup_stats(self):
+        if (self._rollups is None):
+            return None
+        return self._rollups.stats()
+
+
+    @staticmethod
+    def _compute_deltas(df, counter=False, rate=False):
+        import pandas as pd
+
+        with instrumentation.phase('deltas'):
+            # Step-to-step differences for every column at once; the first row has no predecessor, so it is 0
+            deltas = df.diff()
+            if (len(deltas)):
+                deltas.iloc[0] = 0
+
+            # As with PromQL's increase(), a drop in a counter is a reset, and the increase since the reset is 
+            # the new value itself rather than a large negative delta.
+            if (counter):
+                deltas = deltas.mask(deltas < 0, df)
+
+            frames = [ df, deltas.add_prefix('delta_') ]
+
+            # Per-second rate over each step, as PromQL's rate()
+            if (rate):
+                elapsed = df.index.to_series().diff().dt.total_seconds()
+                rates = deltas.div(elapsed, axis=0)
+                if (len(rates)):
+                    rates.iloc[0] = 0
+                frames.append( rates.add_prefix('rate_') )
+
+            return pd.concat(frames, axis=1)
+
+
+    def get_with_deltas(self, query, start=None, end=None, step=None, counter=False, rate=False, labels=None, max_series=None):
         
-        (results, df) = self.get_without_deltas(query, start, end, step)
+        (start, end, step) = PrometheusQueryClient._resolve_window(start, end, step)
+        labels = labels or self.column_labels
+
+        def build():
+            (results, df) = self.get_without_deltas(query, start, end, step, labels=labels, max_series=max_series)
         
-        for col in df.columns:
-            tmp = [ ] 
-            items = df[col].to_list()
-            for (index, _) in enumerate(items):
-                if (index == 0):
-                    tmp.append(0)
-                else:
-                    tmp.append( items[index] - items[index - 1] )
-            df['delta_{}'.format(col)] = tmp
+            df = PrometheusQueryClient._compute_deltas(df, counter=counter, rate=rate)
+
+            return (results, df)
 
-        return (results, df)                   
+        with self._instrument('get_with_deltas', query):
+            return self._cached_frame( (query, start, end, step, (counter, rate), tuple(labels or ())), build )
 
 
-    def get_metric(self, metric, start=None, end=None, step=None):
+    @staticmethod
+    def _is_cumulative(metric):
+        return any(item in metric for item in ['_total'])
+
+
+    def get_metric(self, metric, start=None, end=None, step=None, labels=None, max_series=None):
         
-        if (not metric in self.metrics):
+        if (not self.has_metric(metric)):
             raise ValueError("Metric '{}' is unknown".format(metric))
         
-        is_cummulative = any(item in metric for item in ['_total'])
-        if (is_cummulative):
-            results = self.get_with_deltas(metric, start, end, step)
-        else:
-            results = self.get_without_deltas(metric, start, end, step)
+        with self._instrument('get_metric', metric):
+            if (PrometheusQueryClient._is_cumulative(metric)):
+                results = self.get_with_deltas(metric, start, end, step, counter=True, labels=labels, max_series=max_series)
+            else:
+                results = self.get_without_deltas(metric, start, end, step, labels=labels, max_series=max_series)
 
         return results
 
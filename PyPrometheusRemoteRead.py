@@ -0,0 +1,452 @@
+import re
+import struct
+import numpy as np
+
+
+# Prometheus remote read (api/v1/read): a snappy-compressed protobuf ReadRequest is POSTed, and the raw samples
+# come back either as a snappy-compressed ReadResponse (SAMPLES) or as a stream of ChunkedReadResponse frames
+# holding XOR-encoded chunks (STREAMED_XOR_CHUNKS). The few messages involved are encoded and decoded here
+# directly from the wire format, so neither protobuf nor a snappy library is required; python-snappy or
+# cramjam are used for decompression if installed.
+SAMPLES = 0
+STREAMED_XOR_CHUNKS = 1
+
+REQUEST_HEADERS = {'Content-Encoding': 'snappy', 'Content-Type': 'application/x-protobuf',
+                   'X-Prometheus-Remote-Read-Version': '0.1.0'}
+STREAMED_CONTENT_TYPE = 'application/x-streamed-protobuf; proto=prometheus.ChunkedReadResponse'
+
+# LabelMatcher.Type, by PromQL operator
+MATCH_TYPES = {'=': 0, '!=': 1, '=~': 2, '!~': 3}
+
+_selector_re = re.compile(r'\s*([a-zA-Z_:][a-zA-Z0-9_:]*)?\s*(?:\{(.*)\})?\s*', re.S)
+_matcher_re  = re.compile(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*(=~|!~|!=|=)\s*"((?:[^"\\]|\\.)*)"\s*(?:,|$)')
+
+
+def parse_selector(selector):
+    # 'name{label="value", other=~"regex"}' -> [(type, name, value), ...]. Only plain series selectors can
+    # be read remotely.
+    match = _selector_re.fullmatch(selector)
+    if (not match or not (match.group(1) or match.group(2))):
+        raise ValueError("Invalid series selector '{}'".format(selector))
+
+    matchers = []
+    if (match.group(1)):
+        matchers.append( (MATCH_TYPES['='], '__name__', match.group(1)) )
+
+    body = (match.group(2) or '').strip()
+    pos = 0
+    while (pos < len(body)):
+        m = _matcher_re.match(body, pos)
+        if (not m):
+            raise ValueError("Invalid series selector '{}'".format(selector))
+        value = re.sub(r'\\(.)', r'\1', m.group(3))
+        matchers.append( (MATCH_TYPES[m.group(2)], m.group(1), value) )
+        pos = m.end()
+
+    return matchers
+
+
+# =========================
+# Protobuf wire format
+
+def encode_varint(n):
+    if (n < 0):
+        n += 1 << 64
+    out = bytearray()
+    while (True):
+        (n, b) = (n >> 7, n & 0x7f)
+        if (not n):
+            out.append(b)
+            return bytes(out)
+        out.append(b | 0x80)
+
+
+def decode_varint(buf, pos):
+    result = 0
+    shift = 0
+    while (True):
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if (not b & 0x80):
+            return (result, pos)
+        shift += 7
+
+
+def _signed(n):
+    return (n - (1 << 64)) if (n >= (1 << 63)) else n
+
+
+def encode_field(number, value):
+    # ints as varints (wire type 0), everything else as length-delimited (wire type 2)
+    if (isinstance(value, int)):
+        return encode_varint(number << 3) + encode_varint(value)
+    if (isinstance(value, str)):
+        value = value.encode('UTF-8')
+    return encode_varint((number << 3) | 2) + encode_varint(len(value)) + value
+
+
+def iter_fields(buf, pos, end):
+    # Yields (number, wire_type, value): ints for varints, (start, end) offsets for length-delimited fields and
+    # the raw bytes for fixed-width ones
+    while (pos < end):
+        (key, pos) = decode_varint(buf, pos)
+        (number, wire_type) = (key >> 3, key & 7)
+        if (wire_type == 0):
+            (value, pos) = decode_varint(buf, pos)
+        elif (wire_type == 2):
+            (length, pos) = decode_varint(buf, pos)
+            (value, pos) = ((pos, pos + length), pos + length)
+        elif (wire_type == 1):
+            (value, pos) = (buf[pos:pos + 8], pos + 8)
+        elif (wire_type == 5):
+            (value, pos) = (buf[pos:pos + 4], pos + 4)
+        else:
+            raise ValueError('Unsupported protobuf wire type {}'.format(wire_type))
+        yield (number, wire_type, value)
+
+
+def encode_read_request(matchers, start_ms, end_ms, accepted_response_types=(SAMPLES,)):
+    query = ( encode_field(1, start_ms) + encode_field(2, end_ms) +
+              b''.join( encode_field(3, encode_field(1, t) + encode_field(2, name) + encode_field(3, value)) for (t, name, value) in matchers ) )
+    types = b''.join( encode_varint(t) for t in accepted_response_types )
+    return encode_field(1, query) + encode_field(2, types)
+
+
+def decode_read_request(buf):
+    # The inverse of encode_read_request(), for the first query: (matchers, start_ms, end_ms, accepted_response_types)
+    (query, types) = (None, [])
+    for (number, _, value) in iter_fields(buf, 0, len(buf)):
+        if (number == 1 and query is None):
+            query = value
+        elif (number == 2):
+            (pos, end) = value
+            while (pos < end):
+                (t, pos) = decode_varint(buf, pos)
+                types.append(t)
+
+    (matchers, start_ms, end_ms) = ([], 0, 0)
+    for (number, _, value) in iter_fields(buf, *(query or (0, 0))):
+        if (number == 1):
+            start_ms = _signed(value)
+        elif (number == 2):
+            end_ms = _signed(value)
+        elif (number == 3):
+            matcher = {1: 0, 2: '', 3: ''}
+            for (mnumber, _, mvalue) in iter_fields(buf, *value):
+                matcher[mnumber] = mvalue if (mnumber == 1) else bytes(buf[mvalue[0]:mvalue[1]]).decode('UTF-8')
+            matchers.append( (matcher[1], matcher[2], matcher[3]) )
+
+    return (matchers, start_ms, end_ms, types)
+
+
+# =========================
+# Snappy block format
+
+def snappy_compress(data):
+    # A valid snappy block of literals only: requests are small, so they aren't worth compressing
+    try:
+        import cramjam
+        return bytes(cramjam.snappy.compress_raw(data))
+    except ImportError:
+        pass
+
+    out = bytearray(encode_varint(len(data)))
+    for pos in range(0, len(data), 1 << 16):
+        literal = data[pos:pos + (1 << 16)]
+        n = len(literal) - 1
+        if (n < 60):
+            out.append(n << 2)
+        elif (n < 1 << 8):
+            out += bytes([60 << 2, n])
+        else:
+            out += bytes([61 << 2]) + n.to_bytes(2, 'little')
+        out += literal
+    return bytes(out)
+
+
+def snappy_decompress(data):
+    for (module, function) in (('cramjam', lambda m: m.snappy.decompress_raw), ('snappy', lambda m: m.uncompress)):
+        try:
+            return bytes(function(__import__(module))(data))
+        except ImportError:
+            continue
+
+    (length, pos) = decode_varint(data, 0)
+    out = bytearray()
+    while (pos < len(data)):
+        tag = data[pos]
+        pos += 1
+        kind = tag & 3
+        if (kind == 0):
+            n = tag >> 2
+            if (n >= 60):
+                width = n - 59
+                n = int.from_bytes(data[pos:pos + width], 'little')
+                pos += width
+            out += data[pos:pos + n + 1]
+            pos += n + 1
+            continue
+
+        if (kind == 1):
+            (n, offset) = (4 + ((tag >> 2) & 7), ((tag >> 5) << 8) | data[pos])
+            pos += 1
+        elif (kind == 2):
+            (n, offset) = ((tag >> 2) + 1, int.from_bytes(data[pos:pos + 2], 'little'))
+            pos += 2
+        else:
+            (n, offset) = ((tag >> 2) + 1, int.from_bytes(data[pos:pos + 4], 'little'))
+            pos += 4
+
+        # Copies may overlap their own output, repeating the last offset bytes
+        start = len(out) - offset
+        while (n > 0):
+            piece = out[start:start + min(n, offset)]
+            out += piece
+            (start, n) = (start + len(piece), n - len(piece))
+
+    if (len(out) != length):
+        raise ValueError('Corrupt snappy block')
+    return bytes(out)
+
+
+# =========================
+# Samples
+
+# A Sample with a non-zero value and a 6 byte varint timestamp (i.e. any millisecond time between 2001 and
+# 2109) is always encoded as these 18 bytes, which lets runs of them be decoded as one array:
+#   0x12 0x10 | 0x09 <value, 8 bytes LE> | 0x10 <timestamp, 6 byte varint>
+_SAMPLE_STRIDE = 18
+
+def _decode_samples_run(arr, pos, end):
+    n = (end - pos) // _SAMPLE_STRIDE
+    if (n == 0):
+        return (None, None, pos)
+
+    rows = arr[pos:pos + n * _SAMPLE_STRIDE].reshape(n, _SAMPLE_STRIDE)
+    ok = ( (rows[:, 0] == 0x12) & (rows[:, 1] == 0x10) & (rows[:, 2] == 0x09) & (rows[:, 11] == 0x10) &
+           np.all(rows[:, 12:17] >= 0x80, axis=1) & (rows[:, 17] < 0x80) )
+    k = n if (ok.all()) else int(np.argmin(ok))
+    if (k == 0):
+        return (None, None, pos)
+
+    rows = rows[:k]
+    values = rows[:, 3:11].copy().view('<f8').ravel()
+    timestamps = np.zeros(k, dtype=np.int64)
+    for j in range(6):
+        timestamps |= (rows[:, 12 + j].astype(np.int64) & 0x7f) << (7 * j)
+    return (timestamps, values.astype(np.float64), pos + k * _SAMPLE_STRIDE)
+
+
+def _decode_sample(buf, pos, end):
+    (timestamp, value) = (0, 0.0)
+    for (number, _, field) in iter_fields(buf, pos, end):
+        if (number == 1):
+            value = struct.unpack('<d', field)[0]
+        elif (number == 2):
+            timestamp = _signed(field)
+    return (timestamp, value)
+
+
+def _decode_labels(buf, pos, end):
+    label = {1: '', 2: ''}
+    for (number, _, (start, stop)) in iter_fields(buf, pos, end):
+        label[number] = bytes(buf[start:stop]).decode('UTF-8')
+    return (label[1], label[2])
+
+
+def decode_timeseries(buf, arr, pos, end):
+    # A TimeSeries message into {'metric': labels, 'timestamps': int64 ms, 'values': float64}
+    labels = {}
+    pieces = []
+    (slow_ts, slow_values) = ([], [])
+    while (pos < end):
+        if (buf[pos] == 0x12):
+            (timestamps, values, run_end) = _decode_samples_run(arr, pos, end)
+            if (run_end > pos):
+                if (slow_ts):
+                    pieces.append( (np.array(slow_ts, dtype=np.int64), np.array(slow_values, dtype=np.float64)) )
+                    (slow_ts, slow_values) = ([], [])
+                pieces.append( (timestamps, values) )
+                pos = run_end
+                continue
+
+        (key, pos) = decode_varint(buf, pos)
+        (number, wire_type) = (key >> 3, key & 7)
+        if (wire_type != 2):
+            raise ValueError('Unexpected field in TimeSeries')
+        (length, pos) = decode_varint(buf, pos)
+        (start, pos) = (pos, pos + length)
+        if (number == 1):
+            (name, value) = _decode_labels(buf, start, pos)
+            labels[name] = value
+        elif (number == 2):
+            (timestamp, value) = _decode_sample(buf, start, pos)
+            slow_ts.append(timestamp)
+            slow_values.append(value)
+        # Exemplars and native histograms aren't read
+
+    if (slow_ts):
+        pieces.append( (np.array(slow_ts, dtype=np.int64), np.array(slow_values, dtype=np.float64)) )
+    if (not pieces):
+        pieces.append( (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)) )
+
+    return {'metric': labels, 'timestamps': np.concatenate([ ts for (ts, _) in pieces ]),
+            'values': np.concatenate([ vs for (_, vs) in pieces ])}
+
+
+def decode_read_response(data):
+    # An uncompressed SAMPLES ReadResponse, for its first query
+    arr = np.frombuffer(data, dtype=np.uint8)
+    series = []
+    for (number, _, (start, end)) in iter_fields(data, 0, len(data)):
+        if (number != 1):
+            continue
+        for (rnumber, _, (rstart, rend)) in iter_fields(data, start, end):
+            if (rnumber == 1):
+                series.append( decode_timeseries(data, arr, rstart, rend) )
+        break
+    return series
+
+
+# =========================
+# Streamed XOR chunks
+
+class _BitReader:
+    def __init__(self, data):
+        self.value = int.from_bytes(data, 'big')
+        self.nbits = len(data) * 8
+        self.pos = 0
+
+    def read(self, n):
+        self.pos += n
+        return (self.value >> (self.nbits - self.pos)) & ((1 << n) - 1)
+
+    def read_uvarint(self):
+        result = 0
+        shift = 0
+        while (True):
+            b = self.read(8)
+            result |= (b & 0x7f) << shift
+            if (not b & 0x80):
+                return result
+            shift += 7
+
+
+# Delta-of-delta bit widths, by the number of leading 1 bits in the bucket's control code
+_dod_widths = (0, 14, 17, 20, 64)
+
+def decode_xor_chunk(data):
+    # A Prometheus XOR (Gorilla) chunk into (int64 ms timestamps, float64 values): a big-endian uint16 sample
+    # count, then the first timestamp as a signed varint and value as raw bits, the second timestamp as a
+    # delta, and later ones as deltas of deltas; each value after the first is XORed with the previous one.
+    count = int.from_bytes(data[:2], 'big')
+    if (count == 0):
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+
+    reader = _BitReader(data[2:])
+    zigzag = reader.read_uvarint()
+    t = (zigzag >> 1) ^ -(zigzag & 1)
+    vbits = reader.read(64)
+    timestamps = [t]
+    bits = [vbits]
+
+    (delta, leading, trailing) = (0, 0, 0)
+    for i in range(1, count):
+        if (i == 1):
+            delta = reader.read_uvarint()
+        else:
+            ones = 0
+            while (ones < 4 and reader.read(1)):
+                ones += 1
+            width = _dod_widths[ones]
+            if (width):
+                dod = reader.read(width)
+                if (width == 64):
+                    dod = _signed(dod)
+                elif (dod > (1 << (width - 1))):
+                    dod -= 1 << width
+                delta += dod
+        t += delta
+
+        if (reader.read(1)):
+            if (reader.read(1)):
+                leading = reader.read(5)
+                significant = reader.read(6) or 64
+                trailing = 64 - leading - significant
+            vbits ^= reader.read(64 - leading - trailing) << trailing
+
+        timestamps.append(t)
+        bits.append(vbits)
+
+    return (np.array(timestamps, dtype=np.int64), np.array(bits, dtype=np.uint64).view(np.float64))
+
+
+def _decode_chunked_series(buf, pos, end):
+    labels = {}
+    pieces = []
+    for (number, _, (start, stop)) in iter_fields(buf, pos, end):
+        if (number == 1):
+            (name, value) = _decode_labels(buf, start, stop)
+            labels[name] = value
+        elif (number == 2):
+            chunk = {1: 0, 2: 0, 3: 0, 4: (0, 0)}
+            for (cnumber, _, cvalue) in iter_fields(buf, start, stop):
+                chunk[cnumber] = cvalue
+            if (chunk[3] != 1):
+                raise ValueError('Unsupported chunk encoding {}'.format(chunk[3]))
+            pieces.append( decode_xor_chunk(bytes(buf[chunk[4][0]:chunk[4][1]])) )
+    return (labels, pieces)
+
+
+def iter_chunked_read_response(chunks):
+    # Decodes a STREAMED_XOR_CHUNKS response from an iterable of byte chunks, yielding each series once it
+    # is complete. Each frame is a uvarint length, a CRC32C of the message (not checked, as the transport
+    # already is) and a ChunkedReadResponse; a long series may continue over several frames.
+    buf = bytearray()
+    current = None
+    pieces = []
+
+    def series():
+        return {'metric': current, 'timestamps': np.concatenate([ ts for (ts, _) in pieces ]),
+                'values': np.concatenate([ vs for (_, vs) in pieces ])}
+
+    chunks = iter(chunks)
+    eof = False
+    while (True):
+        frame = None
+        try:
+            (length, pos) = decode_varint(buf, 0)
+            if (len(buf) >= pos + 4 + length):
+                frame = (pos + 4, pos + 4 + length)
+        except IndexError:
+            pass
+
+        if (frame is None):
+            if (eof):
+                if (buf):
+                    raise RuntimeError('Truncated remote read response')
+                break
+            chunk = next(chunks, None)
+            if (chunk is None):
+                eof = True
+            else:
+                buf += chunk
+            continue
+
+        message = bytes(buf[frame[0]:frame[1]])
+        del buf[:frame[1]]
+        for (number, _, (start, end)) in iter_fields(message, 0, len(message)):
+            if (number != 1):
+                continue
+            (labels, chunk_arrays) = _decode_chunked_series(message, start, end)
+            if (labels != current):
+                if (current is not None):
+                    yield series()
+                (current, pieces) = (labels, [])
+            pieces += chunk_arrays
+
+    if (current is not None):
+        if (not pieces):
+            pieces.append( (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)) )
+        yield series()
@@ -0,0 +1,202 @@
+import sys
+import json
+import hashlib
+import threading
+from multiprocessing import shared_memory, resource_tracker
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+from PyPrometheusQueryClient import PrometheusQueryClient
+from PyPrometheusCache import format_value
+
+
+class Interner:
+    # Holds one canonical copy of each label set, label string and timestamp array, so that repeated values
+    # across series and metrics are only stored once.
+    def __init__(self):
+        self._labels = {}
+        self._arrays = {}
+        self._lock = threading.Lock()
+
+    def labels(self, metric):
+        key = tuple(sorted( (sys.intern(k), sys.intern(v)) for (k, v) in metric.items() ))
+        with self._lock:
+            return self._labels.setdefault(key, key)
+
+    def array(self, arr):
+        arr.flags.writeable = False
+        key = (arr.dtype.str, arr.shape, hashlib.blake2b(arr.tobytes(), digest_size=16).digest())
+        with self._lock:
+            return self._arrays.setdefault(key, arr)
+
+
+def parse_series(results, title, labels=None, dtype=np.float64):
+    # Columnar form of a query_range result: the column names and label sets of its series, the union of 
+    # their timestamps (as int64 ms) and a 2-D value array (timestamps x series), NaN where a series has no
+    # sample. Columns are named as PrometheusQueryClient._result_to_frame().
+    series = {}
+    columns = PrometheusQueryClient._column_names([ r['metric'] for r in results['result'] ], title, labels)
+    for (column, r) in zip(columns, results['result']):
+        series[column] = r
+
+    parsed = []
+    for r in series.values():
+        if (r['values']):
+            (timestamps, samples) = zip(*r['values'])
+            parsed.append( (np.rint(np.array(timestamps, dtype=np.float64) * 1000).astype(np.int64), np.array(samples, dtype=dtype)) )
+        else:
+            parsed.append( (np.empty(0, dtype=np.int64), np.empty(0, dtype=dtype)) )
+
+    timestamps = np.unique(np.concatenate([ ts for (ts, _) in parsed ])) if (parsed) else np.empty(0, dtype=np.int64)
+    values = np.full( (len(timestamps), len(parsed)), np.nan, dtype=dtype )
+    for (col, (ts, samples)) in enumerate(parsed):
+        values[np.searchsorted(timestamps, ts), col] = samples
+
+    return (list(series.keys()), [ r['metric'] for r in series.values() ], timestamps, values)
+
+
+class CompactMetricData(Mapping):
+    # A stand-in for the {'metadata', 'title', 'data', 'df'} dict of Prometheus.prometheus_data. Samples are
+    # held as one int64 millisecond timestamp array and one 2-D value array (timestamps x series); the raw
+    # JSON 'data' and the 'df' DataFrame are rebuilt from those on demand.
+    _keys = ('metadata', 'title', 'data', 'df')
+
+    def __init__(self, title, metadata, results, interner, dtype=np.float64, deltas=False, counter=False, rate=False, keep_raw=False, labels=None):
+        (columns, metrics, timestamps, values) = parse_series(results, title, labels, dtype)
+        self._init(title, metadata, columns, metrics, timestamps, values, interner, deltas, counter, rate)
+        self._raw = results if (keep_raw) else None
+
+
+    @classmethod
+    def from_arrays(cls, title, metadata, columns, metrics, timestamps, values, interner, deltas=False, counter=False, rate=False):
+        # As the constructor, from the output of parse_series() rather than the raw results
+        self = cls.__new__(cls)
+        self._init(title, metadata, columns, metrics, timestamps, values, interner, deltas, counter, rate)
+        self._raw = None
+        return self
+
+
+    def _init(self, title, metadata, columns, metrics, timestamps, values, interner, deltas, counter, rate):
+        self.title = title
+        self.metadata = metadata
+        self.deltas = deltas
+        self.counter = counter
+        self.rate = rate
+
+        self.columns = columns
+        self.labels = [ interner.labels(metric) for metric in metrics ]
+        self.timestamps = interner.array(timestamps)
+        self.values = values
+        self.values.flags.writeable = False
+
+
+    def __getitem__(self, key):
+        if (key == 'metadata'):
+            return self.metadata
+        if (key == 'title'):
+            return self.title
+        if (key == 'data'):
+            return self.to_data()
+        if (key == 'df'):
+            return self.to_frame()
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+    @property
+    def nbytes(self):
+        return self.timestamps.nbytes + self.values.nbytes
+
+
+    def to_frame(self):
+        index = pd.to_datetime(self.timestamps / 1000, unit='s')
+        df = pd.DataFrame(self.values.copy(), index=index, columns=self.columns)
+        if (self.deltas):
+            df = PrometheusQueryClient._compute_deltas(df, counter=self.counter, rate=self.rate)
+        return df
+
+
+    def to_data(self):
+        if (self._raw is not None):
+            return self._raw
+
+        seconds = self.timestamps / 1000
+        result = []
+        for (col, labels) in enumerate(self.labels):
+            present = ~np.isnan(self.values[:, col])
+            # float32 samples are formatted as such, so they keep their short form
+            column = self.values[present, col]
+            values = [ [float(ts), format_value(v)] for (ts, v) in zip(seconds[present], column.tolist() if (column.dtype == np.float64) else list(column)) ]
+            result.append({'metric': dict(labels), 'values': values})
+        return {'resultType': 'matrix', 'result': result}
+
+
+
+def parse_response(body, metrics, dtype):
+    # Decodes a raw query_range response body and parses it with parse_series(), for a worker process. 
+    # metrics is a list of (metric, labels); if there are several, the response's series are split between
+    # them by __name__. The arrays are handed back through shared memory, see to_shared().
+    response = json.loads(body)
+    if (response['status'] != 'success'):
+        raise RuntimeError('{errorType}: {error}'.format_map(response))
+
+    series = response['data']['result']
+    if (len(metrics) == 1):
+        split = { metrics[0][0]: series }
+    else:
+        split = {}
+        for r in series:
+            split.setdefault(r['metric'].get('__name__'), []).append(r)
+
+    parsed = {}
+    try:
+        for (metric, labels) in metrics:
+            (columns, label_sets, timestamps, values) = parse_series({'result': split.get(metric, [])}, metric, labels, np.dtype(dtype))
+            parsed[metric] = (columns, label_sets, to_shared(timestamps, values))
+    except BaseException:
+        # Nobody will receive the blocks made so far
+        for (_, _, handle) in parsed.values():
+            release_shared(handle)
+        raise
+    return parsed
+
+
+def to_shared(timestamps, values):
+    # Copies the arrays into a new shared memory block, which from_shared() takes ownership of
+    size = timestamps.nbytes + values.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        np.ndarray(timestamps.shape, dtype=np.int64, buffer=shm.buf)[...] = timestamps
+        np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf, offset=timestamps.nbytes)[...] = values
+        # The receiving process unlinks the block, so this one mustn't clean it up at exit
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return (shm.name, len(timestamps), values.shape[1], values.dtype.str)
+    finally:
+        shm.close()
+
+
+def from_shared(handle):
+    (name, rows, cols, dtype) = handle
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        timestamps = np.ndarray((rows,), dtype=np.int64, buffer=shm.buf).copy()
+        values = np.ndarray((rows, cols), dtype=np.dtype(dtype), buffer=shm.buf, offset=timestamps.nbytes).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return (timestamps, values)
+
+
+def release_shared(handle):
+    # Unlinks a block from to_shared() without reading it
+    try:
+        shm = shared_memory.SharedMemory(name=handle[0])
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
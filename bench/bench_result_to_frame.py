@@ -0,0 +1,58 @@
+import sys
+import time
+import argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from PyPrometheusQueryClient import PrometheusQueryClient
+
+
+def build_result(series, points, step=15, start=1645000000):
+    rng = np.random.default_rng(0)
+    result = []
+    for i in range(series):
+        values = [ [start + n * step, str(v)] for (n, v) in enumerate(rng.random(points) * 1000) ]
+        values[len(values) // 2][1] = 'NaN'
+        values[-1][1] = '+Inf'
+        result.append({'metric': {'__name__': 'bench_metric', 'instance': 'host{:04d}'.format(i)}, 'values': values})
+    return {'resultType': 'matrix', 'result': result}
+
+
+def legacy_result_to_frame(results):
+    # The per-sample conversion get_without_deltas() used previously, kept here as the baseline
+    data = { '{} - {}'.format(r['metric']['__name__'], r['metric']['instance']):
+            pd.Series((np.float64(v[1]) for v in r['values']), index=(pd.Timestamp(v[0], unit='s') for v in r['values']))
+            for r in results['result']}
+    return pd.DataFrame(data)
+
+
+def timed(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = func(*args)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if (best is None) else min(best, elapsed)
+    return (best, out)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the legacy and vectorized JSON-to-DataFrame conversion')
+    parser.add_argument('--series', type=int, default=100)
+    parser.add_argument('--points', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    results = build_result(args.series, args.points)
+
+    (t_legacy, df_legacy) = timed(legacy_result_to_frame, results, repeat=args.repeat)
+    (t_fast, df_fast)     = timed(PrometheusQueryClient._result_to_frame, results, repeat=args.repeat)
+
+    pd.testing.assert_frame_equal(df_legacy, df_fast)
+
+    print('series={} points={}'.format(args.series, args.points))
+    print('legacy:     {:8.3f}s'.format(t_legacy))
+    print('vectorized: {:8.3f}s'.format(t_fast))
+    print('speedup:    {:8.1f}x'.format(t_legacy / t_fast))
@@ -0,0 +1,56 @@
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Each snippet runs in a fresh interpreter so that nothing is already imported. It reports how long the
+# interesting part took, and which of the heavy modules it ended up importing.
+IMPORT_CLIENT = '''
+import time, sys
+t0 = time.perf_counter()
+import PyPrometheusQueryClient
+elapsed = time.perf_counter() - t0
+'''
+
+IMPORT_PROMETHEUS = '''
+import time, sys
+t0 = time.perf_counter()
+import PyPrometheus
+elapsed = time.perf_counter() - t0
+'''
+
+CONSTRUCT_PROMETHEUS = '''
+import time, sys
+from PyPrometheus import Prometheus
+t0 = time.perf_counter()
+Prometheus('http://127.0.0.1:9/', metrics_config_file='test/config_metrics.json')
+elapsed = time.perf_counter() - t0
+'''
+
+REPORT = '''
+import json
+print(json.dumps({'elapsed': elapsed, 'modules': sorted(m for m in ('pandas', 'numpy', 'pyarrow', 'httpx') if m in sys.modules)}))
+'''
+
+CASES = [ ('import PyPrometheusQueryClient', IMPORT_CLIENT),
+          ('import PyPrometheus', IMPORT_PROMETHEUS),
+          ('construct Prometheus', CONSTRUCT_PROMETHEUS) ]
+
+
+def run(snippet):
+    out = subprocess.run([sys.executable, '-c', snippet + REPORT], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure import and construction time in fresh interpreters')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for (name, snippet) in CASES:
+        runs = [ run(snippet) for _ in range(args.repeat) ]
+        best = min(r['elapsed'] for r in runs)
+        print('{:<32} {:8.1f}ms   heavy imports: {}'.format(name, best * 1000, ', '.join(runs[0]['modules']) or 'none'))
@@ -0,0 +1,236 @@
+import sys
+import json
+import shutil
+import tempfile
+from pathlib import Path
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'test'))
+
+from PyPrometheusQueryClient import PrometheusQueryClient
+from PyPrometheus import Prometheus
+from fake_prometheus import FakePrometheusServer
+import PyPrometheusRemoteRead as remote_read
+from bench_result_to_frame import build_result, legacy_result_to_frame
+
+pytest.importorskip('pytest_benchmark')
+
+# Benchmarks of the main client paths, against a local FakePrometheusServer. Run with:
+#
+#   python -m pytest bench/bench_suite.py
+#
+# Each benchmark also asserts a machine-independent regression threshold (a speedup over the legacy
+# implementation, or a request count). To additionally guard absolute timings, save a baseline with
+# --benchmark-autosave and compare later runs with --benchmark-compare --benchmark-compare-fail=mean:25%.
+
+SERIES = 50
+POINTS = 2000
+START  = '2022-02-16T00:00:00Z'
+END_2K = '2022-02-16T08:19:45Z'         # 2000 points at 15s
+
+
+@pytest.fixture(scope='module')
+def server():
+    with FakePrometheusServer(metrics=200, series=SERIES) as fake:
+        yield fake
+
+
+@pytest.fixture(scope='module')
+def results():
+    return build_result(SERIES, POINTS)
+
+
+@pytest.fixture
+def cache_path():
+    path = tempfile.mkdtemp(prefix='pyprometheus_bench_')
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def best_of(func, repeat=3):
+    import time
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if (best is None) else min(best, elapsed)
+    return best
+
+
+# =========================
+# Fetch
+
+def test_fetch_query_range(benchmark, server):
+    iut = PrometheusQueryClient(server.url, auto_get_server_metrics=False)
+    results = benchmark(iut.query_range, 'metric_0000', START, END_2K, '15s')
+    assert len(results['result']) == SERIES
+    assert len(results['result'][0]['values']) == POINTS
+
+
+def test_fetch_sharded_query_range(benchmark, server):
+    # 30 days at 1m: four shards fetched concurrently
+    iut = PrometheusQueryClient(server.url, auto_get_server_metrics=False, shard_workers=4)
+    results = benchmark.pedantic(iut.query_range, args=('metric_0000', '2022-01-01T00:00:00Z', '2022-01-31T00:00:00Z', '1m'), rounds=1, iterations=1)
+    assert len(results['result'][0]['values']) == 30 * 1440 + 1
+
+
+def test_fetch_remote_read(benchmark, server):
+    iut = PrometheusQueryClient(server.url, auto_get_server_metrics=False)
+    series = benchmark.pedantic(iut.remote_read, args=('metric_0000', START, END_2K), rounds=1, iterations=1)
+    assert len(series) == SERIES
+    assert len(series[0]['values']) == POINTS
+
+
+# =========================
+# JSON decode
+
+def test_json_decode(benchmark, results):
+    body = json.dumps({'status': 'success', 'data': results})
+    decoded = benchmark(json.loads, body)
+    assert len(decoded['data']['result']) == SERIES
+
+
+def test_json_decode_streaming(benchmark, results):
+    body = json.dumps({'status': 'success', 'data': results}).encode('UTF-8')
+    chunks = [ body[i:i + 65536] for i in range(0, len(body), 65536) ]
+    decoded = benchmark(lambda: list(PrometheusQueryClient._iter_result_stream(chunks)))
+    assert len(decoded) == SERIES
+
+
+def test_remote_read_decode(benchmark, results):
+    # The same samples as a remote read response, decoded straight to arrays, against just JSON decoding
+    # them to lists of strings
+    body = remote_read.encode_field(1, b''.join( remote_read.encode_field(1, FakePrometheusServer._encode_labels(r['metric']) +
+                                                     b''.join( remote_read.encode_field(2, FakePrometheusServer._encode_sample(int(ts * 1000), float(v))) for (ts, v) in r['values'] ))
+                                                 for r in results['result'] ))
+    decoded = benchmark(remote_read.decode_read_response, body)
+    assert len(decoded) == SERIES and len(decoded[0]['values']) == POINTS
+
+    text = json.dumps({'status': 'success', 'data': results})
+    assert best_of(lambda: json.loads(text)) / best_of(lambda: remote_read.decode_read_response(body)) > 3
+
+
+# =========================
+# DataFrame build
+
+def test_dataframe_build(benchmark, results):
+    df = benchmark(PrometheusQueryClient._result_to_frame, results)
+    assert df.shape == (POINTS, SERIES)
+
+    # Regression threshold: the vectorized build must stay well ahead of the per-sample one
+    speedup = best_of(lambda: legacy_result_to_frame(results), repeat=1) / best_of(lambda: PrometheusQueryClient._result_to_frame(results))
+    assert speedup > 3, 'vectorized frame build only {:.1f}x faster than legacy'.format(speedup)
+
+
+# =========================
+# Delta computation
+
+def legacy_deltas(df):
+    # The per-column loop get_with_deltas() used previously
+    for col in list(df.columns):
+        tmp = []
+        items = df[col].to_list()
+        for (index, _) in enumerate(items):
+            tmp.append(0 if (index == 0) else items[index] - items[index - 1])
+        df['delta_{}'.format(col)] = tmp
+    return df
+
+
+def test_delta_computation(benchmark, results):
+    df = PrometheusQueryClient._result_to_frame(results)
+    out = benchmark(PrometheusQueryClient._compute_deltas, df, counter=True, rate=True)
+    assert out.shape == (POINTS, SERIES * 3)
+
+    speedup = best_of(lambda: legacy_deltas(df.copy()), repeat=1) / best_of(lambda: PrometheusQueryClient._compute_deltas(df))
+    assert speedup > 3, 'vectorized deltas only {:.1f}x faster than legacy'.format(speedup)
+
+
+# =========================
+# Caching
+
+def test_cache_hit(benchmark, server, cache_path):
+    iut = PrometheusQueryClient(server.url, cache_path=cache_path, auto_get_server_metrics=False)
+    iut.query_range('metric_0001', START, END_2K, '15s')
+
+    before = len(server.requests)
+    results = benchmark(iut.query_range, 'metric_0001', START, END_2K, '15s')
+
+    assert len(server.requests) == before, 'cache hits must not reach the server'
+    assert len(results['result'][0]['values']) == POINTS
+
+
+def test_cache_partial_hit(benchmark, server, cache_path):
+    # A window that has moved on by an hour only fetches that hour
+    iut = PrometheusQueryClient(server.url, cache_path=cache_path, auto_get_server_metrics=False)
+    iut.query_range('metric_0002', START, END_2K, '15s')
+
+    before = len(server.requests)
+    benchmark.pedantic(iut.query_range, args=('metric_0002', '2022-02-16T01:00:00Z', '2022-02-16T09:19:45Z', '15s'), rounds=1, iterations=1)
+
+    fetched = server.requests[before:]
+    assert len(fetched) == 1
+    assert float(fetched[0][1]['end']) - float(fetched[0][1]['start']) <= 3600
+
+
+# =========================
+# Concurrency
+
+def _prometheus(url, metrics, config_dir):
+    config = Path(config_dir) / 'metrics.json'
+    config.write_text(json.dumps({ name: {'active': True, 'deltas': False} for name in metrics }))
+    return Prometheus(url, metrics_config_file=config, starttime=START, endtime=END_2K)
+
+
+@pytest.mark.parametrize('max_workers', [1, 8])
+def test_get_metrics_concurrency(benchmark, cache_path, max_workers):
+    with FakePrometheusServer(metrics=16, series=5, latency=0.05) as slow:
+        iut = _prometheus(slow.url, slow.metric_names(), cache_path)
+        errors = benchmark.pedantic(iut.get_metrics, args=(False,), kwargs={'max_workers': max_workers}, rounds=2)
+
+        assert errors == {}
+        assert len(iut.prometheus_data) == 16
+
+
+def test_get_metrics_concurrency_speedup(cache_path):
+    with FakePrometheusServer(metrics=16, series=5, latency=0.05) as slow:
+        iut = _prometheus(slow.url, slow.metric_names(), cache_path)
+        iut.pqc.has_metric('metric_0000')
+
+        # How far the requests the server saw overlapped, rather than the wall-clock speedup, which varies with
+        # the load on the machine. Each is held for 50ms, far longer than it takes a worker to issue its next.
+        slow.peak_in_flight = 0
+        assert iut.get_metrics(False, max_workers=1) == {}
+        assert slow.peak_in_flight == 1
+
+        slow.peak_in_flight = 0
+        assert iut.get_metrics(False, max_workers=8) == {}
+        assert 4 <= slow.peak_in_flight <= 8, 'get_metrics with 8 workers had at most {} requests in flight'.format(slow.peak_in_flight)
+
+
+def test_get_metrics_batched(benchmark, cache_path):
+    with FakePrometheusServer(metrics=40, series=5, latency=0.02) as slow:
+        iut = _prometheus(slow.url, slow.metric_names(), cache_path)
+        iut.pqc.has_metric('metric_0000')
+
+        before = len(slow.requests)
+        benchmark.pedantic(iut.get_metrics, args=(False,), kwargs={'batch': True, 'max_series_per_batch': 100}, rounds=1, iterations=1)
+
+        # One count query plus two batches of 20 metrics x 5 series
+        assert len(slow.requests) - before == 3
+        assert len(iut.prometheus_data) == 40
+
+
+@pytest.mark.parametrize('parse_processes', [0, 4])
+def test_get_metrics_parse_processes(benchmark, cache_path, parse_processes):
+    # Decoding and parsing on a process pool. This only pays off given spare cores: the fake server shares this
+    # process, and pool start-up is included. No threshold, as it depends on the machine.
+    with FakePrometheusServer(metrics=8, series=50) as server:
+        iut = _prometheus(server.url, server.metric_names(), cache_path)
+        iut.pqc.has_metric('metric_0000')
+
+        errors = benchmark.pedantic(iut.get_metrics, args=(False,), kwargs={'max_workers': 8, 'parse_processes': parse_processes}, rounds=2)
+        assert errors == {}
+        assert len(iut.prometheus_data) == 8
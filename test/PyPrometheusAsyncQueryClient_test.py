@@ -0,0 +1,122 @@
+import unittest
+import asyncio
+import importlib.util
+import json
+from urllib.parse import parse_qs
+
+HAVE_HTTPX = importlib.util.find_spec('httpx') is not None
+if (HAVE_HTTPX):
+    import httpx
+    from PyPrometheusAsyncQueryClient import AsyncPrometheusQueryClient
+
+
+def fake_prometheus(request):
+    params = { k: v[0] for (k, v) in parse_qs(request.url.query.decode('UTF-8')).items() }
+    if (request.url.path.endswith('/values')):
+        data = ['up', 'node_cpu_seconds_total']
+    else:
+        (start, end, step) = (float(params['start']), float(params['end']), float(params['step'].rstrip('s')))
+        count = int((end - start) // step) + 1
+        data = {'resultType': 'matrix', 'result': [
+            {'metric': {'__name__': params['query'], 'instance': 'host{}'.format(i)}, 'values': [[start + n * step, str(n)] for n in range(count)]}
+            for i in range(2) ]}
+    return httpx.Response(200, json={'status': 'success', 'data': data})
+
+
+@unittest.skipUnless(HAVE_HTTPX, 'httpx is not installed')
+class TestAsyncPrometheusQueryClient(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.requests = []
+        def handler(request):
+            self.requests.append(request)
+            return fake_prometheus(request)
+
+        self.iut = AsyncPrometheusQueryClient('http://prometheus.test/')
+        await self.iut._client.aclose()
+        self.iut._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    async def asyncTearDown(self):
+        await self.iut.close()
+
+    async def test_get_metric(self):
+        (results, df) = await self.iut.get_metric('node_cpu_seconds_total', start='2022-01-01T00:00:00Z', end='2022-01-01T01:00:00Z', step='60s')
+
+        self.assertEqual( ['node_cpu_seconds_total', 'up'], list(self.iut.metrics) )
+        self.assertEqual( (61, 4), df.shape )
+        self.assertIn( 'delta_node_cpu_seconds_total - host0', df.columns )
+
+    async def test_get_metrics_starting_with(self):
+        self.assertEqual( ['node_cpu_seconds_total'], await self.iut.get_metrics_starting_with(['cpu']) )
+        self.assertEqual( ['node_cpu_seconds_total', 'up'], await self.iut.get_metrics_starting_with(['cpu', 'up']) )
+        self.assertEqual( 1, len(self.requests) )
+
+    async def test_get_metric_concurrent(self):
+        async def handler(request):
+            # Slow enough that the calls overlap
+            self.requests.append(request)
+            await asyncio.sleep(0.01)
+            return fake_prometheus(request)
+
+        await self.iut._client.aclose()
+        self.iut._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+        window = {'start': '2022-01-01T00:00:00Z', 'end': '2022-01-01T01:00:00Z', 'step': '60s'}
+        await asyncio.gather(*( self.iut.get_metric(metric, **window) for metric in ['up', 'node_cpu_seconds_total'] * 3 ))
+
+        # The catalog was fetched once, for all of them
+        self.assertEqual( 1, len([ request for request in self.requests if request.url.path.endswith('/values') ]) )
+
+    async def test_get_metric_exception_metric_unknown(self):
+        with self.assertRaises(ValueError):
+            await self.iut.get_metric('not_a_metric')
+
+    async def test_query_range_sharded(self):
+        results = await self.iut.query_range('up', '2022-01-01T00:00:00Z', '2022-01-31T00:00:00Z', '60s')
+
+        self.assertEqual( 4, len(self.requests) )
+        self.assertEqual( 30 * 1440 + 1, len(results['result'][0]['values']) )
+
+    async def test_retry_on_server_error(self):
+        responses = [ httpx.Response(503), httpx.Response(429, headers={'Retry-After': '0'}) ]
+        def handler(request):
+            return responses.pop(0) if (responses) else fake_prometheus(request)
+
+        await self.iut._client.aclose()
+        self.iut._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        self.iut.backoff_factor = 0
+
+        (results, df) = await self.iut.get_without_deltas('up', start='2022-01-01T00:00:00Z', end='2022-01-01T00:10:00Z', step='60s')
+        self.assertEqual( (11, 2), df.shape )
+
+    async def test_retry_on_transport_error(self):
+        failures = [ httpx.ConnectError('refused'), httpx.ReadTimeout('timed out') ]
+        def handler(request):
+            if (failures):
+                raise failures.pop(0)
+            return fake_prometheus(request)
+
+        await self.iut._client.aclose()
+        self.iut._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        self.iut.backoff_factor = 0
+
+        (results, df) = await self.iut.get_without_deltas('up', start='2022-01-01T00:00:00Z', end='2022-01-01T00:10:00Z', step='60s')
+        self.assertEqual( (11, 2), df.shape )
+
+        # Once the retries run out, the last error is raised
+        failures.extend([ httpx.ConnectError('refused') ] * (self.iut.retries + 1))
+        with self.assertRaises(httpx.ConnectError):
+            await self.iut.query_range('up', '2022-01-01T00:00:00Z', '2022-01-01T00:10:00Z', '60s')
+        self.assertEqual( [], failures )
+
+    async def test_retries_exhausted(self):
+        await self.iut._client.aclose()
+        self.iut._client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(503, text='upstream unavailable')))
+        self.iut.backoff_factor = 0
+
+        with self.assertRaisesRegex(RuntimeError, 'HTTP 503: upstream unavailable'):
+            await self.iut.query_range('up', '2022-01-01T00:00:00Z', '2022-01-01T00:10:00Z', '60s')
+
+
+if (__name__ == '__main__'):
+    unittest.main()
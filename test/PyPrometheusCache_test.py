@@ -0,0 +1,289 @@
+import unittest
+from PyPrometheusCache import RangeQueryCache, FrameCache, RollupCache, format_value
+from pathlib import Path
+import os
+import math
+import time
+from unittest import mock
+import numpy as np
+import pandas as pd
+
+
+def delete_folder(pth:Path) -> None:
+    if (pth.exists()):
+        for sub in pth.iterdir():
+            if (sub.is_dir()):
+                delete_folder(sub)
+            else:
+                sub.unlink()
+        pth.rmdir()
+    return
+
+
+class FakeFetch:
+    def __init__(self, series=2):
+        self.series = series
+        self.calls = []
+
+    def __call__(self, start, end, step=60):
+        self.calls.append( (start, end) )
+        result = []
+        for i in range(self.series):
+            values = []
+            ts = start
+            while (ts <= end):
+                values.append([ts, str(ts * (i + 1))])
+                ts += step
+            result.append({'metric': {'__name__': 'm', 'instance': 'host{}'.format(i)}, 'values': values})
+        return {'resultType': 'matrix', 'result': result}
+
+
+class TestFormatValue(unittest.TestCase):
+
+    def test_format_value(self):
+        # As the server writes them
+        for (value, text) in [ (2.0, '2'), (-0.5, '-0.5'), (0.1, '0.1'), (1e20, '100000000000000000000'), (1.5e-7, '0.00000015'),
+                               (math.nan, 'NaN'), (math.inf, '+Inf'), (-math.inf, '-Inf'), (np.float64(3.25), '3.25') ]:
+            self.assertEqual( text, format_value(value) )
+
+    def test_format_value_float32(self):
+        self.assertEqual( '0.1', format_value(np.float32(0.1)) )
+        self.assertEqual( '2', format_value(np.float32(2)) )
+        for value in np.array([0.1, 1 / 3, 123456.7, 1e-30], dtype=np.float32):
+            self.assertEqual( value, np.float32(float(format_value(value))) )
+
+
+class TestRangeQueryCache(unittest.TestCase):
+
+    cache_path = Path('./test/PyPrometheusCache/range_cache/')
+
+    def setUp(self) -> None:
+        delete_folder(self.cache_path)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        delete_folder(self.cache_path)
+        return super().tearDown()
+
+    def test_align(self):
+        self.assertEqual( (120, 300), RangeQueryCache.align(61, 359, 60) )
+
+    def test_missing_ranges(self):
+        segments = [ {'start': 120, 'end': 240}, {'start': 600, 'end': 720} ]
+        actual = RangeQueryCache.missing_ranges(segments, 0, 900, 60)
+        self.assertEqual( [(0, 60), (300, 540), (780, 900)], actual )
+
+    def test_partial_hit_fetches_only_new_range(self):
+        iut = RangeQueryCache(self.cache_path, ttl=None)
+        fetch = FakeFetch()
+        base = 1_600_000_000 - (1_600_000_000 % 60)
+
+        first = iut.query_range('url', 'm', base, base + 3600, 60, fetch)
+        self.assertEqual( [(base, base + 3600)], fetch.calls )
+        self.assertEqual( 61, len(first['result'][0]['values']) )
+
+        second = iut.query_range('url', 'm', base + 1800, base + 7200, 60, fetch)
+        self.assertEqual( (base + 3660, base + 7200), fetch.calls[-1] )
+        self.assertEqual( 2, len(fetch.calls) )
+        self.assertEqual( 91, len(second['result'][1]['values']) )
+        self.assertEqual( [base + 1800, str((base + 1800) * 2)], second['result'][1]['values'][0] )
+
+        # A window fully inside what we hold is answered without touching the server
+        iut.query_range('url', 'm', base + 600, base + 6000, 60, fetch)
+        self.assertEqual( 2, len(fetch.calls) )
+
+    def test_recent_samples_not_persisted(self):
+        iut = RangeQueryCache(self.cache_path, ttl=None)
+        fetch = FakeFetch()
+        now = time.time()
+
+        iut.query_range('url', 'm', now - 3600, now, 60, fetch)
+        iut.query_range('url', 'm', now - 3600, now, 60, fetch)
+
+        # The second call re-fetches only the unsettled tail of the window
+        self.assertEqual( 2, len(fetch.calls) )
+        self.assertGreaterEqual( fetch.calls[1][1] - fetch.calls[1][0], RangeQueryCache.recent_window - 60 )
+        self.assertLess( fetch.calls[1][1] - fetch.calls[1][0], 3600 )
+
+    def test_ttl_expires_only_recent_tail(self):
+        iut = RangeQueryCache(self.cache_path, ttl=1800)
+        fetch = FakeFetch()
+        now = time.time()
+        end = math.floor((now - 600) / 60) * 60
+
+        # A 24h window, re-run an hour later: only the part within the TTL of the first fetch has expired
+        iut.query_range('url', 'm', end - 86400, end, 60, fetch)
+        with mock.patch('PyPrometheusCache.time.time', return_value=now + 3600):
+            iut.query_range('url', 'm', end - 86400, end, 60, fetch)
+
+        self.assertEqual( 2, len(fetch.calls) )
+        self.assertLessEqual( fetch.calls[1][1] - fetch.calls[1][0], 1800 )
+        self.assertEqual( end, fetch.calls[1][1] )
+
+        # Old windows are final, however long ago they were fetched
+        base = 1_600_000_000 - (1_600_000_000 % 60)
+        iut.query_range('url', 'm', base, base + 600, 60, fetch)
+        with mock.patch('PyPrometheusCache.time.time', return_value=now + 86400 * 365):
+            iut.query_range('url', 'm', base, base + 600, 60, fetch)
+        self.assertEqual( 3, len(fetch.calls) )
+
+    def test_final_segments_merged(self):
+        iut = RangeQueryCache(self.cache_path, ttl=3600)
+        fetch = FakeFetch()
+        base = 1_600_000_000 - (1_600_000_000 % 60)
+
+        for hour in range(24):
+            iut.query_range('url', 'm', base + hour * 3600, base + (hour + 1) * 3600, 60, fetch)
+
+        segments = iut._load(iut._key_file('url', 'm', 60), 60)
+        self.assertEqual( [(base, base + 86400)], [ (seg['start'], seg['end']) for seg in segments ] )
+        self.assertEqual( 1441, len(segments[0]['result'][0]['values']) )
+        self.assertEqual( 1441, len(iut.query_range('url', 'm', base, base + 86400, 60, fetch)['result'][1]['values']) )
+        self.assertEqual( 24, len(fetch.calls) )
+
+    def test_retention(self):
+        iut = RangeQueryCache(self.cache_path, ttl=None, retention=86400)
+        fetch = FakeFetch()
+        end = math.floor((time.time() - 600) / 60) * 60
+
+        iut.query_range('url', 'm', end - 7200, end, 60, fetch)
+        iut.query_range('url', 'm', end - 7200, end, 60, fetch)
+        self.assertEqual( 1, len(fetch.calls) )
+
+        # A day later, only the last part of the window is still retained
+        later = time.time() + 86400 - 3600
+        with mock.patch('PyPrometheusCache.time.time', return_value=later):
+            iut.query_range('url', 'm', end - 7200, end, 60, fetch)
+        self.assertEqual( 2, len(fetch.calls) )
+        self.assertEqual( (end - 7200, math.ceil((later - 86400) / 60) * 60 - 60), fetch.calls[1] )
+
+
+class TestFrameCache(unittest.TestCase):
+
+    @staticmethod
+    def _value(rows):
+        results = FakeFetch(series=1)(0, (rows - 1) * 60)
+        return (results, pd.DataFrame({'m': [1.0] * rows}))
+
+    def test_lru_eviction_by_bytes(self):
+        value = self._value(100)
+        nbytes = FrameCache.nbytes(value)
+        iut = FrameCache(max_bytes=int(nbytes * 2.5))
+
+        iut.put('a', value, end=0)
+        iut.put('b', value, end=0)
+        self.assertIsNotNone( iut.get('a') )
+
+        # 'b' is now the least recently used
+        iut.put('c', value, end=0)
+        self.assertIsNone( iut.get('b') )
+        self.assertIsNotNone( iut.get('a') )
+        self.assertIsNotNone( iut.get('c') )
+
+        stats = iut.stats()
+        self.assertEqual( (3, 1, 1, 2), (stats['hits'], stats['misses'], stats['evictions'], stats['entries']) )
+        self.assertEqual( 2 * nbytes, stats['bytes'] )
+
+    def test_oversized_not_cached(self):
+        iut = FrameCache(max_bytes=100)
+        iut.put('a', self._value(1000), end=0)
+        self.assertIsNone( iut.get('a') )
+        self.assertEqual( 0, iut.stats()['bytes'] )
+
+    def test_recent_window_expires(self):
+        iut = FrameCache(max_bytes=1 << 30, recent_ttl=1)
+        iut.put('old', self._value(10), end=0)
+        iut.put('recent', self._value(10), end=time.time())
+
+        time.sleep(1.1)
+        self.assertIsNotNone( iut.get('old') )
+        self.assertIsNone( iut.get('recent') )
+
+
+
+class TestRollupCache(unittest.TestCase):
+
+    cache_path = Path('./test/PyPrometheusCache/rollups/')
+    url = 'http://localhost:9090/'
+    tiers = ((60, None, 1 << 30), (3600, None, 1 << 30))
+
+    def setUp(self) -> None:
+        delete_folder(self.cache_path)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        delete_folder(self.cache_path)
+        return super().tearDown()
+
+    def test_tiers_validated(self):
+        self.assertRaises( ValueError, RollupCache, self.cache_path, tiers=((60, None, 1000), (90, None, 1000)) )
+        self.assertRaises( ValueError, RollupCache, self.cache_path, tiers=() )
+        self.assertRaises( ValueError, RollupCache(self.cache_path, tiers=self.tiers).query, self.url, 'q', 0, 3600, 3600, agg='median' )
+
+    def test_query_fills_and_reuses_tiers(self):
+        iut = RollupCache(self.cache_path, tiers=self.tiers)
+        fetch = FakeFetch()
+
+        # Nothing held, and no tier divides a 90s step
+        self.assertIsNone( iut.query(self.url, 'q', 7200, 14400, 3600) )
+        self.assertIsNone( iut.query(self.url, 'q', 7200, 14400, 90, fetch=fetch) )
+
+        # The hourly buckets ending 7200 to 14400 are built from 1m samples
+        results = iut.query(self.url, 'q', 7200, 14400, 3600, agg='max', fetch=fetch)
+        self.assertEqual( [(3660, 14400)], fetch.calls )
+        self.assertEqual( [[7200, '14400'], [10800, '21600'], [14400, '28800']], results['result'][1]['values'] )
+
+        # ... as was the 1m tier, and every aggregation is answered locally
+        self.assertEqual( [[7200, '5430'], [10800, '9030'], [14400, '12630']], iut.query(self.url, 'q', 7200, 14400, 3600, agg='avg')['result'][0]['values'] )
+        self.assertEqual( [[7200, '3660'], [10800, '7260'], [14400, '10860']], iut.query(self.url, 'q', 7200, 14400, 3600, agg='min')['result'][0]['values'] )
+        self.assertEqual( [[7200, '7200'], [10800, '10800'], [14400, '14400']], iut.query(self.url, 'q', 7200, 14400, 3600)['result'][0]['values'] )
+        self.assertEqual( [[14400, '10830']], iut.query(self.url, 'q', 14400, 14400, 7200, agg='avg')['result'][0]['values'] )
+        self.assertEqual( 180, len(iut.query(self.url, 'q', 3660, 14400, 60)['result'][0]['values']) )
+        self.assertEqual( 1, len(fetch.calls) )
+
+        # Extending the window fetches only what's new
+        iut.query(self.url, 'q', 7200, 21600, 3600, fetch=fetch)
+        self.assertEqual( (14460, 21600), fetch.calls[-1] )
+
+        stats = iut.stats()
+        self.assertEqual( (5, 3), (stats['hits'], stats['misses']) )
+        self.assertEqual( [1, 1], [ tier['queries'] for tier in stats['tiers'] ] )
+
+    def test_ingest_complete_buckets_only(self):
+        iut = RollupCache(self.cache_path, tiers=self.tiers)
+
+        # 1m samples from 1800 to 9000 only complete the hourly bucket ending 7200
+        iut.ingest(self.url, 'q', FakeFetch()(1800, 9000), 1800, 9000, 60)
+        self.assertIsNotNone( iut.query(self.url, 'q', 7200, 7200, 3600) )
+        self.assertIsNone( iut.query(self.url, 'q', 3600, 7200, 3600) )
+        self.assertIsNone( iut.query(self.url, 'q', 7200, 10800, 3600) )
+
+        # Coarser steps than the finest tier's aren't rolled up
+        iut.ingest(self.url, 'r', FakeFetch()(0, 36000, 3600), 0, 36000, 3600)
+        self.assertIsNone( iut.query(self.url, 'r', 7200, 7200, 3600) )
+
+    def test_retention(self):
+        iut = RollupCache(self.cache_path, tiers=((60, 3600, 1 << 30),))
+        end = math.floor((time.time() - 600) / 60) * 60
+        iut.ingest(self.url, 'q', FakeFetch()(end - 7200, end), end - 7200, end, 60)
+
+        self.assertIsNotNone( iut.query(self.url, 'q', end - 1800, end, 60) )
+        self.assertIsNone( iut.query(self.url, 'q', end - 5400, end, 60) )
+
+    def test_size_limit_evicts_least_recently_used(self):
+        iut = RollupCache(self.cache_path, tiers=((60, None, 1 << 30),))
+        iut.ingest(self.url, 'a', FakeFetch()(0, 36000), 0, 36000, 60)
+        nbytes = iut.stats()['tiers'][0]['bytes']
+
+        iut = RollupCache(self.cache_path, tiers=((60, None, int(nbytes * 1.5)),))
+        past = time.time() - 100
+        os.utime(iut._key_file(60, self.url, 'a'), (past, past))
+        iut.ingest(self.url, 'b', FakeFetch()(0, 36000), 0, 36000, 60)
+
+        self.assertIsNone( iut.query(self.url, 'a', 3600, 36000, 60) )
+        self.assertIsNotNone( iut.query(self.url, 'b', 3600, 36000, 60) )
+        self.assertEqual( 1, iut.stats()['tiers'][0]['queries'] )
+
+
+if (__name__ == '__main__'):
+    unittest.main()
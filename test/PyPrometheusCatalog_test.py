@@ -0,0 +1,90 @@
+import unittest
+from PyPrometheusCatalog import MetricCatalog
+from pathlib import Path
+import time
+
+
+def delete_folder(pth:Path) -> None:
+    if (pth.exists()):
+        for sub in pth.iterdir():
+            if (sub.is_dir()):
+                delete_folder(sub)
+            else:
+                sub.unlink()
+        pth.rmdir()
+    return
+
+
+class CountingLoader:
+    names = ['node_load1', 'node_load5', 'node_network_receive_bytes_total', 'node_network_transmit_bytes_total', 'up']
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return list(self.names)
+
+
+class TestMetricCatalog(unittest.TestCase):
+
+    catalog_path = Path('./test/PyPrometheusCatalog/catalog.json')
+
+    def setUp(self) -> None:
+        delete_folder(self.catalog_path.parent)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        delete_folder(self.catalog_path.parent)
+        return super().tearDown()
+
+    def test_lookups(self):
+        iut = MetricCatalog(CountingLoader())
+
+        self.assertIn( 'up', iut )
+        self.assertNotIn( 'down', iut )
+        self.assertEqual( 5, len(iut) )
+        self.assertEqual( ['node_load1', 'node_load5'], iut.prefix('node_load') )
+        self.assertEqual( [], iut.prefix('zzz') )
+        self.assertEqual( ['node_network_receive_bytes_total'], iut.regex(r'node_network_rec.*') )
+        self.assertEqual( ['node_network_receive_bytes_total', 'node_network_transmit_bytes_total', 'up'],
+                          iut.containing(['_bytes_total', 'up']) )
+        self.assertEqual( [], iut.containing([]) )
+
+    def test_lazy_load(self):
+        loader = CountingLoader()
+        iut = MetricCatalog(loader)
+        self.assertEqual( 0, loader.calls )
+
+        self.assertIn( 'up', iut )
+        self.assertIn( 'node_load1', iut )
+        self.assertEqual( 1, loader.calls )
+
+    def test_persisted_catalog_reused(self):
+        first = CountingLoader()
+        MetricCatalog(first, path=self.catalog_path, ttl=3600).refresh()
+        self.assertEqual( 1, first.calls )
+        self.assertTrue( self.catalog_path.exists() )
+
+        # A second catalog picks up the persisted names without going to the loader
+        second = CountingLoader()
+        iut = MetricCatalog(second, path=self.catalog_path, ttl=3600)
+        self.assertIn( 'node_load5', iut )
+        self.assertEqual( 0, second.calls )
+
+        # ... unless asked to
+        iut.refresh(force=True)
+        self.assertEqual( 1, second.calls )
+
+    def test_expired_catalog_refreshed(self):
+        loader = CountingLoader()
+        iut = MetricCatalog(loader, path=self.catalog_path, ttl=1)
+        iut.refresh()
+
+        time.sleep(1.1)
+        self.assertIn( 'up', iut )
+        self.assertEqual( 2, loader.calls )
+
+
+if (__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,123 @@
+import unittest
+from PyPrometheusFederation import FederatedQueryClient
+from fake_prometheus import FakePrometheusServer
+import time
+
+
+class TestFederatedQueryClient(unittest.TestCase):
+
+    window = ('2022-02-16T00:00:00Z', '2022-02-16T01:00:00Z', '1m')
+
+    def setUp(self) -> None:
+        extra = ['node_cpu_seconds_total']
+        self.servers = { name: FakePrometheusServer(metrics=1, series=2, extra_metrics=extra).start() for name in ['eu-a', 'eu-b', 'us'] }
+        self.servers['slow'] = FakePrometheusServer(metrics=1, series=2, latency=2, extra_metrics=extra).start()
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        for server in self.servers.values():
+            server.stop()
+        return super().tearDown()
+
+    def _instantiate_instance(self, names, **kwargs):
+        endpoints = { name: [ self.servers[n].url for n in names[name] ] for name in names }
+        return FederatedQueryClient(endpoints, retries=0, **kwargs)
+
+    def test_query_range_merges_with_source(self):
+        with self._instantiate_instance({'eu': ['eu-a'], 'us': ['us']}) as iut:
+            results = iut.query_range('metric_0000', *self.window)
+
+        self.assertEqual( {}, results['errors'] )
+        self.assertEqual( 4, len(results['result']) )
+        self.assertEqual( ['eu', 'eu', 'us', 'us'], sorted(series['metric']['source'] for series in results['result']) )
+        self.assertEqual( 61, len(results['result'][0]['values']) )
+
+    def test_ha_replicas_deduplicated(self):
+        with self._instantiate_instance({'eu': ['eu-a', 'eu-b']}) as iut:
+            results = iut.query_range('metric_0000', *self.window)
+
+        # Both replicas were asked, and their identical series merged
+        self.assertEqual( 1, len(self.servers['eu-a'].requests) )
+        self.assertEqual( 1, len(self.servers['eu-b'].requests) )
+        self.assertEqual( 2, len(results['result']) )
+        self.assertEqual( 61, len(results['result'][0]['values']) )
+
+    def test_merge_fills_replica_gaps(self):
+        with self._instantiate_instance({'eu': ['eu-a']}, replica_labels=['replica']) as iut:
+            a = {'result': [ {'metric': {'__name__': 'm', 'replica': 'a'}, 'values': [[0, '1'], [120, '3']]} ]}
+            b = {'result': [ {'metric': {'__name__': 'm', 'replica': 'b'}, 'values': [[0, '9'], [60, '2']]} ]}
+            merged = iut._merge({'eu': [a, b]})
+
+        # The first replica's samples are preferred, with the second filling its gap
+        self.assertEqual( [ {'metric': {'__name__': 'm', 'source': 'eu'}, 'values': [[0, '1'], [60, '2'], [120, '3']]} ], merged )
+
+    def test_failed_replica_tolerated(self):
+        self.servers['eu-b'].stop()
+        with self._instantiate_instance({'eu': ['eu-a', 'eu-b'], 'us': ['us']}) as iut:
+            results = iut.query_range('metric_0000', *self.window)
+
+        self.assertEqual( [self.servers['eu-b'].url], list(results['errors']) )
+        self.assertEqual( 4, len(results['result']) )
+        self.servers['eu-b'].start()
+
+    def test_slow_endpoint_times_out(self):
+        with self._instantiate_instance({'us': ['us'], 'slow': ['slow']}, timeout={'slow': 0.5}) as iut:
+            t0 = time.time()
+            results = iut.query_range('metric_0000', *self.window)
+
+            self.assertLess( time.time() - t0, 1.5 )
+            self.assertEqual( [self.servers['slow'].url], list(results['errors']) )
+            self.assertEqual( ['us', 'us'], [ series['metric']['source'] for series in results['result'] ] )
+
+    def test_slow_endpoint_repeated_calls(self):
+        # The slow endpoint's abandoned requests mustn't hold up the others on later calls, and with its
+        # retries limited to the timeout, nor pile up
+        endpoints = {'us': self.servers['us'].url, 'slow': self.servers['slow'].url}
+        with FederatedQueryClient(endpoints, timeout=0.5) as iut:
+            for _ in range(4):
+                t0 = time.time()
+                results = iut.query_range('metric_0000', *self.window)
+
+                self.assertLess( time.time() - t0, 1.5 )
+                self.assertEqual( [self.servers['slow'].url], list(results['errors']) )
+                self.assertEqual( ['us', 'us'], [ series['metric']['source'] for series in results['result'] ] )
+
+        # At most one request a call (later calls may share one still in flight), i.e. none retried
+        self.assertLessEqual( len(self.servers['slow'].requests), 4 )
+
+    def test_all_endpoints_failed(self):
+        self.servers['us'].stop()
+        with self._instantiate_instance({'us': ['us']}) as iut:
+            self.assertRaises( RuntimeError, iut.query_range, 'metric_0000', *self.window )
+        self.servers['us'].start()
+
+    def test_get_metric(self):
+        with self._instantiate_instance({'eu': ['eu-a'], 'us': ['us']}) as iut:
+            (results, df) = iut.get_metric('node_cpu_seconds_total', *self.window)
+            self.assertRaises( ValueError, iut.get_metric, 'unknown', *self.window )
+
+        self.assertIn( 'node_cpu_seconds_total - eu, host0000:9100', df.columns )
+        self.assertIn( 'delta_node_cpu_seconds_total - us, host0001:9100', df.columns )
+        self.assertEqual( 8, len(df.columns) )
+
+    def test_get_metric_endpoint_failed(self):
+        self.servers['us'].stop()
+        with self._instantiate_instance({'eu': ['eu-a'], 'us': ['us']}) as iut:
+            # Unknown to the endpoint which answered
+            self.assertRaises( ValueError, iut.get_metric, 'unknown', *self.window )
+
+
+        # With no endpoint to ask, the outage is reported rather than the metric being unknown
+        self.servers['eu-a'].stop()
+        with self._instantiate_instance({'eu': ['eu-a'], 'us': ['us']}) as iut:
+            with self.assertRaisesRegex(RuntimeError, 'All endpoints failed') as raised:
+                iut.get_metric('node_cpu_seconds_total', *self.window)
+            self.assertIn( self.servers['eu-a'].url, str(raised.exception) )
+            self.assertIn( self.servers['us'].url, str(raised.exception) )
+
+        self.servers['eu-a'].start()
+        self.servers['us'].start()
+
+
+if (__name__ == '__main__'):
+    unittest.main()
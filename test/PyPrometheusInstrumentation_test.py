@@ -0,0 +1,124 @@
+import unittest
+from PyPrometheusInstrumentation import Instrumentation
+import PyPrometheusInstrumentation as instrumentation
+from PyPrometheusQueryClient import PrometheusQueryClient
+from fake_prometheus import FakePrometheusServer
+from pathlib import Path
+
+
+def delete_folder(pth:Path) -> None:
+    if (pth.exists()):
+        for sub in pth.iterdir():
+            if (sub.is_dir()):
+                delete_folder(sub)
+            else:
+                sub.unlink()
+        pth.rmdir()
+    return
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_call_records_phases(self):
+        seen = []
+        iut = Instrumentation(listeners=[seen.append])
+
+        with iut.call('outer', 'up') as record:
+            with instrumentation.phase('decode'):
+                pass
+            # Nested calls add to the outer record
+            with iut.call('inner') as inner:
+                self.assertIs( record, inner )
+                instrumentation.record_cache(hit=True)
+
+        self.assertIsNone( instrumentation.current() )
+        self.assertEqual( [record], seen )
+        self.assertEqual( 'outer', record.name )
+        self.assertIn( 'decode', record.phases )
+        self.assertEqual( 1, record.cache_hits )
+        self.assertGreaterEqual( record.duration, record.phases['decode'] )
+
+    def test_call_records_errors(self):
+        iut = Instrumentation()
+        with self.assertRaises(ValueError):
+            with iut.call('failing'):
+                raise ValueError('bad')
+
+        self.assertEqual( 'ValueError: bad', iut.records[0].error )
+        self.assertEqual( 1, iut.summary()['errors'] )
+
+    def test_phase_without_call(self):
+        # Outside of a call the helpers do nothing
+        with instrumentation.phase('decode'):
+            pass
+        instrumentation.record_cache(hit=False)
+        self.assertIsNone( instrumentation.current() )
+
+    def test_summary_and_prometheus_export(self):
+        iut = Instrumentation(max_records=2)
+        for name in ['a', 'b', 'c']:
+            with iut.call('query_range', name) as record:
+                record.add('server', 0.5)
+                record.add_request(100)
+
+        summary = iut.summary(slowest=1)
+        self.assertEqual( 2, summary['calls'] )
+        self.assertEqual( {'count': 2, 'total': 1.0, 'max': 0.5, 'mean': 0.5}, summary['phases']['server'] )
+        self.assertEqual( 200, summary['bytes'] )
+        self.assertEqual( 1, len(summary['slowest']) )
+
+        # The exported totals cover every call, not just those retained
+        text = iut.to_prometheus()
+        self.assertIn( 'pyprometheus_client_call_duration_seconds_count{call="query_range"} 3\n', text )
+        self.assertIn( 'pyprometheus_client_phase_duration_seconds_sum{phase="server"} 1.5\n', text )
+        self.assertIn( 'pyprometheus_client_response_bytes_total 300\n', text )
+        self.assertIn( 'pyprometheus_client_cache_lookups_total{result="hit"} 0\n', text )
+
+
+class TestInstrumentedClient(unittest.TestCase):
+
+    cache_path = Path('./test/PyPrometheusInstrumentation')
+
+    def setUp(self) -> None:
+        delete_folder(self.cache_path)
+        self.server = FakePrometheusServer(metrics=1, series=3, extra_metrics=['node_cpu_seconds_total']).start()
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.server.stop()
+        delete_folder(self.cache_path)
+        return super().tearDown()
+
+    def test_get_metric_breakdown(self):
+        iut = Instrumentation()
+        pqc = PrometheusQueryClient(self.server.url, cache_path=self.cache_path, instrumentation=iut)
+
+        for _ in range(2):
+            pqc.get_metric('node_cpu_seconds_total', start='2022-02-16T00:00:00Z', end='2022-02-16T01:00:00Z', step='15s')
+
+        (miss, hit) = list(iut.records)[-2:]
+        self.assertEqual( 'get_metric', miss.name )
+        # The connection was made, outside of the call, to fetch the metric catalog
+        self.assertEqual( {'server', 'transfer', 'decode', 'dataframe', 'deltas'}, set(miss.phases) )
+        self.assertEqual( 1, miss.requests )
+        self.assertGreater( miss.bytes, 0 )
+        self.assertEqual( (0, 1), (miss.cache_hits, miss.cache_misses) )
+
+        # Answered from the range cache, over no requests
+        self.assertEqual( (1, 0), (hit.cache_hits, hit.cache_misses) )
+        self.assertEqual( 0, hit.requests )
+        self.assertNotIn( 'server', hit.phases )
+
+    def test_sharded_query_breakdown(self):
+        iut = Instrumentation()
+        pqc = PrometheusQueryClient(self.server.url, auto_get_server_metrics=False, instrumentation=iut)
+
+        # Three shards, fetched on worker threads, all recorded against the one call
+        pqc.query_range('metric_0000', '2022-01-01T00:00:00Z', '2022-01-05T00:00:00Z', '15s')
+        self.assertEqual( 1, len(iut.records) )
+        self.assertEqual( 3, iut.records[0].requests )
+        self.assertIn( 'connect', iut.records[0].phases )
+
+
+if (__name__ == '__main__'):
+    unittest.main()
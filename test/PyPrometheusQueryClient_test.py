@@ -4,6 +4,11 @@ from pathlib import Path
 import urllib3
 from datetime import datetime, timedelta
 import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
 
 urllib3.disable_warnings()
 
@@ -99,6 +104,335 @@ class TestPyPrometheusQueryClient(unittest.TestCase):
         actual = PrometheusQueryClient._datetime_to_str(t)
         self.assertEqual(expected, actual)
 
+    def test__step_to_seconds(self):
+        self.assertEqual( 5.0, PrometheusQueryClient._step_to_seconds(5) )
+        self.assertEqual( 15.0, PrometheusQueryClient._step_to_seconds('15') )
+        self.assertEqual( 5400.0, PrometheusQueryClient._step_to_seconds('1h30m') )
+        self.assertRaises( ValueError, PrometheusQueryClient._step_to_seconds, '5 minutes' )
+
+    def test__result_to_frame(self):
+        results = {'resultType': 'matrix', 'result': [
+            {'metric': {'__name__': 'm', 'instance': 'a'}, 'values': [[1645000000, '1.5'], [1645000015.5, 'NaN'], [1645000030, '+Inf']]},
+            {'metric': {'__name__': 'm', 'instance': 'b'}, 'values': [[1645000015.5, '-Inf']]},
+        ]}
+
+        df = PrometheusQueryClient._result_to_frame(results)
+
+        self.assertEqual( ['m - a', 'm - b'], list(df.columns) )
+        self.assertEqual( pd.Timestamp(1645000015.5, unit='s'), df.index[1] )
+        self.assertEqual( 1.5, df['m - a'].iloc[0] )
+        self.assertTrue( np.isnan(df['m - a'].iloc[1]) )
+        self.assertEqual( np.inf, df['m - a'].iloc[2] )
+        self.assertEqual( -np.inf, df['m - b'].iloc[1] )
+
+    def test__column_names(self):
+        metrics = [ {'__name__': 'cpu', 'instance': 'a', 'cpu': '0', 'mode': 'idle'},
+                    {'__name__': 'cpu', 'instance': 'a', 'cpu': '0', 'mode': 'user'},
+                    {'__name__': 'cpu', 'instance': 'b', 'cpu': '0', 'mode': 'idle'} ]
+
+        # Series sharing an instance are told apart by the labels that differ between them
+        self.assertEqual( ['cpu - a, mode=idle', 'cpu - a, mode=user', 'cpu - b'], PrometheusQueryClient._column_names(metrics) )
+        self.assertEqual( ['cpu - idle, a', 'cpu - user, a', 'cpu - idle, b'], PrometheusQueryClient._column_names(metrics, labels=['mode', 'instance']) )
+
+        df = PrometheusQueryClient._result_to_frame({'result': [ {'metric': metric, 'values': [[0, '1']]} for metric in metrics ]})
+        self.assertEqual( 3, len(df.columns) )
+
+    def test__compute_deltas(self):
+        index = pd.to_datetime(np.array([0, 15, 30, 45], dtype=np.float64), unit='s')
+        df = pd.DataFrame({'c': [1.0, 5.0, 2.0, 4.0]}, index=index)
+
+        plain = PrometheusQueryClient._compute_deltas(df)
+        self.assertEqual( [0.0, 4.0, -3.0, 2.0], plain['delta_c'].to_list() )
+
+        # A counter reset contributes the post-reset value, as PromQL increase() does
+        counter = PrometheusQueryClient._compute_deltas(df, counter=True, rate=True)
+        self.assertEqual( [0.0, 4.0, 2.0, 2.0], counter['delta_c'].to_list() )
+        self.assertAlmostEqual( 2.0 / 15, counter['rate_c'].iloc[3] )
+
+    def test__iter_result_stream(self):
+        result = [ {'metric': {'__name__': 'm', 'instance': str(i)}, 'values': [[t, '1'] for t in range(100)]} for i in range(5) ]
+        body = json.dumps({'status': 'success', 'data': {'resultType': 'matrix', 'result': result}}).encode('UTF-8')
+
+        # Chunk boundaries must not matter, even when they split a series or a multi-byte character
+        for size in [1, 64, len(body)]:
+            chunks = [ body[i:i + size] for i in range(0, len(body), size) ]
+            self.assertEqual( result, list(PrometheusQueryClient._iter_result_stream(chunks)) )
+
+        error = json.dumps({'status': 'error', 'errorType': 'bad_data', 'error': 'oops'}).encode('UTF-8')
+        self.assertRaises( RuntimeError, list, PrometheusQueryClient._iter_result_stream([error]) )
+        self.assertRaises( RuntimeError, list, PrometheusQueryClient._iter_result_stream([body[:len(body) // 2]]) )
+
+    def test_query_range_sharded(self):
+        opts = dict(self.default_opts, auto_get_server_metrics=False, cache_path=None)
+        iut = self._instantiate_instance(opts)
+
+        calls = []
+        def fake_do_query(path, params):
+            calls.append( (params['start'], params['end']) )
+            ts = range(int(params['start']), int(params['end']) + 1, 60)
+            return {'resultType': 'matrix', 'result': [{'metric': {'__name__': 'm'}, 'values': [[t, '1'] for t in ts]}]}
+        iut._do_query = fake_do_query
+
+        # 30 days at 1m is well over the 11,000 points per series limit
+        results = iut.query_range('m', 0, 30 * 86400, '1m')
+
+        self.assertEqual( 4, len(calls) )
+        self.assertTrue( all( (end - start) / 60 + 1 <= iut.max_points_per_query for (start, end) in calls ) )
+        self.assertEqual( 30 * 1440 + 1, len(results['result'][0]['values']) )
+
+    def test_frame_cache(self):
+        iut = PrometheusQueryClient(url=self.default_opts['url'], auto_get_server_metrics=False, frame_cache_bytes=1 << 20)
+
+        calls = []
+        def fake_do_query(path, params):
+            calls.append( params['query'] )
+            ts = range(int(params['start']), int(params['end']) + 1, 60)
+            return {'resultType': 'matrix', 'result': [{'metric': {'__name__': 'm'}, 'values': [[t, str(t)] for t in ts]}]}
+        iut._do_query = fake_do_query
+
+        window = ('2022-02-16T00:00:00Z', '2022-02-16T01:00:00Z', '1m')
+        (_, first) = iut.get_with_deltas('m_total', *window)
+        first['scratch'] = 0
+        (_, second) = iut.get_with_deltas('m_total', *window)
+
+        # Served from memory, and unaffected by changes to the frame handed out before
+        self.assertEqual( 1, len(calls) )
+        self.assertNotIn( 'scratch', second.columns )
+        self.assertEqual( ['m - ', 'delta_m - '], list(second.columns) )
+
+        # Without deltas is a different entry (built while computing the first), then a different window
+        iut.get_without_deltas('m_total', *window)
+        iut.get_without_deltas('m_total', '2022-02-16T00:00:00Z', '2022-02-16T02:00:00Z', '1m')
+        self.assertEqual( 2, len(calls) )
+        self.assertEqual( 2, iut.frame_cache_stats()['hits'] )
+
+    def test_query_range_coalesced(self):
+        iut = PrometheusQueryClient(url=self.default_opts['url'], auto_get_server_metrics=False)
+
+        calls = []
+        release = threading.Event()
+        def fake_do_query(path, params):
+            calls.append( params['query'] )
+            release.wait(5)
+            if (params['query'] == 'bad'):
+                raise RuntimeError('bad_data: oops')
+            return {'resultType': 'matrix', 'result': [{'metric': {'__name__': params['query']}, 'values': [[params['start'], '1']]}]}
+        iut._do_query = fake_do_query
+
+        window = ('2022-02-16T00:00:00Z', '2022-02-16T01:00:00Z', '1m')
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [ executor.submit(iut.query_range, query, *window) for query in ['m'] * 6 + ['n', 'bad'] ]
+            deadline = time.time() + 5
+            while ((iut.connection_stats()['coalesced'] < 5 or len(calls) < 3) and time.time() < deadline):
+                time.sleep(0.01)
+            release.set()
+
+        # One fetch for each distinct query, with every caller getting its result or its exception
+        self.assertEqual( ['bad', 'm', 'n'], sorted(calls) )
+        self.assertTrue( all(future.result() is futures[0].result() for future in futures[:6]) )
+        self.assertEqual( 'n', futures[6].result()['result'][0]['metric']['__name__'] )
+        self.assertRaises( RuntimeError, futures[7].result )
+
+        # Once complete, the same query is fetched again
+        iut.query_range('m', *window)
+        self.assertEqual( 4, len(calls) )
+
+    def test_query(self):
+        from fake_prometheus import FakePrometheusServer
+
+        with FakePrometheusServer(metrics=2, series=2) as server:
+            iut = PrometheusQueryClient(url=server.url, auto_get_server_metrics=False)
+            results = iut.query('metric_0001', time='2022-02-16T00:00:00Z')
+
+            self.assertEqual( ('api/v1/query', {'query': 'metric_0001', 'time': '2022-02-16T00:00:00Z'}), (server.requests[0][0][1:], server.requests[0][1]) )
+            self.assertEqual( 'vector', results['resultType'] )
+            self.assertEqual( [1644969600.0, 1644969600.0], [ r['value'][0] for r in results['result'] ] )
+
+    def test_retry_backoff(self):
+        from fake_prometheus import FakePrometheusServer
+
+        unavailable = (503, 'text/html', b'<html>Service Unavailable</html>')
+        with FakePrometheusServer(metrics=2, series=2, failures=[unavailable] * 2) as server:
+            iut = PrometheusQueryClient(url=server.url, auto_get_server_metrics=False, retries=3, backoff_factor=0.05)
+
+            began = time.time()
+            results = iut.query('metric_0001', time='2022-02-16T00:00:00Z')
+            elapsed = time.time() - began
+
+            # Retried twice, backing off in between, over the one kept-alive connection
+            self.assertEqual( 2, len(results['result']) )
+            self.assertEqual( 3, len(server.requests) )
+            self.assertGreaterEqual( elapsed, 0.1 )
+
+            iut.query('metric_0000', time='2022-02-16T00:00:00Z')
+            stats = iut.connection_stats()
+            self.assertEqual( 2, stats['retries'] )
+            self.assertEqual( 4, stats['requests'] )
+            self.assertEqual( 1, stats['new_connections'] )
+            self.assertEqual( 3, stats['reused_connections'] )
+
+    def test_retries_exhausted(self):
+        from fake_prometheus import FakePrometheusServer
+
+        unavailable = (503, 'text/html', b'<html>Service Unavailable</html>')
+        with FakePrometheusServer(metrics=2, series=2, failures=[unavailable] * 3) as server:
+            iut = PrometheusQueryClient(url=server.url, auto_get_server_metrics=False, retries=2, backoff_factor=0)
+
+            with self.assertRaisesRegex(RuntimeError, 'HTTP 503: <html>Service Unavailable</html>'):
+                iut.query('metric_0001')
+            self.assertEqual( 3, len(server.requests) )
+
+            # Prometheus' own errors are still reported as such
+            with self.assertRaisesRegex(RuntimeError, 'bad_data: exceeded maximum resolution'):
+                iut._do_query('api/v1/query_range', {'query': 'metric_0001', 'start': 0, 'end': 86400, 'step': 1})
+
+    def test_retries_exhausted_stream(self):
+        from fake_prometheus import FakePrometheusServer
+
+        unavailable = (503, 'text/html', b'<html>Service Unavailable</html>')
+        window = ('metric_0001', '2022-02-16T00:00:00Z', '2022-02-16T01:00:00Z', '1m')
+        with FakePrometheusServer(metrics=2, series=2, failures=[unavailable] * 6) as server:
+            iut = PrometheusQueryClient(url=server.url, auto_get_server_metrics=False, retries=2, backoff_factor=0)
+
+            # The streamed and raw responses are checked as the decoded ones are
+            with self.assertRaisesRegex(RuntimeError, 'HTTP 503: <html>Service Unavailable</html>'):
+                list(iut.query_range_stream(*window))
+            with self.assertRaisesRegex(RuntimeError, 'HTTP 503: <html>Service Unavailable</html>'):
+                iut.query_range_raw(*window)
+
+            # Once the server recovers, the stream is decoded as before
+            self.assertEqual( 2, len(list(iut.query_range_stream(*window))) )
+
+    def test_metrics_catalog_deferred(self):
+        from fake_prometheus import FakePrometheusServer
+
+        with FakePrometheusServer(metrics=2, series=1, extra_metrics=['node_cpu_seconds_total']) as server:
+            iut = PrometheusQueryClient(url=server.url, auto_get_server_metrics=False)
+            self.assertEqual( [], server.requests )
+
+            # The public catalog is loaded on first use, once
+            self.assertIn( 'metric_0001', iut.metrics )
+            self.assertNotIn( 'unknown', iut.metrics )
+            self.assertEqual( ['node_cpu_seconds_total'], iut.get_metrics_starting_with(['cpu']) )
+            self.assertEqual( 3, len(iut.metrics) )
+            self.assertEqual( 1, len(server.requests) )
+
+    def test_snapshot(self):
+        from fake_prometheus import FakePrometheusServer
+
+        with FakePrometheusServer(metrics=5, series=2) as server:
+            iut = PrometheusQueryClient(url=server.url, auto_get_server_metrics=False)
+            iut.max_metrics_per_selector = 2
+            (results, df) = iut.snapshot(server.metric_names(), time='2022-02-16T00:00:00Z')
+
+            # Three selectors for five metrics, with every series in the one frame
+            self.assertEqual( 3, len(server.requests) )
+            self.assertEqual( 10, len(results['result']) )
+            self.assertEqual( ['timestamp', 'value'], list(df.columns) )
+            self.assertEqual( 'metric_0000 - host0000:9100', df.index[0] )
+            self.assertEqual( pd.Timestamp('2022-02-16T00:00:00'), df['timestamp'].iloc[-1] )
+            self.assertAlmostEqual( float(results['result'][-1]['value'][1]), df['value'].iloc[-1] )
+
+            (results, df) = iut.snapshot([])
+            self.assertEqual( (0, 2), df.shape )
+
+    def test_cardinality_guard(self):
+        from fake_prometheus import FakePrometheusServer
+
+        window = ('2022-02-16T00:00:00Z', '2022-02-16T01:00:00Z', '1m')
+        with FakePrometheusServer(metrics=1, series=5) as server:
+            iut = PrometheusQueryClient(url=server.url, auto_get_server_metrics=False, max_series=4)
+            self.assertEqual( 5, iut.count_series('metric_0000') )
+
+            # Rejected on the count alone, without fetching the range
+            self.assertRaises( ValueError, iut.get_without_deltas, 'metric_0000', *window )
+            self.assertEqual( ['/api/v1/query', '/api/v1/series'], [ path for (path, _) in server.requests ] )
+
+            (_, df) = iut.get_with_deltas('metric_0000', *window, max_series=5, labels=['job', 'instance'])
+            self.assertEqual( 'metric_0000 - node, host0000:9100', df.columns[0] )
+            self.assertEqual( 10, len(df.columns) )
+
+    def test_cardinality_guard_churn(self):
+        from fake_prometheus import FakePrometheusServer
+
+        # Two series at a time, replaced every half hour, so three sets of them over the hour
+        window = ('2022-02-16T00:00:00Z', '2022-02-16T01:00:00Z', '1m')
+        with FakePrometheusServer(metrics=1, series=2, churn=1800) as server:
+            iut = PrometheusQueryClient(url=server.url, auto_get_server_metrics=False)
+            self.assertEqual( 2, iut.count_series('metric_0000', time=window[1]) )
+            self.assertEqual( 6, iut.count_series('metric_0000', time=window[1], start=window[0]) )
+            self.assertEqual( 6, iut.count_series('rate(metric_0000[5m])', time=window[1], start=window[0], step='1m') )
+            self.assertEqual( 'count(last_over_time((rate(metric_0000[5m]))[3600000ms:60000ms]))', server.requests[-1][1]['query'] )
+
+            # Each is rejected on the series over the whole window, not just those at its end
+            for query in ['metric_0000', 'rate(metric_0000[5m])']:
+                self.assertRaises( ValueError, iut.get_without_deltas, query, *window, max_series=4 )
+
+            (results, _) = iut.get_without_deltas('metric_0000', *window, max_series=6)
+            self.assertEqual( 6, len(results['result']) )
+
+    def test_remote_read(self):
+        from fake_prometheus import FakePrometheusServer
+
+        window = ('2022-02-16T00:00:00Z', '2022-02-16T02:00:00Z')
+        selector = 'metric_0001{instance=~"host000[12]:9100"}'
+        for streamed_read in [True, False]:
+            with FakePrometheusServer(metrics=2, series=4, streamed_read=streamed_read) as server:
+                iut = PrometheusQueryClient(url=server.url, auto_get_server_metrics=False)
+                series = iut.remote_read(selector, *window)
+                streamed = list(iut.remote_read_stream(selector, *window))
+                results = iut.query_range('metric_0001', *window, '15s')
+
+                # The raw samples, every 15s, match a range query at that step
+                self.assertEqual( ['host0001:9100', 'host0002:9100'], [ s['metric']['instance'] for s in series ] )
+                self.assertEqual( 481, len(series[0]['timestamps']) )
+                self.assertEqual( 1644969600000, series[0]['timestamps'][0] )
+                self.assertEqual( [ float(v) for (_, v) in results['result'][2]['values'] ], series[1]['values'].tolist() )
+
+                for (a, b) in zip(series, streamed):
+                    self.assertEqual( a['metric'], b['metric'] )
+                    self.assertEqual( a['timestamps'].tolist(), b['timestamps'].tolist() )
+                    self.assertEqual( a['values'].tolist(), b['values'].tolist() )
+
+                (_, df) = iut.get_raw('metric_0000', *window)
+                self.assertEqual( (481, 4), df.shape )
+                self.assertEqual( pd.Timestamp('2022-02-16T00:00:15'), df.index[1] )
+                self.assertEqual( 'metric_0000 - host0003:9100', df.columns[-1] )
+
+                self.assertRaises( ValueError, iut.remote_read, 'rate(metric_0000[5m])', *window )
+
+    def test_rollups(self):
+        from fake_prometheus import FakePrometheusServer
+
+        self.addCleanup(delete_folder, self.test_config['cache_path'])
+        tiers = [('1m', None, 1 << 30), ('1h', None, 1 << 30)]
+        window = ('2022-02-01T00:00:00Z', '2022-02-08T00:00:00Z')
+        self.assertRaises( ValueError, PrometheusQueryClient, url='http://localhost:9090/', rollup_tiers=tiers )
+
+        with FakePrometheusServer(metrics=1, series=2) as server:
+            iut = PrometheusQueryClient(url=server.url, cache_path=self.test_config['cache_path'], auto_get_server_metrics=False, rollup_tiers=tiers)
+
+            # Fetched at the finest tier's resolution, and rolled up into both tiers
+            (results, df) = iut.get_rollup('metric_0000', *window, step='1h', agg='max')
+            self.assertEqual( ['60s'], [ params['step'] for (_, params) in server.requests ] )
+            self.assertEqual( (169, 2), df.shape )
+            self.assertEqual( 'metric_0000 - host0000:9100', df.columns[0] )
+            requests = len(server.requests)
+
+            # Other aggregations and coarser steps, and range queries at multiples of 1h, are answered locally
+            (_, daily) = iut.get_rollup('metric_0000', '2022-02-02T00:00:00Z', window[1], step='1d', agg='avg')
+            self.assertEqual( 7, len(daily) )
+            local = iut.query_range('metric_0000', *window, '1h')
+            self.assertEqual( requests, len(server.requests) )
+
+            # ... with the values the server would return
+            remote = PrometheusQueryClient(url=server.url, auto_get_server_metrics=False).query_range('metric_0000', *window, '1h')
+            self.assertEqual( [ [float(ts), float(v)] for (ts, v) in remote['result'][1]['values'] ],
+                              [ [float(ts), float(v)] for (ts, v) in local['result'][1]['values'] ] )
+            self.assertEqual( (2, 1), (iut.rollup_stats()['hits'], iut.rollup_stats()['misses']) )
+
+            self.assertRaises( ValueError, iut.get_rollup, 'metric_0000', *window, step='90s' )
+
     @unittest.skip
     def test__get_all_metrics(self):
         #
@@ -112,7 +446,7 @@ class TestPyPrometheusQueryClient(unittest.TestCase):
 
         # Check that we have not metrics set 
         self.assertTrue( hasattr(iut, 'metrics' ) )
-        self.assertIsNone( iut.metrics )
+        self.assertIsNone( iut.metrics._loaded_at )
 
         # Call _get_all_metrics()
         self.assertTrue( hasattr(iut, '_get_all_metrics' ) )
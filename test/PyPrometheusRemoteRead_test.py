@@ -0,0 +1,93 @@
+import unittest
+import struct
+import numpy as np
+import PyPrometheusRemoteRead as remote_read
+from fake_prometheus import FakePrometheusServer, xor_encode, crc32c
+
+
+def timeseries(labels, samples):
+    return remote_read.encode_field(1, FakePrometheusServer._encode_labels(labels) +
+                                    b''.join( remote_read.encode_field(2, FakePrometheusServer._encode_sample(ts, v)) for (ts, v) in samples ))
+
+
+class TestRemoteRead(unittest.TestCase):
+
+    def test_parse_selector(self):
+        self.assertEqual( [(0, '__name__', 'up')], remote_read.parse_selector('up') )
+        self.assertEqual( [(0, '__name__', 'up'), (0, 'job', 'node'), (2, 'instance', 'a.*'), (1, 'x', 'q"z'), (3, 'y', '')],
+                          remote_read.parse_selector('up{job="node", instance=~"a.*",x!="q\\"z", y!~""}') )
+        self.assertEqual( [(2, '__name__', 'a|b')], remote_read.parse_selector('{__name__=~"a|b"}') )
+        self.assertRaises( ValueError, remote_read.parse_selector, 'rate(up[5m])' )
+        self.assertRaises( ValueError, remote_read.parse_selector, 'up{job=node}' )
+        self.assertRaises( ValueError, remote_read.parse_selector, '' )
+
+    def test_varint(self):
+        for n in [0, 1, 127, 128, 300, 1644969600000, -1]:
+            encoded = remote_read.encode_varint(n)
+            self.assertEqual( (n % (1 << 64), len(encoded)), remote_read.decode_varint(encoded, 0) )
+        self.assertEqual( b'\xac\x02', remote_read.encode_varint(300) )
+
+    def test_read_request(self):
+        matchers = [(0, '__name__', 'up'), (2, 'job', 'no.*')]
+        body = remote_read.encode_read_request(matchers, 1000, 2000, [remote_read.STREAMED_XOR_CHUNKS, remote_read.SAMPLES])
+        # Query{start, end, matchers...}, then the packed response types
+        self.assertTrue( body.startswith(b'\x0a') )
+        self.assertTrue( body.endswith(b'\x12\x02\x01\x00') )
+        self.assertEqual( (matchers, 1000, 2000, [1, 0]), remote_read.decode_read_request(body) )
+
+    def test_snappy(self):
+        for data in [b'', b'a', b'abc' * 100, bytes(range(256)) * 300]:
+            self.assertEqual( data, remote_read.snappy_decompress(remote_read.snappy_compress(data)) )
+
+        # 'abcd' followed by copies of overlapping (1 byte offset) and 2 byte offset kinds
+        block = bytes([15, 3 << 2]) + b'abcd' + bytes([(4 << 2) | 1, 4]) + bytes([(2 << 2) | 2, 3, 0])
+        self.assertEqual( b'abcdabcdabcdbcd', remote_read.snappy_decompress(block) )
+        self.assertRaises( ValueError, remote_read.snappy_decompress, bytes([20, 3 << 2]) + b'abcd' )
+
+    def test_decode_read_response(self):
+        # Zero values and small timestamps are encoded differently, so the second series is decoded sample
+        # by sample between the runs
+        regular = [ (1644969600000 + i * 15000, i + 0.5) for i in range(100) ]
+        irregular = regular[:10] + [(1644969600000, 0.0), (0, 1.0), (-5, float('nan'))] + regular[10:]
+        body = remote_read.encode_field(1, timeseries({'__name__': 'a', 'job': 'x'}, regular) +
+                                           timeseries({'__name__': 'b'}, irregular) + timeseries({'__name__': 'c'}, []))
+        series = remote_read.decode_read_response(body)
+
+        self.assertEqual( [{'__name__': 'a', 'job': 'x'}, {'__name__': 'b'}, {'__name__': 'c'}], [ s['metric'] for s in series ] )
+        self.assertEqual( [ ts for (ts, _) in regular ], series[0]['timestamps'].tolist() )
+        self.assertEqual( [ v for (_, v) in regular ], series[0]['values'].tolist() )
+        self.assertEqual( [ ts for (ts, _) in irregular ], series[1]['timestamps'].tolist() )
+        np.testing.assert_array_equal( [ v for (_, v) in irregular ], series[1]['values'] )
+        self.assertEqual( (np.int64, np.float64, 0), (series[2]['timestamps'].dtype, series[2]['values'].dtype, len(series[2]['values'])) )
+
+    def test_decode_xor_chunk(self):
+        # Regular and irregular intervals, to exercise each delta-of-delta width, and repeated, special and
+        # arbitrary values
+        timestamps = np.cumsum([1644969600000, 15000, 15000, 15001, 14000, 1, 100000, 10 ** 9, 3 * 10 ** 12, 15000])
+        values = [1.0, 1.0, 2.5, float('inf'), -3.25, 0.0, 1e300, 123456.789, 123456.789, 7.0]
+        samples = list(zip(timestamps.tolist(), values))
+
+        for n in [0, 1, 2, 3, len(samples)]:
+            (ts, vs) = remote_read.decode_xor_chunk(xor_encode(samples[:n]))
+            self.assertEqual( timestamps[:n].tolist(), ts.tolist() )
+            self.assertEqual( values[:n], vs.tolist() )
+
+    def test_iter_chunked_read_response(self):
+        server = FakePrometheusServer()
+        series = [ ({'__name__': 'm', 'instance': str(i)}, [ (1644969600000 + j * 15000, float(i * j)) for j in range(500) ]) for i in range(3) ]
+        body = b''.join( server._read_frames(series) )
+        self.assertEqual( 0xE3069283, crc32c(b'123456789') )
+
+        # However the body is split, each series is put back together from its frames
+        for chunk_size in [1, 7, len(body)]:
+            decoded = list(remote_read.iter_chunked_read_response( body[i:i + chunk_size] for i in range(0, len(body), chunk_size) ))
+            self.assertEqual( [ labels for (labels, _) in series ], [ s['metric'] for s in decoded ] )
+            for ((_, samples), s) in zip(series, decoded):
+                self.assertEqual( [ ts for (ts, _) in samples ], s['timestamps'].tolist() )
+                self.assertEqual( [ v for (_, v) in samples ], s['values'].tolist() )
+
+        self.assertRaises( RuntimeError, list, remote_read.iter_chunked_read_response([body[:-1]]) )
+
+
+if (__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+from unittest import mock
+from multiprocessing import shared_memory
+import json
+import PyPrometheusStore
+from PyPrometheusStore import CompactMetricData, Interner, parse_response, to_shared, from_shared, release_shared
+from PyPrometheusQueryClient import PrometheusQueryClient
+import numpy as np
+import pandas as pd
+
+
+def build_results(instances=3, points=10):
+    result = []
+    for i in range(instances):
+        values = [ [1645000000 + n * 15, str(n * (i + 1))] for n in range(points) ]
+        result.append({'metric': {'__name__': 'm_total', 'instance': 'host{}'.format(i), 'job': 'node'}, 'values': values})
+    # One sparse series, so the shared timestamp index has gaps to fill
+    result[-1]['values'] = result[-1]['values'][::2]
+    return {'resultType': 'matrix', 'result': result}
+
+
+class TestCompactMetricData(unittest.TestCase):
+
+    def test_frame_matches_client(self):
+        results = build_results()
+        iut = CompactMetricData('m_total', {}, results, Interner())
+
+        expected = PrometheusQueryClient._result_to_frame(results)
+        pd.testing.assert_frame_equal(expected, iut['df'], check_freq=False)
+
+    def test_deltas_applied_on_materialization(self):
+        results = build_results()
+        iut = CompactMetricData('m_total', {}, results, Interner(), deltas=True, counter=True)
+
+        expected = PrometheusQueryClient._compute_deltas(PrometheusQueryClient._result_to_frame(results), counter=True)
+        pd.testing.assert_frame_equal(expected, iut['df'], check_freq=False)
+
+    def test_interning(self):
+        interner = Interner()
+        first  = CompactMetricData('m_total', {}, build_results(), interner)
+        second = CompactMetricData('m_total', {}, build_results(), interner)
+
+        self.assertIs( first.timestamps, second.timestamps )
+        self.assertIs( first.labels[0], second.labels[0] )
+
+    def test_data_rebuilt_on_demand(self):
+        results = build_results()
+        iut = CompactMetricData('m_total', {'active': True}, results, Interner(), dtype=np.float32)
+
+        self.assertEqual( {'metadata', 'title', 'data', 'df'}, set(iut.keys()) )
+        self.assertEqual( np.float32, iut['df'].dtypes.iloc[0] )
+
+        data = iut['data']
+        self.assertEqual( len(results['result']), len(data['result']) )
+        self.assertEqual( results['result'][2]['metric'], data['result'][2]['metric'] )
+        self.assertEqual( [ float(v[1]) for v in results['result'][2]['values'] ],
+                          [ float(v[1]) for v in data['result'][2]['values'] ] )
+
+    def test_keep_raw(self):
+        results = build_results()
+        iut = CompactMetricData('m_total', {}, results, Interner(), keep_raw=True)
+        self.assertIs( results, iut['data'] )
+
+    def test_data_round_trip(self):
+        results = build_results()
+        results['result'][0]['values'][1][1] = '0.1'
+        results['result'][1]['values'][1][1] = '+Inf'
+
+        for dtype in [np.float64, np.float32]:
+            iut = CompactMetricData('m_total', {}, results, Interner(), dtype=dtype)
+
+            # Rendered as the server rendered them, so they parse back to the same values
+            data = iut['data']
+            self.assertEqual( [ [ v for (_, v) in r['values'] ] for r in results['result'] ], [ [ v for (_, v) in r['values'] ] for r in data['result'] ] )
+            np.testing.assert_array_equal( iut.values, CompactMetricData('m_total', {}, data, Interner(), dtype=dtype).values )
+
+
+class TestSharedMemory(unittest.TestCase):
+
+    def test_round_trip(self):
+        timestamps = np.arange(5, dtype=np.int64)
+        values = np.arange(10, dtype=np.float64).reshape(5, 2)
+
+        handle = to_shared(timestamps, values)
+        (t, v) = from_shared(handle)
+
+        np.testing.assert_array_equal(timestamps, t)
+        np.testing.assert_array_equal(values, v)
+        self.assertRaises( FileNotFoundError, shared_memory.SharedMemory, name=handle[0] )
+
+    def test_release(self):
+        handle = to_shared(np.arange(3, dtype=np.int64), np.zeros((3, 1)))
+        release_shared(handle)
+        self.assertRaises( FileNotFoundError, shared_memory.SharedMemory, name=handle[0] )
+
+        # Releasing twice, or after from_shared(), is harmless
+        release_shared(handle)
+
+    def test_parse_response_releases_on_failure(self):
+        body = json.dumps({'status': 'success', 'data': build_results()}).encode()
+        made = []
+        def fail_second(timestamps, values):
+            if (made):
+                raise MemoryError()
+            made.append( to_shared(timestamps, values) )
+            return made[-1]
+
+        with mock.patch('PyPrometheusStore.to_shared', side_effect=fail_second):
+            self.assertRaises( MemoryError, parse_response, body, [ ('m_total', None), ('other_total', None) ], '<f8' )
+
+        self.assertRaises( FileNotFoundError, shared_memory.SharedMemory, name=made[0][0] )
+
+
+if (__name__ == '__main__'):
+    unittest.main()
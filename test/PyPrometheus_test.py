@@ -1,9 +1,13 @@
 import unittest
 from PyPrometheus import Prometheus
+from PyPrometheusQueryClient import PrometheusQueryClient
 from pathlib import Path
 import urllib3
 from datetime import datetime, timedelta
 import json
+import importlib.util
+import re
+import pandas as pd
 
 urllib3.disable_warnings()
 
@@ -153,6 +157,338 @@ class TestPyPrometheus(unittest.TestCase):
 
 
 
+class StubQueryClient(PrometheusQueryClient):
+    # Answers queries from canned series, recording each query it is asked to run
+    def __init__(self, series_per_metric):
+        super().__init__('http://127.0.0.1:9/', auto_get_server_metrics=False)
+        self.series_per_metric = series_per_metric
+        self.queries = []
+
+    def has_metric(self, metric):
+        return metric in self.series_per_metric
+
+    def _do_query(self, path, params):
+        self.queries.append( (path, params['query']) )
+        selector = re.search(r'__name__=~"([^"]*)"', params['query'])
+        names = selector.group(1).split('|') if (selector) else [ params['query'] ]
+        if (path == 'api/v1/query'):
+            return {'resultType': 'vector', 'result': [ {'metric': {'__name__': name}, 'value': [0, str(self.series_per_metric[name])]} for name in names ]}
+
+        # Samples on the step grid across the requested window, valued at their timestamp so counters only grow
+        step = PrometheusQueryClient._step_to_seconds(params['step'])
+        (start, end) = (float(params['start']), float(params['end']))
+        values = [ [start + n * step, str(start + n * step)] for n in range(int((end - start) // step) + 1) ]
+        return {'resultType': 'matrix', 'result': [ {'metric': {'__name__': name, 'instance': 'host{}'.format(i)}, 'values': values}
+                                                    for name in names for i in range(self.series_per_metric[name]) ]}
+
+
+class TestPyPrometheusDeferredConnect(unittest.TestCase):
+
+    def test_constructor_does_not_connect(self):
+        # Nothing listens on this port, so any request made here would fail
+        iut = Prometheus('http://127.0.0.1:9/', metrics_config_file='./test/config_metrics.json')
+
+        self.assertIsNone( iut.pqc._session )
+        self.assertIsNone( iut.pqc.metrics._loaded_at )
+        self.assertIn( 'node_load1', iut._metrics_config )
+
+
+class TestPyPrometheusBatching(unittest.TestCase):
+
+    def _instantiate_instance(self, series_per_metric):
+        iut = Prometheus('http://127.0.0.1:9/', metrics_config_file='./test/config_metrics.json', 
+                         starttime='2022-02-16T08:26:00Z', endtime='2022-02-16T08:35:00Z')
+        iut.pqc = StubQueryClient(series_per_metric)
+        iut._metrics_config = { name: {'active': True} for name in series_per_metric }
+        return iut
+
+    def test_get_metrics_batched(self):
+        iut = self._instantiate_instance({'node_load1': 2, 'node_load5': 2, 'node_disk_read_bytes_total': 3, 'node_big': 8})
+
+        errors = iut.get_metrics(report_progress=False, batch=True, max_series_per_batch=8)
+        self.assertEqual( {}, errors )
+
+        # One count query, then node_load1+node_load5+node_disk_read_bytes_total together and node_big alone
+        range_queries = [ query for (path, query) in iut.pqc.queries if path == 'api/v1/query_range' ]
+        self.assertEqual( 1, len([ path for (path, _) in iut.pqc.queries if path == 'api/v1/query' ]) )
+        self.assertEqual( ['{__name__=~"node_load1|node_load5|node_disk_read_bytes_total"}', 'node_big'], range_queries )
+
+        self.assertEqual( ['node_load1 - host0', 'node_load1 - host1'], list(iut.prometheus_data['node_load1']['df'].columns) )
+        self.assertEqual( 3, len(iut.prometheus_data['node_disk_read_bytes_total']['data']['result']) )
+        self.assertIn( 'delta_node_disk_read_bytes_total - host2', iut.prometheus_data['node_disk_read_bytes_total']['df'].columns )
+
+    def test_get_metrics_batch_size(self):
+        iut = self._instantiate_instance({'node_load1': 1, 'node_load5': 1, 'node_load15': 1})
+        iut.pqc.max_metrics_per_selector = 2
+
+        iut.get_metrics(report_progress=False, batch=True)
+
+        # The client's limit on names per selector bounds the count queries and the batches
+        count_queries = [ query for (path, query) in iut.pqc.queries if path == 'api/v1/query' ]
+        self.assertEqual( ['count by (__name__) ({__name__=~"node_load15"})', 'count by (__name__) ({__name__=~"node_load1|node_load5"})'], 
+                          sorted(count_queries) )
+        range_queries = [ query for (path, query) in iut.pqc.queries if path == 'api/v1/query_range' ]
+        self.assertEqual( ['{__name__=~"node_load1|node_load5"}', 'node_load15'], range_queries )
+        self.assertEqual( {'node_load1', 'node_load5', 'node_load15'}, set(iut.prometheus_data.keys()) )
+
+    def test_get_metrics_unbatched(self):
+        iut = self._instantiate_instance({'node_load1': 2, 'node_load5': 2})
+
+        iut.get_metrics(report_progress=False, max_workers=2)
+        self.assertEqual( ['node_load1', 'node_load5'], sorted(query for (_, query) in iut.pqc.queries) )
+
+    def test_get_metrics_partial_failure(self):
+        iut = self._instantiate_instance({'node_load1': 2, 'node_load5': 2, 'node_load15': 2})
+        do_query = iut.pqc._do_query
+        def failing_do_query(path, params):
+            if (params['query'] == 'node_load5'):
+                raise RuntimeError('execution: query timed out')
+            return do_query(path, params)
+        iut.pqc._do_query = failing_do_query
+
+        errors = iut.get_metrics(report_progress=False, max_workers=3)
+
+        # The failure is reported against its metric, and the others are still fetched
+        self.assertEqual( ['node_load5'], list(errors.keys()) )
+        self.assertIsInstance( errors['node_load5'], RuntimeError )
+        self.assertEqual( 'execution: query timed out', str(errors['node_load5']) )
+        self.assertEqual( ['node_load1', 'node_load15'], sorted(iut.prometheus_data.keys()) )
+        self.assertEqual( ['node_load15 - host0', 'node_load15 - host1'], list(iut.prometheus_data['node_load15']['df'].columns) )
+
+
+class TestPyPrometheusInstrumentation(unittest.TestCase):
+
+    def test_get_metrics_instrumented(self):
+        from PyPrometheusInstrumentation import Instrumentation
+
+        iut = Prometheus('http://127.0.0.1:9/', metrics_config_file='./test/config_metrics.json', 
+                         starttime='2022-02-16T08:26:00Z', endtime='2022-02-16T08:35:00Z')
+        iut.pqc = StubQueryClient({'node_load1': 2, 'node_load5': 2, 'node_disk_read_bytes_total': 3})
+        iut.pqc.instrumentation = Instrumentation()
+        iut._metrics_config = { name: {'active': True} for name in iut.pqc.series_per_metric }
+
+        iut.get_metrics(report_progress=False, batch=True, max_series_per_batch=4)
+
+        # node_load1 and node_load5 in one batch, node_disk_read_bytes_total (with deltas) alone
+        records = sorted(iut.pqc.instrumentation.records, key=lambda record: record.name)
+        self.assertEqual( ['get_metric', 'get_metric_batch'], [ record.name for record in records ] )
+        self.assertEqual( {'dataframe', 'deltas'}, set(records[0].phases) )
+        self.assertEqual( {'dataframe'}, set(records[1].phases) )
+
+
+class TestPyPrometheusParallelParse(unittest.TestCase):
+
+    def test_get_metrics_parse_processes(self):
+        from fake_prometheus import FakePrometheusServer
+        from PyPrometheusStore import CompactMetricData
+
+        config = {'metric_0000': {'active': True}, 'metric_0001': {'active': True}, 'node_cpu_seconds_total': {'active': True},
+                  'node_load1': {'active': True, 'function': 'avg_over_time', 'range': '5m'}}
+        with FakePrometheusServer(metrics=2, series=3, extra_metrics=['node_cpu_seconds_total', 'node_load1']) as server:
+            (expected, expected_tail) = ({}, {})
+            for (batch, parse_processes) in [ (False, 0), (False, 2), (True, 2) ]:
+                iut = Prometheus(server.url, metrics_config_file='./test/config_metrics.json', 
+                                 starttime='2022-02-16T08:00:00Z', endtime='2022-02-16T09:00:00Z')
+                iut._metrics_config = config
+
+                self.assertEqual( {}, iut.get_metrics(report_progress=False, batch=batch, parse_processes=parse_processes) )
+                self.assertIsNone( iut._parse_pool )
+
+                for (metric, item) in iut.prometheus_data.items():
+                    if (not parse_processes):
+                        (expected[metric], expected_tail[metric]) = (item, iut._tail_state[metric])
+                        continue
+                    self.assertIsInstance( item, CompactMetricData )
+                    pd.testing.assert_frame_equal( expected[metric]['df'], item['df'], check_freq=False )
+                    self.assertEqual( [ r['metric'] for r in expected[metric]['data']['result'] ], [ r['metric'] for r in item['data']['result'] ] )
+                    self.assertEqual( expected_tail[metric]['last'], iut._tail_state[metric]['last'] )
+
+    def test_parse_pool_started_up_front(self):
+        pool = Prometheus._start_parse_pool(2)
+        try:
+            # Every worker is running before any fetch thread starts, and none was forked from this process
+            self.assertEqual( 2, len(pool._processes) )
+            self.assertNotEqual( 'fork', pool._mp_context.get_start_method() )
+        finally:
+            pool.shutdown()
+
+
+class TestPyPrometheusCardinality(unittest.TestCase):
+
+    def test_get_metrics_max_series(self):
+        from fake_prometheus import FakePrometheusServer
+
+        config = {'metric_0000': {'active': True, 'labels': ['job', 'instance']}, 'metric_0001': {'active': True, 'max_series': 10},
+                  'metric_0002': {'active': True}}
+        with FakePrometheusServer(metrics=3, series=4) as server:
+            for batch in [False, True]:
+                iut = Prometheus(server.url, metrics_config_file='./test/config_metrics.json', max_series=3,
+                                 starttime='2022-02-16T08:00:00Z', endtime='2022-02-16T09:00:00Z')
+                iut._metrics_config = config
+
+                # metric_0000 and metric_0002 have more series than the default limit allows
+                errors = iut.get_metrics(report_progress=False, batch=batch)
+                self.assertEqual( ['metric_0000', 'metric_0002'], sorted(errors) )
+                self.assertEqual( ['metric_0001'], list(iut.prometheus_data) )
+
+                iut._max_series = None
+                item = iut.get_metric('metric_0000')
+                self.assertEqual( 'metric_0000 - node, host0000:9100', item['df'].columns[0] )
+
+
+class TestPyPrometheusPushdown(unittest.TestCase):
+
+    def test_build_query(self):
+        self.assertEqual( 'node_load1', Prometheus._build_query('node_load1', {'active': True, 'step': '1m'}) )
+        self.assertEqual( 'rate(node_cpu_seconds_total[2m])', 
+                          Prometheus._build_query('node_cpu_seconds_total', {'function': 'rate', 'range': '2m'}) )
+        self.assertEqual( 'sum by (job, mode) (rate(node_cpu_seconds_total[5m]))', 
+                          Prometheus._build_query('node_cpu_seconds_total', {'function': 'rate', 'aggregate_by': ['job', 'mode']}) )
+        self.assertEqual( 'max by (job) (quantile_over_time(0.95, node_load1[10m]))', 
+                          Prometheus._build_query('node_load1', {'function': 'quantile_over_time', 'quantile': 0.95, 'range': '10m', 
+                                                                 'aggregate_by': ['job'], 'aggregation': 'max'}) )
+        self.assertEqual( 'quantile by (job) (0.9, node_load1)', 
+                          Prometheus._build_query('node_load1', {'aggregate_by': ['job'], 'aggregation': 'quantile', 'quantile': 0.9}) )
+
+    def test_build_query_exception_unsupported(self):
+        self.assertRaises( ValueError, Prometheus._build_query, 'node_load1', {'function': 'label_replace'} )
+        self.assertRaises( ValueError, Prometheus._build_query, 'node_load1', {'aggregate_by': ['job'], 'aggregation': 'topk'} )
+
+    def test_build_query_single_label(self):
+        self.assertEqual( 'sum by (job) (node_load1)', Prometheus._build_query('node_load1', {'aggregate_by': 'job'}) )
+
+        iut = Prometheus('http://127.0.0.1:9/', metrics_config_file='./test/config_metrics.json')
+        self.assertEqual( ['job'], iut._column_labels_for({'aggregate_by': 'job'}) )
+
+    def test_build_query_exception_no_quantile(self):
+        with self.assertRaisesRegex(ValueError, "'quantile'"):
+            Prometheus._build_query('node_load1', {'function': 'quantile_over_time'})
+        with self.assertRaisesRegex(ValueError, "'quantile'"):
+            Prometheus._build_query('node_load1', {'aggregate_by': ['job'], 'aggregation': 'quantile'})
+
+    def test_aggregated_frame_columns(self):
+        iut = Prometheus('http://127.0.0.1:9/', metrics_config_file='./test/config_metrics.json')
+        results = {'resultType': 'matrix', 'result': [
+            {'metric': {'job': 'node', 'mode': mode}, 'values': [[1645000000, '1'], [1645000060, '2']]} for mode in ('user', 'system') ]}
+
+        item = iut._store_metric('node_cpu_seconds_total', {'function': 'rate', 'aggregate_by': ['job', 'mode']}, results)
+
+        # Reduced on the server, so no deltas even though this is a _total metric
+        self.assertEqual( ['node_cpu_seconds_total - node, user', 'node_cpu_seconds_total - node, system'], list(item['df'].columns) )
+
+
+class TestPyPrometheusTail(unittest.TestCase):
+
+    def test_refresh_metric_appends(self):
+        end = datetime.utcnow().replace(microsecond=0) - timedelta(minutes=10)
+        iut = Prometheus('http://127.0.0.1:9/', metrics_config_file='./test/config_metrics.json', 
+                         starttime=end - timedelta(minutes=30), endtime=end)
+        iut.pqc = StubQueryClient({'node_disk_read_bytes_total': 2})
+        iut._metrics_config = {'node_disk_read_bytes_total': {'active': True}}
+
+        before = iut.get_metric('node_disk_read_bytes_total')['df']
+        iut.pqc.queries.clear()
+
+        after = iut.refresh_metric('node_disk_read_bytes_total')['df']
+
+        # Only the new part of the window was requested, and it was appended to what we had
+        self.assertEqual( 1, len(iut.pqc.queries) )
+        self.assertGreater( len(after), len(before) )
+        pd.testing.assert_frame_equal(before, after.iloc[:len(before)], check_freq=False)
+        self.assertTrue( after.index.is_monotonic_increasing and after.index.is_unique )
+
+        # The first appended delta continues on from the last row we already held
+        self.assertEqual( after['delta_node_disk_read_bytes_total - host0'].iloc[len(before)], 
+                          after['delta_node_disk_read_bytes_total - host0'].iloc[len(before) - 1] )
+
+    def test_refresh_metric_retention(self):
+        end = datetime.utcnow().replace(microsecond=0)
+        iut = Prometheus('http://127.0.0.1:9/', metrics_config_file='./test/config_metrics.json', 
+                         starttime=end - timedelta(hours=1), endtime=end - timedelta(minutes=5))
+        iut.pqc = StubQueryClient({'node_load1': 1})
+
+        iut.get_metric('node_load1')
+        df = iut.refresh_metric('node_load1', retention=600)['df']
+
+        self.assertGreaterEqual( df.index.min(), pd.Timestamp(end) - pd.Timedelta(seconds=620) )
+
+    def test_refresh_metric_keeps_columns(self):
+        iut = Prometheus('http://127.0.0.1:9/', metrics_config_file='./test/config_metrics.json')
+        iut.pqc = StubQueryClient({})
+        last = (int(datetime.utcnow().timestamp()) // 60 - 2) * 60
+        results = {'resultType': 'matrix', 'result': [
+            {'metric': {'__name__': 'node_load1', 'instance': 'a', 'mode': mode}, 'values': [[last - 60, '1'], [last, '2']]} for mode in ('idle', 'user') ]}
+
+        iut._store_metric('node_load1', {}, results)
+        iut._remember_window('node_load1', 'node_load1', results, last, '1m')
+
+        # Only one of the two series has new samples, so on its own it would be named just 'node_load1 - a'
+        iut.pqc.query_range = lambda query, start, end, step: {'resultType': 'matrix', 'result': [ 
+            {'metric': {'__name__': 'node_load1', 'instance': 'a', 'mode': 'idle'}, 'values': [[last + 60, '3']]} ]}
+        df = iut.refresh_metric('node_load1')['df']
+
+        self.assertEqual( ['node_load1 - a, mode=idle', 'node_load1 - a, mode=user'], list(df.columns) )
+        self.assertEqual( [1.0, 2.0, 3.0], list(df['node_load1 - a, mode=idle']) )
+        self.assertTrue( pd.isna(df['node_load1 - a, mode=user'].iloc[-1]) )
+
+    def test_refresh_metric_exception_not_fetched(self):
+        iut = Prometheus('http://127.0.0.1:9/', metrics_config_file='./test/config_metrics.json')
+        self.assertRaises( ValueError, iut.refresh_metric, 'node_load1' )
+
+
+@unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+class TestPyPrometheusExport(unittest.TestCase):
+
+    export_path = Path('./test/PyPrometheus/export/')
+
+    def setUp(self) -> None:
+        delete_folder(self.export_path)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        delete_folder(self.export_path)
+        return super().tearDown()
+
+    def _instance_with_data(self):
+        # Bypass the constructor, which needs a live server
+        iut = Prometheus.__new__(Prometheus)
+        iut.prometheus_data = {}
+
+        results = {'resultType': 'matrix', 'result': [
+            {'metric': {'__name__': 'node:load', 'instance': 'host{}'.format(i)}, 'values': [[1645000000 + n * 15, str(n * i)] for n in range(50)]}
+            for i in range(3) ]}
+        df = PrometheusQueryClient._compute_deltas(PrometheusQueryClient._result_to_frame(results))
+        iut.prometheus_data['node:load'] = {'metadata': {'active': True, 'deltas': True}, 'title': 'node:load', 'data': results, 'df': df}
+
+        return iut
+
+    def test_export_import_arrow(self):
+        source = self._instance_with_data()
+        source.export_data(self.export_path)
+
+        iut = Prometheus.__new__(Prometheus)
+        iut.prometheus_data = {}
+        self.assertEqual( ['node:load'], iut.import_data(self.export_path) )
+
+        item = iut.prometheus_data['node:load']
+        self.assertEqual( {'active': True, 'deltas': True}, item['metadata'] )
+        pd.testing.assert_frame_equal(source.prometheus_data['node:load']['df'], item['df'], check_freq=False)
+
+        # The columns should be views onto the memory-mapped file, not copies
+        self.assertFalse( item['df']['node:load - host1'].values.flags.owndata )
+
+    def test_export_import_parquet(self):
+        source = self._instance_with_data()
+        source.export_data(self.export_path, format='parquet')
+
+        iut = Prometheus.__new__(Prometheus)
+        iut.prometheus_data = {}
+        iut.import_data(self.export_path)
+
+        pd.testing.assert_frame_equal(source.prometheus_data['node:load']['df'], iut.prometheus_data['node:load']['df'],
+                                      check_freq=False, check_index_type=False)
+
+
 if (__name__ == '__main__'):
     unittest.main()
     
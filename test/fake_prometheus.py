@@ -0,0 +1,336 @@
+import re
+import json
+import math
+import time
+import struct
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PyPrometheusQueryClient import PrometheusQueryClient
+import PyPrometheusRemoteRead as remote_read
+
+
+class FakePrometheusServer:
+    # A local stand-in for the Prometheus HTTP API, generating deterministic data of configurable size:
+    #   api/v1/label/__name__/values  'metrics' names, metric_0000 ... plus any in 'extra_metrics'
+    #   api/v1/query_range            'series' series per metric name, with a sample at every step of the window
+    #   api/v1/query                  the same series at a single instant, or a count() or count by (__name__) of them,
+    #                                 or a count(last_over_time(...[<n>ms:<step>])) of those present over n ms
+    #   api/v1/series                 the label sets of the series present between 'start' and 'end'
+    #   api/v1/read                   remote read of the same series' raw samples, every 'scrape_interval' seconds,
+    #                                 streamed as XOR chunks if asked for and 'streamed_read' is set
+    # 'latency' seconds are added to every response, to stand in for network and server time. GETs are answered
+    # with the (status, content type, body) responses in 'failures', in turn, before any of the above. With 
+    # 'churn', every metric's series are replaced by as many new ones (new instances) every 'churn' seconds.
+    # 'peak_in_flight' is the most requests which were being handled at once.
+    def __init__(self, metrics=100, series=10, latency=0.0, extra_metrics=None, scrape_interval=15, streamed_read=True, 
+                 failures=None, churn=None):
+        self.metrics = metrics
+        self.series = series
+        self.latency = latency
+        self.failures = list(failures or [])
+        self.churn = churn
+        self.extra_metrics = list(extra_metrics or [])
+        self.scrape_interval = scrape_interval
+        self.streamed_read = streamed_read
+
+        self.requests = []
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self._server.server_port)
+
+
+    def metric_names(self):
+        return [ 'metric_{:04d}'.format(i) for i in range(self.metrics) ] + self.extra_metrics
+
+
+    def start(self):
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = { k: v[0] for (k, v) in parse_qs(url.query).items() }
+                with fake._lock:
+                    fake.requests.append( (url.path, params) )
+                    failure = fake.failures.pop(0) if (fake.failures) else None
+                    fake._begin()
+
+                try:
+                    if (fake.latency):
+                        time.sleep(fake.latency)
+
+                    if (failure):
+                        (status, content_type, body) = failure
+                    else:
+                        (status, body) = fake.handle(url.path, params)
+                        content_type = 'application/json'
+                finally:
+                    fake._end()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with fake._lock:
+                    fake.requests.append( (url.path, body) )
+                    fake._begin()
+
+                try:
+                    if (fake.latency):
+                        time.sleep(fake.latency)
+
+                    (status, content_type, body) = fake.handle_read(url.path, body)
+                finally:
+                    fake._end()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+
+    def _begin(self):
+        # Called holding the lock
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+
+    def _end(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        return
+
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+    @staticmethod
+    def _selected_names(query):
+        # Understands bare metric names, {__name__=~"a|b"} selectors and names wrapped in functions/aggregations
+        selector = re.search(r'__name__=~"([^"]*)"', query)
+        if (selector):
+            return selector.group(1).split('|')
+        return re.findall(r'[a-zA-Z_:][a-zA-Z0-9_:]*(?=\[|\)|$)', query)[-1:]
+
+
+    def _series(self, name, generation=0):
+        # (index, labels) of the series present in a generation, see _generation()
+        return [ (i, {'__name__': name, 'instance': 'host{:04d}:9100'.format(i), 'job': 'node'}) 
+                 for i in range(generation * self.series, (generation + 1) * self.series) ]
+
+
+    def _generation(self, ts):
+        return int(ts // self.churn) if (self.churn) else 0
+
+
+    def _generations(self, start, end):
+        return range(self._generation(start), self._generation(end) + 1)
+
+
+    @staticmethod
+    def _value(ts, i):
+        # A slowly increasing, counter-like value, distinct per series
+        return '{:.3f}'.format(ts / 60 + i * 1000 + math.sin(ts / 600))
+
+
+    def handle(self, path, params):
+        if (path.endswith('/label/__name__/values')):
+            return self._success(self.metric_names())
+
+        if (path.endswith('/query_range')):
+            step  = PrometheusQueryClient._step_to_seconds(params['step'])
+            start = PrometheusQueryClient._to_timestamp(params['start'])
+            end   = PrometheusQueryClient._to_timestamp(params['end'])
+            if ((end - start) / step + 1 > PrometheusQueryClient.max_points_per_query):
+                return self._error(400, 'bad_data', 'exceeded maximum resolution of 11,000 points per timeseries')
+
+            timestamps = [ start + n * step for n in range(int((end - start) // step) + 1) ]
+            result = [ {'metric': labels, 'values': [ [ts, self._value(ts, i)] for ts in timestamps if self._generation(ts) == generation ]}
+                       for name in self._selected_names(params['query']) for generation in self._generations(start, end) 
+                       for (i, labels) in self._series(name, generation) ]
+            return self._success({'resultType': 'matrix', 'result': [ r for r in result if r['values'] ]})
+
+        if (path.endswith('/series')):
+            (start, end) = (PrometheusQueryClient._to_timestamp(params['start']), PrometheusQueryClient._to_timestamp(params['end']))
+            return self._success([ labels for name in self._selected_names(params['match[]']) 
+                                   for generation in self._generations(start, end) for (_, labels) in self._series(name, generation) ])
+
+        if (path.endswith('/query')):
+            ts = PrometheusQueryClient._to_timestamp(params['time']) if ('time' in params) else time.time()
+            names = self._selected_names(params['query'])
+            if (params['query'].startswith('count by (__name__)')):
+                result = [ {'metric': {'__name__': name}, 'value': [ts, str(self.series)]} for name in names ]
+            elif (params['query'].startswith('count(')):
+                window = re.search(r'\[(\d+)ms:', params['query'])
+                generations = len(self._generations(ts - int(window.group(1)) / 1000, ts)) if (window) else 1
+                result = [ {'metric': {}, 'value': [ts, str(self.series * generations * len(names))]} ] if (names) else []
+            else:
+                result = [ {'metric': labels, 'value': [ts, self._value(ts, i)]}
+                           for name in names for (i, labels) in self._series(name, self._generation(ts)) ]
+            return self._success({'resultType': 'vector', 'result': result})
+
+        return self._error(404, 'not_found', 'unknown path {}'.format(path))
+
+
+    def handle_read(self, path, body):
+        if (not path.endswith('/read')):
+            return (404, 'text/plain', b'404 page not found')
+        try:
+            (matchers, start_ms, end_ms, types) = remote_read.decode_read_request(remote_read.snappy_decompress(body))
+        except Exception as e:
+            return (400, 'text/plain', str(e).encode('UTF-8'))
+
+        def matches(labels):
+            tests = {0: lambda v, p: v == p, 1: lambda v, p: v != p, 2: lambda v, p: re.fullmatch(p, v) is not None,
+                     3: lambda v, p: re.fullmatch(p, v) is None}
+            return all(tests[t](labels.get(name, ''), pattern) for (t, name, pattern) in matchers)
+
+        interval = int(self.scrape_interval * 1000)
+        timestamps = list(range(-(-start_ms // interval) * interval, end_ms + 1, interval))
+        series = [ (labels, [ (ts, float(self._value(ts / 1000, i))) for ts in timestamps ])
+                   for name in self.metric_names() for (i, labels) in self._series(name) if matches(labels) ]
+
+        if (self.streamed_read and types and types[0] == remote_read.STREAMED_XOR_CHUNKS):
+            return (200, remote_read.STREAMED_CONTENT_TYPE, b''.join( self._read_frames(series) ))
+
+        encoded = b''.join( remote_read.encode_field(1, self._encode_labels(labels) +
+                                                     b''.join( remote_read.encode_field(2, self._encode_sample(ts, v)) for (ts, v) in samples ))
+                            for (labels, samples) in series )
+        response = remote_read.encode_field(1, encoded)
+        return (200, 'application/x-protobuf', remote_read.snappy_compress(response))
+
+
+    @staticmethod
+    def _encode_labels(labels):
+        return b''.join( remote_read.encode_field(1, remote_read.encode_field(1, k) + remote_read.encode_field(2, v))
+                         for (k, v) in sorted(labels.items()) )
+
+
+    @staticmethod
+    def _encode_sample(ts, value):
+        # Zero values (the default) are left out, as protobuf encoders do
+        return (b'\x09' + struct.pack('<d', value) if (value) else b'') + (remote_read.encode_field(2, ts) if (ts) else b'')
+
+
+    def _read_frames(self, series, samples_per_chunk=120, chunks_per_frame=2):
+        # A frame per (up to) chunks_per_frame chunks of a series, so longer series span several frames
+        for (labels, samples) in series:
+            chunks = [ samples[i:i + samples_per_chunk] for i in range(0, len(samples), samples_per_chunk) ]
+            for i in range(0, len(chunks), chunks_per_frame):
+                encoded = b''.join( remote_read.encode_field(2, remote_read.encode_field(1, chunk[0][0]) + remote_read.encode_field(2, chunk[-1][0]) +
+                                                                remote_read.encode_field(3, 1) + remote_read.encode_field(4, xor_encode(chunk)))
+                                    for chunk in chunks[i:i + chunks_per_frame] )
+                message = remote_read.encode_field(1, self._encode_labels(labels) + encoded)
+                yield remote_read.encode_varint(len(message)) + crc32c(message).to_bytes(4, 'big') + message
+
+
+    @staticmethod
+    def _success(data):
+        return (200, json.dumps({'status': 'success', 'data': data}).encode('UTF-8'))
+
+    @staticmethod
+    def _error(status, error_type, error):
+        return (status, json.dumps({'status': 'error', 'errorType': error_type, 'error': error}).encode('UTF-8'))
+
+
+
+def xor_encode(samples):
+    # A Prometheus XOR chunk of [(ts_ms, value), ...], as written by tsdb/chunkenc/xor.go
+    bits = [0, 0]       # [value, length]
+    def write(value, n):
+        bits[0] = (bits[0] << n) | (value & ((1 << n) - 1))
+        bits[1] += n
+
+    def write_uvarint(n):
+        for b in remote_read.encode_varint(n):
+            write(b, 8)
+
+    (t, delta, vbits, leading, trailing) = (0, 0, 0, 0xff, 0)
+    for (i, (ts, value)) in enumerate(samples):
+        new_vbits = struct.unpack('>Q', struct.pack('>d', value))[0]
+        if (i == 0):
+            write_uvarint((ts << 1) ^ (ts >> 63))
+            write(new_vbits, 64)
+            (t, vbits) = (ts, new_vbits)
+            continue
+
+        if (i == 1):
+            delta = ts - t
+            write_uvarint(delta)
+        else:
+            dod = (ts - t) - delta
+            delta = ts - t
+            if (dod == 0):
+                write(0, 1)
+            else:
+                for (code, n, width) in ((0b10, 2, 14), (0b110, 3, 17), (0b1110, 4, 20), (0b1111, 4, 64)):
+                    if (width == 64 or -((1 << (width - 1)) - 1) <= dod <= 1 << (width - 1)):
+                        write(code, n)
+                        write(dod, width)
+                        break
+        t = ts
+
+        xor = new_vbits ^ vbits
+        vbits = new_vbits
+        if (xor == 0):
+            write(0, 1)
+            continue
+        write(1, 1)
+        new_leading = min(64 - xor.bit_length(), 31)
+        new_trailing = (xor & -xor).bit_length() - 1
+        if (leading != 0xff and new_leading >= leading and new_trailing >= trailing):
+            write(0, 1)
+            write(xor >> trailing, 64 - leading - trailing)
+        else:
+            (leading, trailing) = (new_leading, new_trailing)
+            significant = 64 - leading - trailing
+            write(1, 1)
+            write(leading, 5)
+            write(significant, 6)
+            write(xor >> trailing, significant)
+
+    (value, n) = bits
+    pad = -n % 8
+    return len(samples).to_bytes(2, 'big') + (value << pad).to_bytes((n + pad) // 8, 'big')
+
+
+_crc32c_table = []
+for _n in range(256):
+    for _ in range(8):
+        _n = (_n >> 1) ^ 0x82F63B78 if (_n & 1) else _n >> 1
+    _crc32c_table.append(_n)
+
+def crc32c(data):
+    crc = 0xFFFFFFFF
+    for b in data:
+        crc = _crc32c_table[(crc ^ b) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF